@@ -1,12 +1,17 @@
 #! /usr/bin/python3
 #-*-coding: utf-8 -*-
 
-from AutoHeadFix.AHF_Camera import AHF_Camera
+from AutoHeadFix.AHF_UDPTrig import AHF_UDPTrig
 import os
 import socket
+import selectors
+import threading
+import shutil
 import json
+import inspect
 import pwd
 import grp
+from time import time, sleep
 
 
 def Camera2Run():
@@ -14,17 +19,19 @@ def Camera2Run():
     AHF_Camera2 is a stand-alone program running on a dedicated Rpi that controls a secondary camera trigered by a UDP command from the Rpi running the main task
 
     AHF_Camera2Run waits for a UDP start signal containing some metadata, which it incorporates into a filename for the video it records,
-    stopping the video upon receipt of a UDP signal whose message is "Stop"
+    stopping the video upon receipt of a UDP signal whose message is "Stop". The waiting is done by a Camera2Daemon event loop,
+    which also handles heartbeat and status messages and can record for several senders at once.
     There may be more than 1 secondary camera, recording different aspects of mouse behaviour during the task.
 
     The AHF_Camera class from AutoHeadFix is used to control the PiCamera
 
     Camera2 saves settings in a JSON dictionary file, ./Camera2_settings.jsn, for the following information:
     dataPath          The file path to the folder where the recorded video will be stored
-    UDP_SENDER        IP address of the Rpi running the main task, which sends the start and stop signals
+    UDP_SENDER        IP address of the Rpi running the main task, which sends the start and stop signals, or a comma separated list of addresses
     UDP_IP            IP address of the interface to look at on this computer, or just leave blank and it will look on all interfaces
     UDP_PORT          use any one of the many non-assigned port numbers
-    maxRecSecs        The maximum number of seconds to record video after getting a start signal, a fail-safe if connection is lost after starting
+    UDP_Group         multicast group the main task sends triggers to, so all secondary cameras start from a single message, or blank if triggers are sent to this Pi's address
+    maxRecSecs        The maximum number of seconds to record video after last hearing from the sender, a fail-safe if connection is lost after starting
 
     plus the settings for the AHF_camera used.
     """
@@ -37,7 +44,9 @@ def Camera2Run():
         print (
             'Unable to open Camera2_settings.jsn, using default settings, please edit new settings.')
         configDict = {'dataPath': '/home/pi/Documents/', 'UDP_Sender': '127.0.0.1',
-                      'UDP_IP': '', 'UDP_Port': 5007, 'maxRecSecs': 30.0}
+                      'UDP_IP': '', 'UDP_Port': 5007, 'UDP_Group': '', 'maxRecSecs': 30.0}
+    # camera is imported here so the daemon can be run without picamera installed, as in loopbackTest
+    from AutoHeadFix.AHF_Camera import AHF_Camera
     try:
         camera2 = AHF_Camera(configDict)
     except Exception as anError:
@@ -49,39 +58,166 @@ def Camera2Run():
         editConfig(configDict, camera2)
 
     try:
-        # set up UDP port for listening
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.bind((configDict.get('UDP_IP'), configDict.get('UDP_Port')))
+        # set up UDP port for listening, joining the multicast group if there is one
+        sock = AHF_UDPTrig.make_listener(configDict.get('UDP_Port'), configDict.get(
+            'UDP_Group', ''), configDict.get('UDP_IP'))
     except socket.error:
         print ("Quitting, Could not make a socket connection.")
         return
-    isCapturing = False
-    while True:
-        if isCapturing == True:
-            sock.settimeout(configDict.get('maxRecSecs'))
-            print ('Waiting for a Stop Trigger.')
-        else:
-            print ('Waiting for a Start Trigger.')
-            sock.settimeout(None)
+    daemon = Camera2Daemon(configDict, camera2, sock)
+    daemon.run()
+
+
+class Camera2Daemon (object):
+    """
+    Event loop for AHF_Camera2 that records videos triggered by one or more senders, using a selector on the UDP socket
+
+    Messages understood, all as utf-8 text in a single datagram:
+    START:name    start a recording session for the sending computer, saved as dataPath + name + '.' + format
+    name          same as START:name, for senders that only send metadata to start a recording
+    Stop or STOP  stop the recording session of the sending computer
+    HEARTBEAT     tells the watchdog that the sending computer is still alive, so its session can run past maxRecSecs
+    STATUS        replies to the sender with a JSON dictionary of sessions and disk use of dataPath
+
+    Each sender gets its own session, recorded on its own splitter port of the camera, so up to 3 senders can record at once.
+    Each session has a watchdog that stops recording if nothing is heard from its sender for maxRecSecs.
+    The camera records in its own threads, so handling control messages here never delays frame capture.
+    """
+    SPLITTER_PORTS = (1, 2, 3)
+
+    def __init__(self, configDict, camera2, sock):
+        """
+        Makes a new Camera2Daemon for an already configured camera and an already bound UDP socket
+
+        :param configDict: dictionary of Camera2 settings, UDP_Sender can be a comma separated list of ip addresses
+        :param camera2: the AHF camera to record with
+        :param sock: UDP socket to receive messages on
+        """
+        self.configDict = configDict
+        self.camera2 = camera2
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.senders = set(address.strip() for address in str(
+            configDict.get('UDP_Sender', '')).split(','))
+        self.maxRecSecs = float(configDict.get('maxRecSecs', 30.0))
+        self.sessions = {}  # sender address: dictionary of session info
+        self.startTime = time()
+        self.isRunning = False
+
+    def run(self):
+        """
+        Runs the event loop until quit is called, waiting on the socket until the next watchdog deadline
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        self.isRunning = True
+        print ('Waiting for triggers from ' + ', '.join(sorted(self.senders)))
+        try:
+            while self.isRunning:
+                selector.select(self.nextTimeout())
+                while True:
+                    try:
+                        data, addr = self.sock.recvfrom(1024)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    self.handleMessage(data.decode('utf-8', 'replace'), addr)
+                self.checkWatchdogs()
+        finally:
+            selector.close()
+            for address in list(self.sessions.keys()):
+                self.stopSession(address, 'quitting')
+
+    def quit(self):
+        """
+        Makes the event loop exit and stop all sessions the next time it wakes
+        """
+        self.isRunning = False
+
+    def nextTimeout(self):
+        """
+        Returns seconds until the first watchdog deadline, never more than 1 second so quit is noticed
+        """
+        timeout = 1.0
+        for session in self.sessions.values():
+            timeout = min(timeout, session['lastHeard'] + self.maxRecSecs - time())
+        return max(0, timeout)
+
+    def handleMessage(self, dataStr, addr):
+        """
+        Acts on a single message from a sender
+        """
+        address = addr[0]
+        if dataStr == 'STATUS':
+            self.sock.sendto(bytes(json.dumps(self.status()), 'utf-8'), addr)
+            return
+        if address not in self.senders:
+            return
+        if address in self.sessions:
+            self.sessions[address]['lastHeard'] = time()
+        if dataStr == 'HEARTBEAT':
+            return
+        if dataStr == 'Stop' or dataStr == 'STOP':
+            if address in self.sessions:
+                self.stopSession(address, 'stop')
+        elif address not in self.sessions:
+            if dataStr.startswith('START:'):
+                dataStr = dataStr[6:]
+            self.startSession(address, dataStr)
+
+    def startSession(self, address, name):
+        """
+        Starts recording for a sender on the first free splitter port
+        """
+        busyPorts = set(session['splitter'] for session in self.sessions.values())
+        freePorts = [port for port in Camera2Daemon.SPLITTER_PORTS if port not in busyPorts]
+        if len(freePorts) == 0:
+            print ('No free splitter port to record "' + name + '" from ' + address)
+            return
+        videoPath = self.configDict.get(
+            'dataPath') + name + '.' + self.configDict.get('format', 'h264')
         try:
-            data, addr = sock.recvfrom(1024)
-            dataStr = data.decode("utf-8")
-            addStr = addr[0]
-            if addStr == configDict.get('UDP_Sender'):
-                if isCapturing == False:
-                    camera2.start_recording(configDict.get(
-                        'dataPath') + dataStr + '.' + configDict.get('format'))
-                    isCapturing = True
-                    print ('Capturing "' + dataStr + '"...', end=' ')
-                elif dataStr == 'Stop':
-                    camera2.stop_recording()
-                    isCapturing = False
-                    print ('Ending Capture...', end=' ')
-
-        except socket.error:
-            if isCapturing == True:
-                camera2.stop_recording()
-                isCapturing = False
+            self.camera2.start_recording(videoPath, splitter_port=freePorts[0])
+        except Exception as anError:
+            print ('Could not start recording "' + name + '":' + str(anError))
+            return
+        self.sessions[address] = {'name': name, 'path': videoPath, 'splitter': freePorts[0],
+                                  'startTime': time(), 'lastHeard': time()}
+        print ('Capturing "' + name + '" for ' + address + '...')
+
+    def stopSession(self, address, reason):
+        """
+        Stops recording for a sender
+        """
+        session = self.sessions.pop(address)
+        try:
+            self.camera2.stop_recording(splitter_port=session['splitter'])
+        except Exception as anError:
+            print ('Error stopping recording "' + session['name'] + '":' + str(anError))
+        print ('Ending Capture of "' + session['name'] + '" after {:.2f} secs ({:s})'.format(
+            time() - session['startTime'], reason))
+
+    def checkWatchdogs(self):
+        """
+        Stops any session whose sender has been silent for more than maxRecSecs
+        """
+        now = time()
+        for address in [address for address, session in self.sessions.items()
+                        if now >= session['lastHeard'] + self.maxRecSecs]:
+            self.stopSession(address, 'watchdog')
+
+    def status(self):
+        """
+        Returns a dictionary with recording sessions and disk use of dataPath, as sent in reply to STATUS
+        """
+        now = time()
+        sessions = [{'sender': address, 'name': session['name'], 'splitter': session['splitter'],
+                     'secs': round(now - session['startTime'], 2)} for address, session in self.sessions.items()]
+        try:
+            usage = shutil.disk_usage(self.configDict.get('dataPath'))
+            disk = {'total': usage.total, 'used': usage.used, 'free': usage.free}
+        except OSError:
+            disk = None
+        return {'sessions': sessions, 'disk': disk, 'upSecs': round(now - self.startTime, 2)}
 
 
 def showConfig(configDict, camera2):
@@ -103,6 +239,8 @@ def showConfig(configDict, camera2):
            str(configDict.get('UDP_IP')))
     print ('14:Maximum number of seconds to record video after getting a start signal, ' +
            str(configDict.get('maxRecSecs')))
+    print ('15:Multicast group the main task sends triggers to, or \'\' for triggers sent to this computer: ' +
+           str(configDict.get('UDP_Group', '')))
 
 
 def editConfig(configDict, camera2):
@@ -145,7 +283,68 @@ def editConfig(configDict, camera2):
             tempInput = input(
                 'Enter maximum number of seconds to record video:')
             configDict.update({'maxRecSecs': float(tempInput)})
+        elif selNum == 15:
+            tempInput = input(
+                'Enter multicast group, or nothing to receive triggers sent to this computer:')
+            configDict.update({'UDP_Group': tempInput})
+
+
+def loopbackTest():
+    """
+    Runs a Camera2Daemon against loopback senders, 127.0.0.2 to 127.0.0.4, with a recorder that prints instead of recording
+
+    Checks concurrent sessions, status queries, heartbeats keeping a session alive, and the watchdog stopping a silent session
+    """
+    class PrintRecorder:
+        # same signatures as AHF_Camera, checked against it below where picamera is installed
+        def start_recording(self, video_name_path, splitter_port=1):
+            print ('\tstart_recording', video_name_path, splitter_port)
+
+        def stop_recording(self, splitter_port=1):
+            print ('\tstop_recording', splitter_port)
+
+    try:
+        from AutoHeadFix.AHF_Camera import AHF_Camera
+        for method in ('start_recording', 'stop_recording'):
+            if inspect.signature(getattr(PrintRecorder, method)) != inspect.signature(getattr(AHF_Camera, method)):
+                print ('PrintRecorder.' + method + ' does not match AHF_Camera.' + method)
+                return
+    except ImportError:
+        print ('picamera is not installed, PrintRecorder is not checked against AHF_Camera')
+
+    configDict = {'dataPath': '/tmp/', 'format': 'h264', 'UDP_Sender': '127.0.0.2,127.0.0.3,127.0.0.4',
+                  'UDP_IP': '127.0.0.1', 'UDP_Port': 5017, 'maxRecSecs': 0.5}
+    sock = AHF_UDPTrig.make_listener(configDict.get('UDP_Port'), '', configDict.get('UDP_IP'))
+    daemon = Camera2Daemon(configDict, PrintRecorder(), sock)
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    senders = []
+    for i in range(3):
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.bind(('127.0.0.' + str(i + 2), 0))
+        senders.append(sender)
+    dest = ('127.0.0.1', configDict.get('UDP_Port'))
+    for i, sender in enumerate(senders):
+        sender.sendto(bytes('START:M' + str(i) + '_stim_0', 'utf-8'), dest)
+    sleep(0.1)
+    senders[0].sendto(b'STATUS', dest)
+    print ('status:', senders[0].recv(4096).decode('utf-8'))
+    for i in range(6):  # sender 0 keeps alive, sender 1 stops, sender 2 goes silent
+        senders[0].sendto(b'HEARTBEAT', dest)
+        if i == 1:
+            senders[1].sendto(b'Stop', dest)
+        sleep(0.15)
+    senders[0].sendto(b'STATUS', dest)
+    print ('status:', senders[0].recv(4096).decode('utf-8'))
+    senders[0].sendto(b'STOP', dest)
+    sleep(0.1)
+    daemon.quit()
+    thread.join()
 
 
 if __name__ == '__main__':
-    Camera2Run()
+    from sys import argv
+    if len(argv) > 1 and argv[1] == 'loopback':
+        loopbackTest()
+    else:
+        Camera2Run()
@@ -0,0 +1,244 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+"""
+Codes for events in headFix log files, as written by writeToLogFile in __main__ and by stimulator logfile methods.
+Any other event, e.g. a video file name, or stimulus description, gets code kOTHER
+"""
+kEVENTCODES = {'entry': 0, 'exit': 1, 'entryReward': 2, 'check+': 3, 'check-': 4,
+               'check No Fix Trial': 5, 'complete': 6, 'reward': 7, 'SeshStart': 8, 'SeshEnd': 9}
+kOTHER = -1
+kCACHEVERSION = 1
+kCOLUMNS = ('date', 'cage', 'tag', 'entries', 'entryRewards', 'headFixes', 'checkFails', 'noFixTrials',
+            'taskRewards', 'statsHFRewards', 'meanTrialSecs', 'medianTrialSecs')
+
+
+def findTextFiles(dataPath):
+    """
+    Walks the data folder, dataPath/<date>/<cageID>/TextFiles/, finding headFix and quickStats files
+
+    :returns: list of (date, cageID, headFix file path or None, quickStats file path or None), sorted by date and cage
+    """
+    found = {}
+    for dateStr in sorted(os.listdir(dataPath)):
+        datePath = os.path.join(dataPath, dateStr)
+        if not (dateStr.isdigit() and os.path.isdir(datePath)):
+            continue
+        for cageID in sorted(os.listdir(datePath)):
+            textPath = os.path.join(datePath, cageID, 'TextFiles')
+            if not os.path.isdir(textPath):
+                continue
+            logPath = os.path.join(textPath, 'headFix_' + cageID + '_' + dateStr + '.txt')
+            statsPath = os.path.join(textPath, 'quickStats_' + cageID + '_' + dateStr + '.txt')
+            found[(dateStr, cageID)] = (logPath if os.path.isfile(logPath) else None,
+                                        statsPath if os.path.isfile(statsPath) else None)
+    return [(dateStr, cageID) + paths for (dateStr, cageID), paths in sorted(found.items())]
+
+
+def parseLogFile(logPath):
+    """
+    Parses a headFix log file into arrays of tag, time and event code
+
+    Lines that can not be parsed, like a line cut short when the program stopped, are skipped
+    :returns: dictionary of numpy arrays, tags (int64), times (float64), codes (int8)
+    """
+    tags = []
+    times = []
+    codes = []
+    with open(logPath, 'r', errors='replace') as fp:
+        for line in fp:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 3:
+                continue
+            try:
+                tag = int(fields[0])
+                eventTime = float(fields[1])
+            except ValueError:
+                continue
+            tags.append(tag)
+            times.append(eventTime)
+            codes.append(kEVENTCODES.get(fields[2], kOTHER))
+    return {'tags': np.array(tags, dtype=np.int64), 'times': np.array(times, dtype=np.float64),
+            'codes': np.array(codes, dtype=np.int8)}
+
+
+def parseStatsFile(statsPath):
+    """
+    Parses a quickStats file into arrays of tag, entries, entrance rewards, head fixes, and head fix rewards
+
+    :returns: dictionary of numpy arrays, statsTags, and statsCounts with one row per mouse
+    """
+    rows = []
+    with open(statsPath, 'r', errors='replace') as fp:
+        fp.readline()  # header
+        for line in fp:
+            try:
+                rows.append([int(x) for x in line.split('\t')])
+            except ValueError:
+                continue
+    rows = [row for row in rows if len(row) == 5]
+    statsArray = np.array(rows, dtype=np.int64).reshape(-1, 5)
+    return {'statsTags': statsArray[:, 0].copy(), 'statsCounts': statsArray[:, 1:].copy()}
+
+
+def cachePathFor(cacheDir, filePath):
+    """
+    Returns the path of the cache file for a parsed text file
+    """
+    return os.path.join(cacheDir, hashlib.sha1(os.path.abspath(filePath).encode('utf-8')).hexdigest() + '.npz')
+
+
+def fileKey(filePath):
+    """
+    Returns an array identifying the version of a file, its size and modification time in ns, and the cache format version
+    """
+    fileStat = os.stat(filePath)
+    return np.array([fileStat.st_size, fileStat.st_mtime_ns, kCACHEVERSION], dtype=np.int64)
+
+
+def loadCached(cacheDir, filePath):
+    """
+    Returns the parsed arrays for a text file from the cache, or None if the cache is missing or the file has changed
+    """
+    try:
+        with np.load(cachePathFor(cacheDir, filePath)) as cached:
+            if np.array_equal(cached['key'], fileKey(filePath)):
+                return {name: cached[name] for name in cached.files if name != 'key'}
+    except (IOError, KeyError, ValueError):
+        pass
+    return None
+
+
+def parseAndCache(args):
+    """
+    Parses one text file and saves the arrays to the cache, run in a worker process
+
+    :param args: tuple of cache folder, file path, and True for a quickStats file or False for a headFix log file
+    :returns: the file path and the parsed arrays
+    """
+    cacheDir, filePath, isStats = args
+    key = fileKey(filePath)
+    parsed = parseStatsFile(filePath) if isStats else parseLogFile(filePath)
+    tempPath = cachePathFor(cacheDir, filePath) + '.tmp.npz'
+    np.savez(tempPath, key=key, **parsed)
+    os.replace(tempPath, cachePathFor(cacheDir, filePath))
+    return filePath, parsed
+
+
+def summarizeDay(dateStr, cageID, logArrays, statsArrays):
+    """
+    Makes per-mouse summary rows for one cage-day from parsed log and quickStats arrays
+
+    Trial duration is the time from check+ or check No Fix Trial to the next complete for the same mouse
+    :returns: list of tuples, with values in the order of kCOLUMNS
+    """
+    rows = []
+    tags = set()
+    if logArrays is not None:
+        tags.update(np.unique(logArrays['tags'][logArrays['codes'] != kEVENTCODES['SeshStart']]).tolist())
+    statsDict = {}
+    if statsArrays is not None:
+        statsDict = dict(zip(statsArrays['statsTags'].tolist(), statsArrays['statsCounts'].tolist()))
+        tags.update(statsDict.keys())
+    tags.discard(0)
+    for tag in sorted(tags):
+        counts = np.zeros(len(kEVENTCODES), dtype=np.int64)
+        durations = np.zeros(0)
+        if logArrays is not None:
+            isTag = logArrays['tags'] == tag
+            codes = logArrays['codes'][isTag]
+            times = logArrays['times'][isTag]
+            counts = np.bincount(codes[codes >= 0], minlength=len(kEVENTCODES))
+            startTimes = times[(codes == kEVENTCODES['check+']) | (codes == kEVENTCODES['check No Fix Trial'])]
+            completeTimes = times[codes == kEVENTCODES['complete']]
+            if len(startTimes) > 0 and len(completeTimes) > 0:
+                nextComplete = np.searchsorted(completeTimes, startTimes)
+                hasComplete = nextComplete < len(completeTimes)
+                durations = completeTimes[nextComplete[hasComplete]] - startTimes[hasComplete]
+                # a trial whose complete comes after the next trial started did not complete
+                if len(durations) > 1:
+                    nextStart = np.append(startTimes[hasComplete][1:], np.inf)
+                    durations = durations[completeTimes[nextComplete[hasComplete]] < nextStart]
+        stats = statsDict.get(tag)
+        rows.append((dateStr, cageID, tag, int(counts[kEVENTCODES['entry']]), int(counts[kEVENTCODES['entryReward']]),
+                     int(counts[kEVENTCODES['check+']]), int(counts[kEVENTCODES['check-']]),
+                     int(counts[kEVENTCODES['check No Fix Trial']]), int(counts[kEVENTCODES['reward']]),
+                     -1 if stats is None else int(stats[3]),
+                     float(np.mean(durations)) if len(durations) else float('nan'),
+                     float(np.median(durations)) if len(durations) else float('nan')))
+    return rows
+
+
+def analyze(dataPath, cacheDir=None, nWorkers=None, cageID=None, tag=None, fromDate=None, toDate=None):
+    """
+    Makes per-mouse, per-day summary rows for every cage-day in the data folder, re-parsing only files that changed
+
+    :param dataPath: base data folder, as in AHF_CageSet.dataPath
+    :param cacheDir: folder for cached arrays, default is .analyticsCache in dataPath
+    :param nWorkers: number of worker processes for parsing, default is the number of cpus
+    :param cageID, tag, fromDate, toDate: optional filters, dates as YYYYMMDD
+    :returns: list of row tuples in order of kCOLUMNS, and number of files parsed, and number loaded from cache
+    """
+    if cacheDir is None:
+        cacheDir = os.path.join(dataPath, '.analyticsCache')
+    os.makedirs(cacheDir, exist_ok=True)
+    cageDays = [cageDay for cageDay in findTextFiles(dataPath)
+                if (cageID is None or cageDay[1] == cageID) and (fromDate is None or cageDay[0] >= fromDate)
+                and (toDate is None or cageDay[0] <= toDate)]
+    parsedDict = {}
+    toParse = []
+    for dateStr, cage, logPath, statsPath in cageDays:
+        for filePath, isStats in ((logPath, False), (statsPath, True)):
+            if filePath is None:
+                continue
+            parsed = loadCached(cacheDir, filePath)
+            if parsed is None:
+                toParse.append((cacheDir, filePath, isStats))
+            else:
+                parsedDict[filePath] = parsed
+    if len(toParse) > 0:
+        with ProcessPoolExecutor(max_workers=nWorkers) as executor:
+            for filePath, parsed in executor.map(parseAndCache, toParse, chunksize=8):
+                parsedDict[filePath] = parsed
+    rows = []
+    for dateStr, cage, logPath, statsPath in cageDays:
+        for row in summarizeDay(dateStr, cage, parsedDict.get(logPath), parsedDict.get(statsPath)):
+            if tag is None or row[2] == tag:
+                rows.append(row)
+    return rows, len(toParse), len(parsedDict) - len(toParse)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Per-mouse, per-day summaries of AutoHeadFix headFix and quickStats files')
+    parser.add_argument('dataPath', help='base data folder, containing <date>/<cageID>/TextFiles/')
+    parser.add_argument('--cage', help='only this cage ID')
+    parser.add_argument('--mouse', type=int, help='only this mouse tag')
+    parser.add_argument('--from', dest='fromDate', help='first date, YYYYMMDD')
+    parser.add_argument('--to', dest='toDate', help='last date, YYYYMMDD')
+    parser.add_argument('--workers', type=int, help='number of parsing processes')
+    parser.add_argument('--cache', help='folder for cached arrays, default dataPath/.analyticsCache')
+    parser.add_argument('--out', help='write tab separated results to this file instead of the screen')
+    args = parser.parse_args()
+    from time import perf_counter
+    startTime = perf_counter()
+    rows, nParsed, nCached = analyze(args.dataPath, args.cache, args.workers, args.cage, args.mouse,
+                                     args.fromDate, args.toDate)
+    lines = ['\t'.join(kCOLUMNS)]
+    for row in rows:
+        lines.append('\t'.join('{:.2f}'.format(x) if isinstance(x, float) else str(x) for x in row))
+    if args.out is None:
+        print ('\n'.join(lines))
+    else:
+        with open(args.out, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+    print ('{:d} rows from {:d} files parsed and {:d} from cache in {:.2f} secs'.format(
+        len(rows), nParsed, nCached, perf_counter() - startTime), file=sys.stderr)
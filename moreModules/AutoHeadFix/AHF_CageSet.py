@@ -21,32 +21,62 @@ class AHF_CageSet (object):
        :ledPin: int - output pin for the Blue LED that illuminates the brain
        :serialPort: str - "/dev/ttyUSB0" for USB with sparkFun breakout or "/dev/ttyAMA0" for built-in
        :dataPath: str - path to base folder, possibly on removable media, where data will be saved in created subfolders
+       :eventDB: bool - if True, log events are also saved in an SQLite database, dataPath/events_<cageID>.db
+       :fleetHost: str - name or address of the computer running the fleet aggregator, or empty to not publish events
+       :metricsPort: int - port to serve live metrics on, in Prometheus text format, or 0 to not serve them
+       :stallSecs: float - time the main loop can go without running before it is reported as stalled, longer than any trial
+       :realTimeCPU: int - CPU the stimulus runs on in real-time mode, best one isolated with isolcpus=, or -1 for real-time mode off
+       :lickPin: int - connected to the lick sensor on the water spout, HIGH while the mouse licks, or 0 for no lick sensor
+       :contactOnSecs: float - time the head contacts must stay touched before a contact is seen, or 0 to not filter contacts
+       :contactOffSecs: float - time the head contacts must stay untouched before a contact is over, longer than contactOnSecs
+       :gpioTrace: bool - if True, every GPIO output and input edge is recorded, and saved with each trial next to its video
+       :loopbackPins: list of (output pin, input pin) jumpered together, timed by the self test, or empty for none
 
     The settings are saved between program runs in a json-styled text config file, AHFconfig.jsn, in a human readable and editable key=value form.
 """
 
-    def __init__(self):
+    def __init__(self, interactive=True):
         """
         Makes a new AHF_CageSet object by loading from AHFconfig.jsn or by querying the user
 
         Either reads a dictionary from a config file, AHFconfig.jsn, in the same directory in
         which the program is run, or if the file is not found, it querries the user for settings and then writes a new file.
-
+        :param interactive: set False when starting unattended, so a missing file raises an error instead of querying the user
+        :raises IOError: if not interactive and AHFconfig.jsn can not be read
+        :raises ValueError: if a setting in AHFconfig.jsn is missing or of the wrong type
         """
         try:
             with open('AHFconfig.jsn', 'r') as fp:
                 data = fp.read()
                 configDict = json.loads(data)
                 fp.close()
-                self.cageID = configDict.get('Cage ID')
-                self.pistonsPin = int(configDict.get('Pistons Pin'))
-                self.rewardPin = int(configDict.get('Reward Pin'))
-                self.tirPin = int(configDict.get('Tag In Range Pin'))
-                self.contactPin = int(configDict.get('Head Contact Pin'))
-                self.ledPin = int(configDict.get('LED Pin'))
-                self.serialPort = configDict.get('Serial Port')
-                self.dataPath = configDict.get('Path to Save Data')
+            try:
+                self.cageID = str(configDict['Cage ID'])
+                self.pistonsPin = int(configDict['Pistons Pin'])
+                self.rewardPin = int(configDict['Reward Pin'])
+                self.tirPin = int(configDict['Tag In Range Pin'])
+                self.contactPin = int(configDict['Head Contact Pin'])
+                self.ledPin = int(configDict['LED Pin'])
+                self.serialPort = str(configDict['Serial Port'])
+                self.dataPath = str(configDict['Path to Save Data'])
+                # optional, so config files made before it was added still load
+                self.eventDB = bool(configDict.get('Event Database', False))
+                self.fleetHost = str(configDict.get('Fleet Host', ''))
+                self.metricsPort = int(configDict.get('Metrics Port', 0))
+                self.stallSecs = float(configDict.get('Stall Secs', 120.0))
+                self.realTimeCPU = int(configDict.get('Real Time CPU', -1))
+                self.lickPin = int(configDict.get('Lick Pin', 0))
+                self.contactOnSecs = float(configDict.get('Contact On Secs', 0.0))
+                self.contactOffSecs = float(configDict.get('Contact Off Secs', 0.05))
+                self.gpioTrace = bool(configDict.get('GPIO Trace', False))
+                self.loopbackPins = [(int(outPin), int(inPin)) for outPin, inPin in configDict.get('Loopback Pins', [])]
+            except KeyError as anError:
+                raise ValueError('AHFconfig.jsn is missing ' + str(anError))
+            except (TypeError, ValueError) as anError:
+                raise ValueError('Bad value in AHFconfig.jsn: ' + str(anError))
         except IOError as e:
+            if not interactive:
+                raise e
             # we will make a file if we didn't find it
             print (
                 'Unable to open base confiuration file, AHFconfig.jsn, let\'s make a new one.\n')
@@ -65,6 +95,26 @@ class AHF_CageSet (object):
                 'Enter serial port for tag reader(likely either /dev/ttyAMA0 or /dev/ttyUSB0):')
             self.dataPath = input(
                 'Enter the path to the directory where the data will be saved:')
+            tempInput = input('Also save log events in an SQLite database (Y or N):')
+            self.eventDB = tempInput[:1] in ('y', 'Y')
+            self.fleetHost = input(
+                'Enter the address of the fleet aggregator to publish events to, or nothing to not publish:')
+            self.metricsPort = int(
+                input('Enter the port to serve live metrics on, e.g. 9100, or 0 to not serve metrics:'))
+            self.stallSecs = float(
+                input('Enter seconds the main loop can stop before it is reported as stalled, longer than any trial:'))
+            self.realTimeCPU = int(
+                input('Enter the CPU to run stimuli on in real-time mode, e.g. 3, or -1 for real-time mode off:'))
+            self.lickPin = int(
+                input('Enter the GPIO pin connected to the lick sensor, or 0 for no lick sensor:'))
+            self.contactOnSecs = float(
+                input('Enter seconds head contacts must be touched before a contact is seen, e.g. 0.02, or 0 to not filter:'))
+            self.contactOffSecs = float(
+                input('Enter seconds head contacts must be untouched before a contact is over, e.g. 0.05:'))
+            tempInput = input('Record a trace of GPIO pins for each trial (Y or N):')
+            self.gpioTrace = tempInput[:1] in ('y', 'Y')
+            self.loopbackPins = self.pinPairs(
+                input('Enter output:input pairs of GPIO pins jumpered together for the self test, e.g. 17:27,22:10, or nothing for none:'))
             self.show()
             doSave = input(
                 'Enter \'e\' to re-edit the new Cage settings, or any other character to save the new settings to a file.')
@@ -74,6 +124,18 @@ class AHF_CageSet (object):
                 self.save()
         return
 
+    @staticmethod
+    def pinPairs(pairStr):
+        """
+        Returns a list of (output pin, input pin) from a string of output:input pairs separated by commas, e.g. 17:27,22:10
+        """
+        pairs = []
+        for pairItem in pairStr.split(','):
+            if pairItem.strip() != '':
+                outPin, inPin = pairItem.split(':')
+                pairs.append((int(outPin), int(inPin)))
+        return pairs
+
     def save(self):
         """
         Saves current configuration stored in this AHF_CageSet object into the file ./AHFconfig.jsn
@@ -88,7 +150,12 @@ class AHF_CageSet (object):
         jsonDict.update({'Tag In Range Pin': self.tirPin,
                          'Head Contact Pin':  self.contactPin, 'LED Pin': self.ledPin})
         jsonDict.update({'Serial Port': self.serialPort,
-                         'Path to Save Data': self.dataPath})
+                         'Path to Save Data': self.dataPath, 'Event Database': self.eventDB,
+                         'Fleet Host': self.fleetHost, 'Metrics Port': self.metricsPort,
+                         'Stall Secs': self.stallSecs, 'Real Time CPU': self.realTimeCPU,
+                         'Lick Pin': self.lickPin, 'Contact On Secs': self.contactOnSecs,
+                         'Contact Off Secs': self.contactOffSecs, 'GPIO Trace': self.gpioTrace,
+                         'Loopback Pins': self.loopbackPins})
         with open('AHFconfig.jsn', 'w') as fp:
             fp.write(json.dumps(jsonDict))
             fp.close()
@@ -114,6 +181,16 @@ class AHF_CageSet (object):
         print ('6:Brain LED Illumination Pin=' + str(self.ledPin))
         print ('7:Tag Reader serialPort=' + self.serialPort)
         print ('8:dataPath=' + self.dataPath)
+        print ('9:Save events in database=' + str(self.eventDB))
+        print ('10:Fleet aggregator host=' + self.fleetHost)
+        print ('11:Metrics port=' + str(self.metricsPort))
+        print ('12:Main loop stall secs=' + str(self.stallSecs))
+        print ('13:Real-time mode CPU=' + str(self.realTimeCPU))
+        print ('14:Lick Sensor Pin=' + str(self.lickPin))
+        print ('15:Contact filter on secs=' + str(self.contactOnSecs))
+        print ('16:Contact filter off secs=' + str(self.contactOffSecs))
+        print ('17:Record GPIO trace=' + str(self.gpioTrace))
+        print ('18:Self test loopback pins=' + ','.join('{:d}:{:d}'.format(outPin, inPin) for outPin, inPin in self.loopbackPins))
         print (
             '**************************************************************************************')
 
@@ -150,6 +227,36 @@ class AHF_CageSet (object):
             elif editNum == 8:
                 self.dataPath = input(
                     'Enter the path to the directory where the data will be saved:')
+            elif editNum == 9:
+                tempInput = input('Also save log events in an SQLite database (Y or N):')
+                self.eventDB = tempInput[:1] in ('y', 'Y')
+            elif editNum == 10:
+                self.fleetHost = input(
+                    'Enter the address of the fleet aggregator to publish events to, or nothing to not publish:')
+            elif editNum == 11:
+                self.metricsPort = int(
+                    input('Enter the port to serve live metrics on, e.g. 9100, or 0 to not serve metrics:'))
+            elif editNum == 12:
+                self.stallSecs = float(
+                    input('Enter seconds the main loop can stop before it is reported as stalled, longer than any trial:'))
+            elif editNum == 13:
+                self.realTimeCPU = int(
+                    input('Enter the CPU to run stimuli on in real-time mode, e.g. 3, or -1 for real-time mode off:'))
+            elif editNum == 14:
+                self.lickPin = int(
+                    input('Enter the GPIO pin connected to the lick sensor, or 0 for no lick sensor:'))
+            elif editNum == 15:
+                self.contactOnSecs = float(
+                    input('Enter seconds head contacts must be touched before a contact is seen, e.g. 0.02, or 0 to not filter:'))
+            elif editNum == 16:
+                self.contactOffSecs = float(
+                    input('Enter seconds head contacts must be untouched before a contact is over, e.g. 0.05:'))
+            elif editNum == 17:
+                tempInput = input('Record a trace of GPIO pins for each trial (Y or N):')
+                self.gpioTrace = tempInput[:1] in ('y', 'Y')
+            elif editNum == 18:
+                self.loopbackPins = self.pinPairs(
+                    input('Enter output:input pairs of GPIO pins jumpered together for the self test, e.g. 17:27,22:10, or nothing for none:'))
             else:
                 print ('I don\'t recognize that number ' + str(editNum))
         self.show()
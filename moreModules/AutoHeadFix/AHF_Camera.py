@@ -219,30 +219,35 @@ class AHF_Camera (PiCamera):
         print ("Digital Gain = " + str(float(self.digital_gain)))
         return
 
-    def start_recording(self, video_name_path):
+    def start_recording(self, video_name_path, splitter_port=1):
         """
         Starts a video recording using the saved settings for format, quality, gain, etc.
 
-        A preview of the recording is always shown
+        A preview of the recording is always shown, started with the first recording if several splitter ports are used
 
         :param video_name_path: a full path to the file where the video will be stored. Always save to a file, not a PIL, for, example
+        :param splitter_port: camera splitter port to record on, 1 to 3, so up to 3 recordings can run at once
         """
         if self.AHFvideoFormat == 'rgb':
-            super().start_recording(output=video_name_path, format=self.AHFvideoFormat)
+            super().start_recording(output=video_name_path, format=self.AHFvideoFormat, splitter_port=splitter_port)
         else:
-            super().start_recording(output=video_name_path,
-                                    format=self.AHFvideoFormat, quality=self.AHFvideoQuality)
-        super().start_preview(fullscreen=False, window=self.AHFpreview)
+            super().start_recording(output=video_name_path, format=self.AHFvideoFormat,
+                                    quality=self.AHFvideoQuality, splitter_port=splitter_port)
+        if self.preview is None:
+            super().start_preview(fullscreen=False, window=self.AHFpreview)
 
         return
 
-    def stop_recording(self):
+    def stop_recording(self, splitter_port=1):
         """
-        Stops a video recording previously started with start_recording.
+        Stops a video recording previously started with start_recording, and the preview when no recordings are left
+
+        :param splitter_port: camera splitter port of the recording to stop
         """
         if self.recording:
-            super().stop_recording()
-            super().stop_preview()
+            super().stop_recording(splitter_port=splitter_port)
+            if not self.recording:
+                super().stop_preview()
         return
 
     def timed_recording(self, video_name_path, recTime):
@@ -0,0 +1,328 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import threading
+from bisect import bisect_right
+from time import time
+from AHF_LazyImport import lazy_import
+GPIO = lazy_import('RPi.GPIO')
+
+"""
+Time the head contacts must stay touched before contact-on is reported. Bounces when the head bar first touches last
+a few ms, and a real touch lasts far longer, so 20 ms removes bounce without delaying trials noticeably
+"""
+kONSECS = 0.02
+"""
+Time the head contacts must stay untouched before contact-off is reported, longer than kONSECS, so a mouse wriggling
+against the contacts does not end a contact. The difference between the two is the hysteresis
+"""
+kOFFSECS = 0.05
+kMAXWAITSECS = 1.0  # longest the filter thread waits with nothing pending, so it can see when it is told to quit
+
+
+class AHF_ContactState (object):
+    """
+    Debounce and hysteresis state machine for the head contacts, fed raw edges, reporting clean contact-on and contact-off
+
+    A raw level different from the filtered level becomes the filtered level once it has lasted onSecs, for contact, or
+    offSecs, for no contact. The transition is reported with the time of the raw edge that started it, so times are of
+    when the contact really started or ended, though known onSecs or offSecs later. Raw edges that do not become a
+    transition are counted as bounces. Used by AHF_ContactFilter as the mouse moves, and by filterEdges on recorded edges.
+    """
+
+    def __init__(self, onSecs=kONSECS, offSecs=kOFFSECS, level=0):
+        self.onSecs = onSecs
+        self.offSecs = offSecs
+        self.level = level  # filtered level
+        self.rawLevel = level
+        self.rawTime = 0.0
+        self.nRawEdges = 0
+        self.nTransitions = 0
+
+    def feed(self, edgeTime, level):
+        """
+        Feeds a raw edge, which may complete a pending transition, if it came after the pending transition was due
+
+        :returns: list of (time, level) of transitions completed, empty or with one transition
+        """
+        transitions = self.poll(edgeTime)
+        if level != self.rawLevel:
+            self.rawLevel = level
+            self.rawTime = edgeTime
+            self.nRawEdges += 1
+        return transitions
+
+    def poll(self, now):
+        """
+        :returns: list of (time, level) of transitions completed by now, empty or with one transition
+        """
+        if self.rawLevel != self.level and now - self.rawTime >= (self.onSecs if self.rawLevel else self.offSecs):
+            self.level = self.rawLevel
+            self.nTransitions += 1
+            return [(self.rawTime, self.level)]
+        return []
+
+    def nextDue(self):
+        """
+        :returns: time the pending transition will be complete if the raw level does not change, or None if none is pending
+        """
+        if self.rawLevel == self.level:
+            return None
+        return self.rawTime + (self.onSecs if self.rawLevel else self.offSecs)
+
+    def nBounces(self):
+        return self.nRawEdges - self.nTransitions
+
+
+def filterEdges(edges, onSecs=kONSECS, offSecs=kOFFSECS, level=0):
+    """
+    Filters recorded raw edges of a contact pin, as AHF_ContactFilter would have as they happened
+
+    :param edges: list of (time, level) of raw edges, in time order
+    :returns: (list of (time, level) of filtered transitions, number of bounces)
+    """
+    state = AHF_ContactState(onSecs, offSecs, level)
+    transitions = []
+    for edgeTime, edgeLevel in edges:
+        transitions.extend(state.feed(edgeTime, edgeLevel))
+    transitions.extend(state.poll(float('inf')))
+    return transitions, state.nBounces()
+
+
+class AHF_ContactFilter (object):
+    """
+    Filters the head contact pin from a background thread, so the main loop sees clean contact-on and contact-off
+
+    Raw edges are captured with GPIO edge detection and fed to an AHF_ContactState, and a thread completes transitions
+    when they come due. The main loop waits for contact with waitForContact and for release with waitForRelease, instead
+    of waiting for edges on the pin itself, and checks isContact instead of reading the pin. Subscribers, like closed
+    loop stimulators, are called with (time, level) for each transition. Bounces, contacts, and time in contact are kept
+    for the mouse set with setMouse, for contact quality statistics.
+    """
+
+    def __init__(self, contactPin, onSecs=kONSECS, offSecs=kOFFSECS):
+        """
+        Makes a new contact filter and starts its thread
+
+        :param contactPin: GPIO pin connected to the head contacts, HIGH when touched
+        :param onSecs: time the contacts must stay touched before contact-on
+        :param offSecs: time the contacts must stay untouched before contact-off
+        """
+        self.contactPin = contactPin
+        self.state = AHF_ContactState(onSecs, offSecs, GPIO.input(contactPin))
+        self.condition = threading.Condition()
+        self.contactEvent = threading.Event()
+        self.releaseEvent = threading.Event()
+        self.setEvents(self.state.level)
+        self.subscribers = []
+        self.tag = None
+        self.statsDict = {}  # tag: [contacts, bounces, secs in contact]
+        self.contactTime = 0.0
+        self.lastBounces = 0
+        self.isRunning = True
+        self.isPaused = False
+        GPIO.add_event_detect(contactPin, GPIO.BOTH, callback=self.edge)
+        self.thread = threading.Thread(target=self.filterLoop, daemon=True)
+        self.thread.start()
+
+    def setEvents(self, level):
+        if level:
+            self.releaseEvent.clear()
+            self.contactEvent.set()
+        else:
+            self.contactEvent.clear()
+            self.releaseEvent.set()
+
+    def edge(self, channel):
+        """
+        Called from the GPIO library's thread on each raw edge
+        """
+        with self.condition:
+            self.handle(self.state.feed(time(), GPIO.input(self.contactPin)))
+            self.condition.notify()
+
+    def filterLoop(self):
+        """
+        Run by the filter thread, completes pending transitions when they come due
+        """
+        with self.condition:
+            while self.isRunning:
+                due = self.state.nextDue()
+                waitSecs = kMAXWAITSECS if due is None else min(kMAXWAITSECS, max(0.0, due - time()))
+                self.condition.wait(waitSecs)
+                self.handle(self.state.poll(time()))
+
+    def handle(self, transitions):
+        """
+        Updates events and statistics and calls subscribers for completed transitions, called holding the condition
+        """
+        for transitionTime, level in transitions:
+            self.setEvents(level)
+            stats = self.statsDict.get(self.tag)
+            if stats is not None:
+                if level:
+                    stats[0] += 1
+                    self.contactTime = transitionTime
+                elif self.contactTime > 0:
+                    stats[2] += transitionTime - self.contactTime
+                    self.contactTime = 0.0
+            for callback in self.subscribers:
+                callback(transitionTime, level)
+
+    @property
+    def isContact(self):
+        return self.contactEvent.is_set()
+
+    def waitForContact(self, timeoutSecs):
+        """
+        :returns: True if there is contact now or there was contact-on before timeoutSecs, else False
+        """
+        return self.contactEvent.wait(timeoutSecs)
+
+    def waitForRelease(self, timeoutSecs):
+        """
+        :returns: True if there is no contact now or there was contact-off before timeoutSecs, else False
+        """
+        return self.releaseEvent.wait(timeoutSecs)
+
+    def subscribe(self, callback):
+        with self.condition:
+            self.subscribers = self.subscribers + [callback]
+
+    def unsubscribe(self, callback):
+        with self.condition:
+            self.subscribers = [x for x in self.subscribers if x != callback]
+
+    def setMouse(self, tag):
+        """
+        Starts keeping contact statistics for a mouse, or stops with None, as a mouse enters or leaves the chamber
+        """
+        with self.condition:
+            if self.tag is not None:
+                stats = self.statsDict[self.tag]
+                stats[1] += self.state.nBounces() - self.lastBounces
+            self.tag = tag
+            self.lastBounces = self.state.nBounces()
+            self.contactTime = 0.0
+            if tag is not None:
+                self.statsDict.setdefault(tag, [0, 0, 0.0])
+
+    def statsStr(self, tag):
+        """
+        Returns contact statistics for a mouse as a short string: contacts, bounces, bounces per contact, and mean
+        contact length. Quality is the fraction of raw edges that were clean, 1.0 when contacts did not bounce
+        """
+        contacts, bounces, contactSecs = self.statsDict.get(tag, [0, 0, 0.0])
+        quality = 2 * contacts / (2 * contacts + bounces) if contacts + bounces > 0 else 1.0
+        return 'contacts n={:d} bounces={:d} quality={:.2f} meanSecs={:.2f}'.format(
+            contacts, bounces, quality, contactSecs / contacts if contacts > 0 else 0.0)
+
+    def pause(self):
+        """
+        Stops capturing edges, so other code can wait for edges on the pin, e.g., the hardware tester
+        """
+        if not self.isPaused:
+            GPIO.remove_event_detect(self.contactPin)
+            self.isPaused = True
+
+    def resume(self):
+        if self.isPaused:
+            with self.condition:
+                self.handle(self.state.feed(time(), GPIO.input(self.contactPin)))
+            GPIO.add_event_detect(self.contactPin, GPIO.BOTH, callback=self.edge)
+            self.isPaused = False
+
+    def quit(self):
+        self.pause()
+        with self.condition:
+            self.isRunning = False
+            self.condition.notify()
+
+
+def addBounces(edges, nBounces, bounceSecs, nSpurious, rng):
+    """
+    Adds contact bounce to clean edges: nBounces short pulses within bounceSecs after each edge, and nSpurious brushes of
+    the contacts, 1 to 10 ms long, between each pair of contacts
+
+    :param edges: list of (time, level) of clean edges, in time order
+    :returns: list of (time, level) of edges with bounce, in time order
+    """
+    bouncy = []
+    for i, (edgeTime, level) in enumerate(edges):
+        bouncy.append((edgeTime, level))
+        times = sorted(edgeTime + rng.random() * bounceSecs for j in range(2 * nBounces))
+        for j, bounceTime in enumerate(times):
+            bouncy.append((bounceTime, 1 - level if j % 2 == 0 else level))
+        if level == 0 and i + 1 < len(edges):
+            for j in range(nSpurious):
+                brushTime = edgeTime + bounceSecs + rng.random() * (edges[i + 1][0] - edgeTime - 2 * bounceSecs)
+                bouncy.append((brushTime, 1))
+                bouncy.append((brushTime + 1e-03 + rng.random() * 9e-03, 0))
+    bouncy.sort()
+    return bouncy
+
+
+def falseTrials(transitions, settleSecs):
+    """
+    Counts trials the main loop would start on contact-on, and those that would fail the contact check settleSecs later
+
+    A trial starts on a contact-on, and if there is no contact settleSecs later it is a check- trial, a wasted piston
+    cycle, and the next contact-on can start a trial. If there is contact, the next trial waits for the contacts to be
+    let go of after the check.
+    :param transitions: list of (time, level) in time order
+    :returns: (trials, check- trials)
+    """
+    times = [transitionTime for transitionTime, level in transitions]
+    nTrials = 0
+    nFalse = 0
+    nextAllowed = float('-inf')
+    for i, (transitionTime, level) in enumerate(transitions):
+        if not level or transitionTime < nextAllowed:
+            continue
+        nTrials += 1
+        checkTime = transitionTime + settleSecs
+        iCheck = bisect_right(times, checkTime) - 1
+        if transitions[iCheck][1] == 0:
+            nFalse += 1
+            nextAllowed = checkTime
+        else:
+            nextAllowed = next((t for t, x in transitions[iCheck + 1:] if x == 0), float('inf'))
+    return nTrials, nFalse
+
+
+# compares trials started, and false trials, on the raw and filtered head contact edges of a replayed log, with bounce added
+if __name__ == '__main__':
+    import random
+    import argparse
+    import AHF_Replay
+    parser = argparse.ArgumentParser(description='False trial rates with and without contact filtering')
+    parser.add_argument('log', help='headFix log file to replay, or test to make one up')
+    parser.add_argument('--bounces', type=int, default=3, help='bounce pulses after each real edge')
+    parser.add_argument('--bounceSecs', type=float, default=5e-03, help='time after each real edge bounces happen in')
+    parser.add_argument('--spurious', type=int, default=1, help='brushes of the contacts between each real contact')
+    parser.add_argument('--on', type=float, default=kONSECS, help='contact-on filter time')
+    parser.add_argument('--off', type=float, default=kOFFSECS, help='contact-off filter time')
+    args = parser.parse_args()
+    if args.log == 'test':
+        args.log = 'contactFilterTest.txt'
+        AHF_Replay.makeTestLog(args.log)
+    edges, tags, trials = AHF_Replay.makeScript(AHF_Replay.readLog(args.log))
+    contactPin = AHF_Replay.kCAGEDICT['Head Contact Pin']
+    clean = [(edgeTime, level) for edgeTime, pin, level in edges if pin == contactPin]
+    raw = addBounces(clean, args.bounces, args.bounceSecs, args.spurious, random.Random(1))
+    filtered, nBounces = filterEdges(raw, args.on, args.off)
+    print ('{:d} real contacts, {:d} raw edges with bounce added, {:d} bounces removed by the filter'.format(
+        len(clean) // 2, len(raw), nBounces))
+    print ('{:<10}{:>10}{:>14}{:>12}'.format('', 'trials', 'false trials', 'false rate'))
+    for name, transitions in (('clean', clean), ('raw', raw), ('filtered', filtered)):
+        nOn, nFalse = falseTrials(transitions, AHF_Replay.kSETTLESECS)
+        print ('{:<10}{:>10d}{:>14d}{:>12.3f}'.format(name, nOn, nFalse, nFalse / nOn if nOn > 0 else 0.0))
+    # the times of real edges are kept, each is matched to the nearest filtered transition
+    filteredTimes = [transitionTime for transitionTime, level in filtered]
+    errors = []
+    for edgeTime, level in clean:
+        i = bisect_right(filteredTimes, edgeTime)
+        errors.append(min(abs(edgeTime - filteredTimes[j]) for j in (i - 1, i) if 0 <= j < len(filteredTimes)))
+    errors.sort()
+    print ('filtered edge time error: median {:.2f} ms, 99% {:.2f} ms'.format(
+        errors[len(errors) // 2] * 1e03, errors[int(len(errors) * 0.99)] * 1e03))
@@ -0,0 +1,236 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import os
+import queue
+import sqlite3
+import threading
+from datetime import datetime
+
+
+class AHF_EventStore (object):
+    """
+    SQLite database of log events, tag, time and event, kept alongside the daily text log files
+
+    Events are queued and written by a writer thread, all events waiting in the queue in one transaction, so logging never
+    waits on the disk. The database is in WAL mode, so queries from other programs do not block the writer. Indexes on
+    (tag, time) and (event, time) make questions like entries per hour for a mouse over a week a single indexed query.
+    """
+
+    def __init__(self, dbPath, maxBatch=1000):
+        """
+        Makes a new event store, creating the database file, table and indexes if needed, and starts the writer thread
+
+        :param dbPath: path to the SQLite database file, e.g. dataPath + 'events_' + cageID + '.db'
+        :param maxBatch: most events written in one transaction
+        """
+        self.dbPath = dbPath
+        self.maxBatch = maxBatch
+        AHF_EventStore.connect(dbPath).close()
+        self.queue = queue.Queue()
+        self.nWritten = 0
+        self.thread = threading.Thread(target=self.writeLoop, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def connect(dbPath):
+        """
+        Opens the database in WAL mode, making the events table and its indexes if they do not exist
+        """
+        db = sqlite3.connect(dbPath, timeout=10.0)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS events (tag INTEGER, time REAL, event TEXT)')
+        db.execute('CREATE INDEX IF NOT EXISTS events_tag ON events (tag, time)')
+        db.execute('CREATE INDEX IF NOT EXISTS events_event ON events (event, time)')
+        db.commit()
+        return db
+
+    def addEvent(self, tag, eventTime, event):
+        """
+        Queues an event to be written to the database, returning without waiting
+
+        :param tag: RFID tag of the mouse, 0 for events not about a mouse, like SeshStart
+        :param eventTime: time of the event, seconds since the epoch
+        :param event: the event, as written in the log file, entry, exit, reward, etc.
+        """
+        self.queue.put((tag, eventTime, event))
+
+    def addLine(self, line):
+        """
+        Queues an event from a log file line, tag, time and event separated by tabs, ignoring lines in any other format
+        """
+        fields = line.split('\t', 2)
+        if len(fields) == 3:
+            try:
+                self.queue.put((int(fields[0]), float(fields[1]), fields[2]))
+            except ValueError:
+                pass
+
+    def writeLoop(self):
+        """
+        Run by the writer thread, writes queued events to the database, up to maxBatch events in each transaction
+        """
+        db = AHF_EventStore.connect(self.dbPath)
+        isRunning = True
+        while isRunning:
+            events = [self.queue.get()]
+            while len(events) < self.maxBatch:
+                try:
+                    events.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in events:
+                isRunning = False
+                events = [anEvent for anEvent in events if anEvent is not None]
+            try:
+                db.executemany('INSERT INTO events VALUES (?,?,?)', events)
+                db.commit()
+                self.nWritten += len(events)
+            except sqlite3.Error as anError:
+                print ('AHF_EventStore could not write events: ' + str(anError))
+        db.close()
+
+    def quit(self, waitSecs=10.0):
+        """
+        Writes any queued events and stops the writer thread
+
+        :param waitSecs: longest time to wait for queued events to be written, None to wait till they are all written
+        """
+        self.queue.put(None)
+        self.thread.join(waitSecs)
+
+    @staticmethod
+    def events(dbPath, tag=None, event=None, fromTime=None, toTime=None):
+        """
+        Returns events matching all the given conditions, as a list of (tag, time, event) ordered by time
+
+        :param tag: only events for this mouse
+        :param event: only events of this kind, e.g. entry
+        :param fromTime, toTime: only events in this range of times, seconds since the epoch
+        """
+        sql, values = AHF_EventStore.where(tag, event, fromTime, toTime)
+        db = AHF_EventStore.connect(dbPath)
+        try:
+            return db.execute('SELECT tag, time, event FROM events' + sql + ' ORDER BY time', values).fetchall()
+        finally:
+            db.close()
+
+    @staticmethod
+    def countByHour(dbPath, tag=None, event='entry', fromTime=None, toTime=None):
+        """
+        Returns counts of matching events in each hour, as a list of (hour start time, count), leaving out empty hours
+        """
+        sql, values = AHF_EventStore.where(tag, event, fromTime, toTime)
+        db = AHF_EventStore.connect(dbPath)
+        try:
+            return db.execute('SELECT CAST(time / 3600 AS INTEGER) * 3600, COUNT(*) FROM events' + sql +
+                              ' GROUP BY 1 ORDER BY 1', values).fetchall()
+        finally:
+            db.close()
+
+    @staticmethod
+    def where(tag, event, fromTime, toTime):
+        """
+        Returns the WHERE clause and its values for queries, conditions on tag, event and time range
+        """
+        conditions = []
+        values = []
+        for condition, value in (('tag = ?', tag), ('event = ?', event), ('time >= ?', fromTime), ('time < ?', toTime)):
+            if value is not None:
+                conditions.append(condition)
+                values.append(value)
+        if len(conditions) == 0:
+            return '', values
+        return ' WHERE ' + ' AND '.join(conditions), values
+
+
+class AHF_EventTee (object):
+    """
+    File-like wrapper for a text log file that also sends each line written to an AHF_EventStore
+
+    makeLogFile puts this in expSettings.logFP when the event database is enabled, so writeToLogFile and the
+    stimulator logfile methods write to both the text file and the database without any changes
+    """
+
+    def __init__(self, fp, eventStore):
+        """
+        :param fp: the open text log file
+        :param eventStore: the AHF_EventStore that lines written are also sent to
+        """
+        self.fp = fp
+        self.eventStore = eventStore
+        self.partLine = ''
+
+    def write(self, text):
+        self.fp.write(text)
+        lines = (self.partLine + text).split('\n')
+        self.partLine = lines.pop()
+        for line in lines:
+            self.eventStore.addLine(line)
+        return len(text)
+
+    def flush(self):
+        self.fp.flush()
+
+    @property
+    def closed(self):
+        return self.fp.closed
+
+    def close(self):
+        """
+        Closes the log file, the event store is left open for the next day's log file
+        """
+        if self.partLine != '':
+            self.eventStore.addLine(self.partLine)
+            self.partLine = ''
+        self.fp.close()
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    from time import time, perf_counter
+    parser = argparse.ArgumentParser(description='Query an AutoHeadFix event database, or benchmark one')
+    parser.add_argument('dbPath', help='event database, dataPath/events_<cageID>.db')
+    parser.add_argument('--mouse', type=int, help='tag of the mouse')
+    parser.add_argument('--event', help='kind of event, e.g. entry')
+    parser.add_argument('--days', type=float, default=7, help='number of days back from now')
+    parser.add_argument('--hourly', action='store_true', help='count events per hour instead of listing them')
+    parser.add_argument('--bench', action='store_true', help='fill a new database with a year of made up events, and time it')
+    args = parser.parse_args()
+    if args.bench:
+        # a year of a cage of 10 mice, each entering 100 times a day, each entry with about 10 events
+        if os.path.exists(args.dbPath):
+            print ('Benchmark needs a new database, ' + args.dbPath + ' exists')
+            sys.exit(1)
+        nEvents = 365 * 10 * 100 * 10
+        kinds = ('entry', 'check+', 'reward', 'reward', 'reward', 'reward', 'reward', 'complete', 'entryReward', 'exit')
+        yearStart = time() - 365 * 86400
+        eventStore = AHF_EventStore(args.dbPath)
+        tee = AHF_EventTee(open(os.devnull, 'w'), eventStore)
+        startTime = perf_counter()
+        for i in range(nEvents):
+            tee.write('{:013}\t{:.2f}\t{:s}\n'.format(1000 + (i // 10) % 10, yearStart + i * 8.64, kinds[i % 10]))
+        queuedSecs = perf_counter() - startTime
+        eventStore.quit(None)
+        writtenSecs = perf_counter() - startTime
+        print ('{:d} events, queued at {:.0f} per sec, written at {:.0f} per sec'.format(
+            eventStore.nWritten, nEvents / queuedSecs, nEvents / writtenSecs))
+        for name, query in (('entries per hour for a mouse, last week', lambda: AHF_EventStore.countByHour(
+                                 args.dbPath, 1003, 'entry', time() - 7 * 86400, time())),
+                            ('all events for a mouse, one day', lambda: AHF_EventStore.events(
+                                 args.dbPath, 1003, None, time() - 86400 * 100, time() - 86400 * 99)),
+                            ('head fixes of all mice, last month', lambda: AHF_EventStore.events(
+                                 args.dbPath, None, 'check+', time() - 30 * 86400, time()))):
+            startTime = perf_counter()
+            nRows = len(query())
+            print ('{:s}: {:d} rows in {:.2f} ms'.format(name, nRows, (perf_counter() - startTime) * 1e03))
+        sys.exit(0)
+    fromTime = time() - args.days * 86400
+    if args.hourly:
+        for hourStart, count in AHF_EventStore.countByHour(args.dbPath, args.mouse, args.event or 'entry', fromTime):
+            print (datetime.fromtimestamp(hourStart).isoformat(' ') + '\t' + str(count))
+    else:
+        for tag, eventTime, event in AHF_EventStore.events(args.dbPath, args.mouse, args.event, fromTime):
+            print ('{:013}\t{:s}\t{:s}'.format(tag, datetime.fromtimestamp(int(eventTime)).isoformat(' '), event))
@@ -0,0 +1,374 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import os
+import sys
+import json
+import queue
+import socket
+import sqlite3
+import selectors
+import threading
+from time import time, sleep
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+"""
+Port the aggregator listens on for event batches from cages, and port for its HTTP summaries
+"""
+kFLEETPORT = 5010
+kHTTPPORT = 8010
+
+
+class AHF_FleetPublisher (object):
+    """
+    Sends a cage's log events to a fleet aggregator over TCP, in batches, from its own thread
+
+    Each batch is one line of JSON, {"cage": cageID, "events": [[tag, time, event], ...]}. Events are queued in a bounded
+    queue, so if the aggregator is slow or down the queue fills and new events are dropped and counted, instead of the
+    main loop waiting on the network. Has the same addEvent and addLine methods as AHF_EventStore, so an AHF_EventTee can
+    feed it from the log file.
+    """
+
+    def __init__(self, cageID, host, port=kFLEETPORT, maxQueue=10000, batchSecs=0.5, maxBatch=500):
+        """
+        Makes a new publisher and starts its thread, which connects to the aggregator, and re-connects if needed
+
+        :param cageID: name of this cage, as in AHF_CageSet.cageID
+        :param host: name or address of the computer running the aggregator
+        :param port: port the aggregator listens on
+        :param maxQueue: most events waiting to be sent, events are dropped when it is full
+        :param batchSecs: longest time an event waits before its batch is sent
+        :param maxBatch: most events sent in one batch
+        """
+        self.cageID = cageID
+        self.address = (host, port)
+        self.batchSecs = batchSecs
+        self.maxBatch = maxBatch
+        self.queue = queue.Queue(maxsize=maxQueue)
+        self.sock = None
+        self.nSent = 0
+        self.nDropped = 0
+        self.isRunning = True
+        self.thread = threading.Thread(target=self.sendLoop, daemon=True)
+        self.thread.start()
+
+    def addEvent(self, tag, eventTime, event):
+        """
+        Queues an event to be sent, or drops it and counts it if the queue is full, returning without waiting
+        """
+        try:
+            self.queue.put_nowait((tag, eventTime, event))
+        except queue.Full:
+            self.nDropped += 1
+
+    def addLine(self, line):
+        """
+        Queues an event from a log file line, tag, time and event separated by tabs, ignoring lines in any other format
+        """
+        fields = line.split('\t', 2)
+        if len(fields) == 3:
+            try:
+                self.addEvent(int(fields[0]), float(fields[1]), fields[2])
+            except ValueError:
+                pass
+
+    def sendLoop(self):
+        """
+        Run by the publisher thread, collects events into batches and sends them, waiting and re-connecting on errors
+
+        A batch that could not be sent is kept and sent after re-connecting, so events are only lost when the queue is full
+        """
+        batch = []
+        retrySecs = 1.0
+        while self.isRunning or not self.queue.empty() or len(batch) > 0:
+            if len(batch) == 0:
+                try:
+                    batch.append(self.queue.get(timeout=self.batchSecs))
+                except queue.Empty:
+                    continue
+                endTime = time() + self.batchSecs
+                while len(batch) < self.maxBatch:
+                    try:
+                        batch.append(self.queue.get(timeout=max(0, endTime - time())))
+                    except queue.Empty:
+                        break
+            try:
+                if self.sock is None:
+                    self.sock = socket.create_connection(self.address, timeout=10.0)
+                self.sock.sendall((json.dumps({'cage': self.cageID, 'events': batch}) + '\n').encode('utf-8'))
+                self.nSent += len(batch)
+                batch = []
+                retrySecs = 1.0
+            except OSError as anError:
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+                if not self.isRunning:
+                    break
+                print ('AHF_FleetPublisher could not send to ' + str(self.address) + ': ' + str(anError))
+                sleep(retrySecs)
+                retrySecs = min(retrySecs * 2, 60.0)
+        if self.sock is not None:
+            self.sock.close()
+
+    def quit(self, waitSecs=5.0):
+        """
+        Sends queued events, waiting at most waitSecs, and stops the publisher thread
+        """
+        self.isRunning = False
+        self.thread.join(waitSecs)
+
+
+class AHF_FleetAggregator (object):
+    """
+    Receives event batches from many cages and stores them in one SQLite database, indexed by cage and by mouse
+
+    One thread runs a selectors loop over all cage connections, so hundreds of cages need no thread each, and writes
+    all the batches received in one pass of the loop in a single transaction. Another thread serves summaries as JSON
+    over HTTP, /cages for all cages, /cage?cage=ID for the mice of one cage, and /mouse?tag=TAG for one mouse, each
+    counting events over the last hours=24 hours.
+    """
+
+    def __init__(self, dbPath, port=kFLEETPORT, httpPort=kHTTPPORT):
+        """
+        Makes a new aggregator, listening for cages on port and for HTTP requests on httpPort
+
+        :param dbPath: path to the SQLite database file
+        """
+        self.dbPath = dbPath
+        self.db = AHF_FleetAggregator.connect(dbPath)
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('', port))
+        self.listener.listen(128)
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, None)
+        self.buffers = {}  # socket: bytes received after the last complete line
+        self.nReceived = 0
+        self.nBadLines = 0
+        self.isRunning = True
+        aggregator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                try:
+                    hours = float(query.get('hours', ['24'])[0])
+                    if url.path == '/cages':
+                        result = aggregator.cageSummary(hours)
+                    elif url.path == '/cage':
+                        result = aggregator.miceSummary(query['cage'][0], hours)
+                    elif url.path == '/mouse':
+                        result = aggregator.mouseSummary(int(query['tag'][0]), hours)
+                    elif url.path == '/stats':
+                        result = {'received': aggregator.nReceived, 'badLines': aggregator.nBadLines,
+                                  'connections': len(aggregator.buffers)}
+                    else:
+                        self.send_error(404)
+                        return
+                except (KeyError, ValueError) as anError:
+                    self.send_error(400, str(anError))
+                    return
+                body = json.dumps(result).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpServer = ThreadingHTTPServer(('', httpPort), Handler)
+        self.httpThread = threading.Thread(target=self.httpServer.serve_forever, daemon=True)
+        self.httpThread.start()
+
+    @staticmethod
+    def connect(dbPath):
+        """
+        Opens the database in WAL mode, making the events table and its indexes if they do not exist
+        """
+        db = sqlite3.connect(dbPath, timeout=10.0, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS events (cage TEXT, tag INTEGER, time REAL, event TEXT)')
+        db.execute('CREATE INDEX IF NOT EXISTS events_cage ON events (cage, time)')
+        db.execute('CREATE INDEX IF NOT EXISTS events_tag ON events (tag, time)')
+        db.execute('CREATE INDEX IF NOT EXISTS events_time ON events (time)')
+        db.commit()
+        return db
+
+    def run(self):
+        """
+        Accepts cage connections and stores the batches they send, until quit is called
+        """
+        while self.isRunning:
+            rows = []
+            for key, mask in self.selector.select(timeout=0.5):
+                if key.fileobj is self.listener:
+                    try:
+                        sock, address = self.listener.accept()
+                    except OSError:
+                        continue
+                    sock.setblocking(False)
+                    self.selector.register(sock, selectors.EVENT_READ, None)
+                    self.buffers[sock] = b''
+                    continue
+                sock = key.fileobj
+                try:
+                    data = sock.recv(65536)
+                except OSError:
+                    data = b''
+                if len(data) == 0:
+                    self.selector.unregister(sock)
+                    sock.close()
+                    del self.buffers[sock]
+                    continue
+                lines = (self.buffers[sock] + data).split(b'\n')
+                self.buffers[sock] = lines.pop()
+                for line in lines:
+                    try:
+                        batch = json.loads(line)
+                        cageID = str(batch['cage'])
+                        rows.extend((cageID, int(tag), float(eventTime), str(event))
+                                    for tag, eventTime, event in batch['events'])
+                    except (ValueError, KeyError, TypeError):
+                        self.nBadLines += 1
+            if len(rows) > 0:
+                self.db.executemany('INSERT INTO events VALUES (?,?,?,?)', rows)
+                self.db.commit()
+                self.nReceived += len(rows)
+        for sock in list(self.buffers.keys()):
+            sock.close()
+        self.listener.close()
+        self.httpServer.shutdown()
+        self.db.close()
+
+    def quit(self):
+        """
+        Stops the run loop, which closes connections and the database
+        """
+        self.isRunning = False
+
+    def query(self, sql, values):
+        """
+        Runs a query on a new connection, so HTTP threads do not share the connection used for writing
+        """
+        db = sqlite3.connect(self.dbPath, timeout=10.0)
+        try:
+            return db.execute(sql, values).fetchall()
+        finally:
+            db.close()
+
+    @staticmethod
+    def countDict(rows):
+        """
+        Turns rows of (key, event, count, last time) into {key: {'lastSeen': time, event: count, ...}}
+        """
+        summaryDict = {}
+        for key, event, count, lastTime in rows:
+            keyDict = summaryDict.setdefault(str(key), {'lastSeen': 0})
+            keyDict[event] = count
+            keyDict['lastSeen'] = max(keyDict['lastSeen'], lastTime)
+        return summaryDict
+
+    def cageSummary(self, hours):
+        """
+        Returns counts of each kind of event for each cage over the last hours, and the time each cage was last heard from
+        """
+        return AHF_FleetAggregator.countDict(self.query(
+            'SELECT cage, event, COUNT(*), MAX(time) FROM events WHERE time >= ? GROUP BY cage, event',
+            (time() - hours * 3600,)))
+
+    def miceSummary(self, cageID, hours):
+        """
+        Returns counts of each kind of event for each mouse in a cage over the last hours
+        """
+        return AHF_FleetAggregator.countDict(self.query(
+            'SELECT tag, event, COUNT(*), MAX(time) FROM events WHERE cage = ? AND time >= ? GROUP BY tag, event',
+            (cageID, time() - hours * 3600)))
+
+    def mouseSummary(self, tag, hours):
+        """
+        Returns counts of each kind of event for one mouse over the last hours, by cage, as mice can move between cages
+        """
+        return AHF_FleetAggregator.countDict(self.query(
+            'SELECT cage, event, COUNT(*), MAX(time) FROM events WHERE tag = ? AND time >= ? GROUP BY cage, event',
+            (tag, time() - hours * 3600)))
+
+
+def loadCages(firstCage, nCages, eventsPerSec, runSecs, port, resultQueue):
+    """
+    Run in a load generator process, simulates nCages cages each publishing eventsPerSec events for runSecs
+    """
+    publishers = [AHF_FleetPublisher('cage{:04}'.format(iCage), 'localhost', port, batchSecs=0.2)
+                  for iCage in range(firstCage, firstCage + nCages)]
+    kinds = ('entry', 'check+', 'reward', 'reward', 'complete', 'exit')
+    startTime = time()
+    nEvents = 0
+    while time() < startTime + runSecs:
+        for iCage, publisher in enumerate(publishers):
+            for i in range(eventsPerSec // 10):
+                publisher.addEvent(1000 + (firstCage + iCage) * 10 + i % 10, time(), kinds[nEvents % len(kinds)])
+                nEvents += 1
+        sleep(max(0, 0.1 - (time() - startTime) % 0.1))
+    for publisher in publishers:
+        publisher.quit()
+    resultQueue.put((nEvents, sum(publisher.nSent for publisher in publishers),
+                     sum(publisher.nDropped for publisher in publishers)))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='AutoHeadFix fleet aggregator, or a load generator to test one')
+    parser.add_argument('dbPath', help='aggregator database file')
+    parser.add_argument('--port', type=int, default=kFLEETPORT, help='port to listen on for cages')
+    parser.add_argument('--http', type=int, default=kHTTPPORT, help='port for HTTP summaries')
+    parser.add_argument('--load', type=int, default=0, help='number of cages to simulate on localhost, 0 to just aggregate')
+    parser.add_argument('--rate', type=int, default=100, help='events per second from each simulated cage')
+    parser.add_argument('--secs', type=int, default=10, help='seconds to run the load generator')
+    parser.add_argument('--procs', type=int, default=4, help='processes for the load generator')
+    args = parser.parse_args()
+    aggregator = AHF_FleetAggregator(args.dbPath, args.port, args.http)
+    if args.load == 0:
+        print ('Aggregating events from cages on port {:d}, summaries on http port {:d}'.format(args.port, args.http))
+        try:
+            aggregator.run()
+        except KeyboardInterrupt:
+            aggregator.quit()
+        sys.exit(0)
+    import multiprocessing
+    import urllib.request
+    aggregatorThread = threading.Thread(target=aggregator.run)
+    aggregatorThread.start()
+    resultQueue = multiprocessing.Queue()
+    cagesPerProc = (args.load + args.procs - 1) // args.procs
+    procs = [multiprocessing.Process(target=loadCages, args=(first, min(cagesPerProc, args.load - first), args.rate,
+                                                             args.secs, args.port, resultQueue))
+             for first in range(0, args.load, cagesPerProc)]
+    startTime = time()
+    for proc in procs:
+        proc.start()
+    results = [resultQueue.get() for proc in procs]
+    for proc in procs:
+        proc.join()
+    # wait for the aggregator to store what the publishers sent
+    nSent = sum(result[1] for result in results)
+    while aggregator.nReceived < nSent and time() < startTime + args.secs + 30:
+        sleep(0.1)
+    ingestSecs = time() - startTime
+    with urllib.request.urlopen('http://localhost:{:d}/cages?hours=1'.format(args.http)) as response:
+        nCages = len(json.loads(response.read()))
+    summaryStart = time()
+    with urllib.request.urlopen('http://localhost:{:d}/cage?cage=cage0000&hours=1'.format(args.http)) as response:
+        json.loads(response.read())
+    summarySecs = time() - summaryStart
+    aggregator.quit()
+    aggregatorThread.join()
+    print ('{:d} cages: {:d} events made, {:d} sent, {:d} dropped, {:d} stored in {:.1f} secs, {:.0f} events per sec'.format(
+        args.load, sum(result[0] for result in results), nSent, sum(result[2] for result in results),
+        aggregator.nReceived, ingestSecs, aggregator.nReceived / ingestSecs))
+    print ('{:d} cages in summary, one cage summary took {:.1f} ms'.format(nCages, summarySecs * 1e03))
@@ -0,0 +1,244 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import os
+import pwd
+import grp
+import json
+from time import time
+import numpy as np
+
+"""
+Number of entries in the volume to duration table. Volumes are looked up by index, so a lookup costs the same for any
+size, and with 1024 entries the table adds far less error than the scatter of the calibration itself
+"""
+kTABLESIZE = 1024
+"""
+Longest opening, in seconds, durationFor ever returns. Volumes are only given up to the largest volume calibrated, so
+this is a last guard that the solenoid is never held open for long by a bad calibration
+"""
+kMAXDURATION = 1.0
+
+
+def isotonic(values, weights):
+    """
+    Returns the weighted least squares fit to values that never decreases, by pooling adjacent violators
+
+    :param values: list of values, in order
+    :param weights: list of the weight of each value
+    """
+    blocks = []  # [weighted mean, weight, number of values] of each pool
+    for value, weight in zip(values, weights):
+        blocks.append([value, weight, 1])
+        while len(blocks) > 1 and blocks[-2][0] > blocks[-1][0]:
+            mean, weight, count = blocks.pop()
+            last = blocks[-1]
+            last[0] = (last[0] * last[1] + mean * weight) / (last[1] + weight)
+            last[1] += weight
+            last[2] += count
+    fit = []
+    for mean, weight, count in blocks:
+        fit.extend([mean] * count)
+    return fit
+
+
+class AHF_FlowCalibration (object):
+    """
+    Converts between solenoid opening durations and volumes of water delivered, from measured openings
+
+    A calibration is made from batches of openings of known duration, each weighed, see calibrate in AHF_ValveControl.
+    Volume per opening is interpolated linearly between the measured durations, after a weighted isotonic fit makes the
+    measurements never decrease with duration, so the curve is monotonic by construction, and a valve that saturates
+    gives a curve that flattens instead of one that turns down. Below the shortest duration the first segment is
+    extended down to no water, the valve's dead time. The curve is turned into a table of durations at evenly spaced
+    volumes, so finding the duration for a volume is an index and one linear interpolation, with no searching, at any
+    reward. Volumes above the largest one calibrated are refused, as they can only be guessed at.
+    Volumes are in microlitres, the same as mg of water, and durations in seconds.
+    """
+
+    def __init__(self, points, cageID='', calTime=None):
+        """
+        Makes a new calibration from measured points
+
+        :param points: list of (opening duration in secs, number of openings, total volume of all openings in uL)
+        :param cageID: ID of the cage the valve is on, saved with the calibration
+        :param calTime: time the calibration was done, default now
+        :raises ValueError: if fewer than two different durations were measured, or no water was measured
+        """
+        self.points = [(float(duration), int(nOpenings), float(volume)) for duration, nOpenings, volume in points]
+        self.cageID = cageID
+        self.calTime = time() if calTime is None else calTime
+        durations = sorted(set(point[0] for point in self.points))
+        if len(durations) < 2:
+            raise ValueError('A flow calibration needs at least two different opening durations')
+        # batches of the same duration are pooled, each weighted by its number of openings
+        openings = [sum(point[1] for point in self.points if point[0] == duration) for duration in durations]
+        volumes = [sum(point[2] for point in self.points if point[0] == duration) for duration in durations]
+        perOpening = isotonic([volume / nOpenings for volume, nOpenings in zip(volumes, openings)], openings)
+        if perOpening[-1] <= 0:
+            raise ValueError('Flow calibration measured no water for any opening duration')
+        # average flow while open, over all openings, the least the valve gives past the longest duration measured
+        self.meanFlow = sum(volumes) / sum(duration * nOpenings for duration, nOpenings in zip(durations, openings))
+        knotDurs = []
+        knotVols = []
+        if perOpening[0] > 0:
+            slope = (perOpening[1] - perOpening[0]) / (durations[1] - durations[0])
+            deadTime = durations[0] - perOpening[0] / slope if slope > 0 else 0.0
+            knotDurs.append(max(0.0, deadTime))
+            knotVols.append(0.0)
+        # flat runs are dropped, keeping the shortest duration for each volume, so volumes strictly increase
+        for duration, volume in zip(durations, perOpening):
+            if len(knotVols) == 0 or volume > knotVols[-1]:
+                knotDurs.append(duration)
+                knotVols.append(volume)
+        self.knotDurs = np.array(knotDurs)
+        self.knotVols = np.array(knotVols)
+        self.maxVolume = float(self.knotVols[-1])
+        self.maxDuration = float(self.knotDurs[-1])
+        # slope past the longest duration, for volumeFor, never less than the average flow
+        self.endSlope = max((self.knotVols[-1] - self.knotVols[-2]) / (self.knotDurs[-1] - self.knotDurs[-2]),
+                            self.meanFlow)
+        # volume to duration, at evenly spaced volumes, as a list of floats, faster to index than a numpy array
+        self.volStep = self.maxVolume / (kTABLESIZE - 1)
+        self.durTable = np.interp(np.linspace(0.0, self.maxVolume, kTABLESIZE), self.knotVols, self.knotDurs).tolist()
+
+    def durationFor(self, volume):
+        """
+        Returns the opening duration, in seconds, that delivers a volume, never more than kMAXDURATION
+
+        :param volume: volume to deliver, in uL
+        :raises ValueError: if the volume is more than the largest volume calibrated
+        """
+        if volume <= 0:
+            return 0.0
+        if volume > self.maxVolume:
+            raise ValueError('{:.2f} uL is more than the largest calibrated volume, {:.2f} uL'.format(volume, self.maxVolume))
+        x = volume / self.volStep
+        i = int(x)
+        if i >= kTABLESIZE - 1:
+            return min(self.durTable[-1], kMAXDURATION)
+        return min(self.durTable[i] + (x - i) * (self.durTable[i + 1] - self.durTable[i]), kMAXDURATION)
+
+    def volumeFor(self, duration):
+        """
+        Returns the volume, in uL, delivered by an opening of a duration in seconds
+
+        Past the longest duration calibrated, volume is extended from the end of the curve at endSlope
+        """
+        if duration >= self.maxDuration:
+            return self.maxVolume + (duration - self.maxDuration) * self.endSlope
+        return float(np.interp(duration, self.knotDurs, self.knotVols))
+
+    def residualsStr(self):
+        """
+        Returns a string with measured and fit volume per opening for each point, and the root mean square difference
+        """
+        lines = ['{:>10}{:>10}{:>14}{:>14}'.format('ms', 'openings', 'measured uL', 'fit uL')]
+        sumSquares = 0.0
+        for duration, nOpenings, volume in self.points:
+            measured = volume / nOpenings
+            fit = self.volumeFor(duration)
+            sumSquares += (measured - fit) ** 2
+            lines.append('{:>10.1f}{:>10d}{:>14.3f}{:>14.3f}'.format(duration * 1e03, nOpenings, measured, fit))
+        lines.append('rms difference {:.3f} uL per opening'.format((sumSquares / len(self.points)) ** 0.5))
+        return '\n'.join(lines)
+
+    def describe(self):
+        return 'flow calibration of cage {:s}, {:d} points, {:s}, up to {:.2f} uL in {:.0f} ms'.format(
+            self.cageID, len(self.points), ', '.join('{:.0f} ms = {:.2f} uL'.format(ms, self.volumeFor(ms * 1e-03))
+                                                    for ms in (10, 20, 50)), self.maxVolume, self.maxDuration * 1e03)
+
+    def save(self, filePath):
+        """
+        Saves the measured points, and the curve made from them for people to read, to a json file
+        """
+        with open(filePath, 'w') as fp:
+            fp.write(json.dumps({'cageID': self.cageID, 'time': self.calTime, 'points': self.points,
+                                 'curve': [[duration, volume] for duration, volume in zip(self.knotDurs.tolist(),
+                                                                                          self.knotVols.tolist())]}))
+        try:
+            os.chown(filePath, pwd.getpwnam('pi').pw_uid, grp.getgrnam('pi').gr_gid)
+        except (KeyError, OSError):
+            pass
+
+    @staticmethod
+    def load(filePath):
+        """
+        Loads a calibration saved by save, making the curve again from the saved points
+
+        :returns: the calibration, or None if there is no calibration file
+        :raises ValueError: if the file can not be read as a calibration
+        """
+        try:
+            with open(filePath, 'r') as fp:
+                data = json.loads(fp.read())
+        except FileNotFoundError:
+            return None
+        try:
+            return AHF_FlowCalibration(data['points'], data.get('cageID', ''), data.get('time'))
+        except (KeyError, TypeError, IndexError, ZeroDivisionError) as anError:
+            raise ValueError('Bad flow calibration file ' + filePath + ': ' + str(anError))
+
+
+def calibrationPath(cageSet):
+    """
+    Returns the path of the flow calibration file of a cage, in its data folder
+    """
+    return cageSet.dataPath + 'flowCalibration_' + cageSet.cageID + '.jsn'
+
+
+# for testing purposes, calibrates a made up valve with a dead time and a flow that rises as it opens, then checks the
+# table against the true curve, and compares the cost of a lookup with interpolating the curve directly. Then checks a
+# valve that saturates, and noisy measurements that go down with duration, still give a monotonic curve, and that
+# volumes past the calibration are refused instead of holding the valve open
+if __name__ == '__main__':
+    from time import perf_counter
+
+    def trueVolume(duration):
+        # opens after 5 ms, then flows at 0.1 uL/ms, rising to 0.13 uL/ms fully open
+        openMs = max(0.0, duration * 1e03 - 5.0)
+        return 0.1 * openMs + 0.0015 * openMs ** 2 if openMs < 10 else 0.13 * openMs - 0.15
+
+    rng = np.random.default_rng(1)
+    points = [(duration, 100, 100 * trueVolume(duration) * rng.normal(1.0, 0.01))
+              for duration in (0.01, 0.015, 0.02, 0.03, 0.04, 0.06, 0.08)]
+    calibration = AHF_FlowCalibration(points, 'test')
+    print (calibration.residualsStr())
+    print (calibration.describe())
+    calibration.save('flowTest.jsn')
+    loaded = AHF_FlowCalibration.load('flowTest.jsn')
+    os.remove('flowTest.jsn')
+    print ('loaded calibration matches: ' + str(loaded.durTable == calibration.durTable))
+    volumes = np.linspace(0.5, calibration.maxVolume, 1000)
+    errors = [abs(trueVolume(calibration.durationFor(volume)) - volume) / volume for volume in volumes]
+    print ('delivered volume error, 0.5 to {:.1f} uL: median {:.2%}, max {:.2%}'.format(
+        calibration.maxVolume, np.median(errors), max(errors)))
+    roundTrip = max(abs(calibration.volumeFor(calibration.durationFor(volume)) - volume) for volume in volumes)
+    print ('duration to volume and back, max error {:.4f} uL'.format(roundTrip))
+    nCalls = 100000
+    startTime = perf_counter()
+    for i in range(nCalls):
+        calibration.durationFor(3.7)
+    tableUs = (perf_counter() - startTime) * 1e06 / nCalls
+    startTime = perf_counter()
+    for i in range(nCalls // 10):
+        float(np.interp(3.7, calibration.knotVols, calibration.knotDurs))
+    interpUs = (perf_counter() - startTime) * 1e07 / nCalls
+    print ('duration for a volume, us: table {:.2f}, numpy interp {:.2f}'.format(tableUs, interpUs))
+    # a valve that saturates, a fit of a curve to these points turns down, and an unbounded extrapolation was 1e08 secs
+    saturating = AHF_FlowCalibration([(0.01, 100, 50), (0.02, 100, 150), (0.04, 100, 330), (0.08, 100, 520)], 'saturating')
+    print (saturating.describe())
+    isMonotonic = all(b >= a for a, b in zip(saturating.durTable, saturating.durTable[1:]))
+    longest = max(saturating.durationFor(volume) for volume in np.linspace(0.0, saturating.maxVolume, 1000))
+    print ('saturating valve: table monotonic {:s}, longest opening {:.1f} ms, end slope {:.1f} uL/s, mean flow {:.1f} uL/s'.format(
+        str(isMonotonic), longest * 1e03, saturating.endSlope, saturating.meanFlow))
+    for volume in (saturating.maxVolume + 0.1, 1000.0):
+        try:
+            print ('duration for {:.2f} uL: {:.3f} secs, SHOULD HAVE BEEN REFUSED'.format(volume, saturating.durationFor(volume)))
+        except ValueError as anError:
+            print ('refused: ' + str(anError))
+    # noisy measurements where a longer opening weighed less than a shorter one
+    noisy = AHF_FlowCalibration([(0.01, 100, 60), (0.02, 100, 210), (0.03, 50, 95), (0.04, 100, 420)], 'noisy')
+    print ('noisy points: curve {:s}, monotonic {:s}'.format(
+        ', '.join('{:.0f} ms {:.2f} uL'.format(d * 1e03, v) for d, v in zip(noisy.knotDurs, noisy.knotVols)),
+        str(all(np.diff(noisy.knotVols) > 0) and all(np.diff(noisy.knotDurs) > 0))))
@@ -0,0 +1,341 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import os
+import json
+import struct
+import types
+import threading
+from array import array
+from time import time_ns
+
+"""
+Number of GPIO events kept in the ring buffer. A trial has tens to a few thousand events, LED pulse trains being the
+most, so this holds several trials, in 640 kBytes
+"""
+kCAPACITY = 65536
+kPREROLL = 32  # events from before the trial started that are dumped with it, to show what led up to it
+"""
+Trace file format: kMAGIC, then a header of version, length of the pin names JSON, start time in ns since the epoch, and
+number of events, then the pin names JSON, then for each event its time in ns since the event before as an unsigned
+LEB128 varint, the pin, and the kind, kOUTPUT or kINPUT, plus the level
+"""
+kMAGIC = b'AHFT'
+kVERSION = 1
+kHEADER = struct.Struct('<HIqI')
+kOUTPUT = 0
+kINPUT = 2
+
+
+class AHF_GPIOTrace (object):
+    """
+    Records every GPIO output write, and every input edge the program sees, with ns timestamps, into a ring buffer
+
+    The trace is installed in place of the RPi.GPIO module in the lazy module every AutoHeadFix module uses for GPIO,
+    as a copy of the module with output, input, wait_for_edge, and event callbacks wrapped to record before passing on.
+    Inputs are recorded as the program sees them: when input reads a level different from the last one read for that
+    pin, when wait_for_edge returns with an edge, and when an edge detection callback is called. Events come from the
+    main loop, GPIO callback threads, and the lick and contact threads, so each event takes its slot in the ring buffer
+    and fills it holding a lock, and events from different threads never overwrite each other. Recording an event is
+    the lock, a clock read and three array stores into arrays made once, about a microsecond more than the call.
+    At the end of a trial the events since the trial started are dumped, delta encoded, to a file next to the video.
+    """
+
+    def __init__(self, lazyGPIO, pinNames, capacity=kCAPACITY):
+        """
+        Makes a new trace and installs it in the lazy GPIO module
+
+        :param lazyGPIO: the AHF_LazyModule for RPi.GPIO, from lazy_import('RPi.GPIO')
+        :param pinNames: dictionary of pin: name, e.g., {12: 'pistons'}, saved in each dump for the viewer
+        :param capacity: number of events the ring buffer holds
+        """
+        self.lazyGPIO = lazyGPIO
+        self.pinNames = dict(pinNames)
+        self.capacity = capacity
+        self.times = array('q', [0] * capacity)
+        self.pins = array('B', [0] * capacity)
+        self.kinds = array('B', [0] * capacity)
+        self.nEvents = 0
+        self.trialStart = 0
+        self.lastInputs = {}
+        self.lock = threading.Lock()
+        self.realGPIO = lazyGPIO._get_module()
+        self.proxy = self.makeProxy()
+        lazyGPIO._use(self.proxy)
+
+    def record(self, pin, kind):
+        with self.lock:
+            pos = self.nEvents % self.capacity
+            self.times[pos] = time_ns()
+            self.pins[pos] = pin
+            self.kinds[pos] = kind
+            self.nEvents += 1
+
+    def makeProxy(self):
+        """
+        Returns a copy of the GPIO module with calls that change or read pins wrapped to record events
+        """
+        real = self.realGPIO
+        proxy = types.ModuleType(real.__name__)
+        proxy.__dict__.update({key: value for key, value in vars(real).items() if not key.startswith('__')})
+        # record is inlined in the wrappers of output and input, the calls most made, to save a call each time
+        record = self.record
+        trace = self
+        times = self.times
+        pins = self.pins
+        kinds = self.kinds
+        capacity = self.capacity
+        lastInputs = self.lastInputs
+        # the lock's bound methods, in a try, cost less than a with block
+        acquire = self.lock.acquire
+        release = self.lock.release
+        realOutput = real.output
+        realInput = real.input
+        realWait = real.wait_for_edge
+        rising = real.RISING
+        falling = real.FALLING
+
+        def output(pin, value):
+            realOutput(pin, value)
+            acquire()
+            try:
+                pos = trace.nEvents % capacity
+                times[pos] = time_ns()
+                pins[pos] = pin
+                kinds[pos] = kOUTPUT | (1 if value else 0)
+                trace.nEvents += 1
+            finally:
+                release()
+
+        def input(pin):
+            level = realInput(pin)
+            if lastInputs.get(pin) != level:
+                lastInputs[pin] = level
+                acquire()
+                try:
+                    pos = trace.nEvents % capacity
+                    times[pos] = time_ns()
+                    pins[pos] = pin
+                    kinds[pos] = kINPUT | level
+                    trace.nEvents += 1
+                finally:
+                    release()
+            return level
+
+        def wait_for_edge(channel, edge, **kwargs):
+            result = realWait(channel, edge, **kwargs)
+            if result is not None:
+                level = 1 if edge == rising else 0 if edge == falling else realInput(channel)
+                lastInputs[channel] = level
+                record(channel, kINPUT | level)
+            return result
+
+        def traced(callback):
+            def tracedCallback(channel):
+                level = realInput(channel)
+                lastInputs[channel] = level
+                record(channel, kINPUT | level)
+                callback(channel)
+            return tracedCallback
+
+        def add_event_detect(channel, edge, callback=None, **kwargs):
+            real.add_event_detect(channel, edge, callback=None if callback is None else traced(callback), **kwargs)
+
+        def add_event_callback(channel, callback):
+            real.add_event_callback(channel, traced(callback))
+
+        proxy.output = output
+        proxy.input = input
+        proxy.wait_for_edge = wait_for_edge
+        proxy.add_event_detect = add_event_detect
+        proxy.add_event_callback = add_event_callback
+        return proxy
+
+    def startTrial(self):
+        self.trialStart = self.nEvents
+
+    def dumpTrial(self, filePath, preroll=kPREROLL):
+        """
+        Writes events from preroll events before startTrial till now to a trace file
+
+        :returns: number of events written
+        """
+        with self.lock:
+            toEvent = self.nEvents
+        fromEvent = max(0, self.trialStart - preroll, toEvent - self.capacity)
+        nEvents = toEvent - fromEvent
+        body = bytearray()
+        lastTime = self.times[fromEvent % self.capacity] if nEvents > 0 else time_ns()
+        startTime = lastTime
+        for i in range(fromEvent, toEvent):
+            pos = i % self.capacity
+            delta = max(0, self.times[pos] - lastTime)
+            lastTime = self.times[pos]
+            while delta >= 0x80:
+                body.append((delta & 0x7F) | 0x80)
+                delta >>= 7
+            body.append(delta)
+            body.append(self.pins[pos])
+            body.append(self.kinds[pos])
+        names = json.dumps({str(pin): name for pin, name in self.pinNames.items()}).encode('utf-8')
+        with open(filePath, 'wb') as fp:
+            fp.write(kMAGIC)
+            fp.write(kHEADER.pack(kVERSION, len(names), startTime, nEvents))
+            fp.write(names)
+            fp.write(body)
+        return nEvents
+
+    def quit(self):
+        """
+        Puts the real GPIO module back in the lazy module
+        """
+        self.lazyGPIO._use(self.realGPIO)
+
+
+def readTrace(filePath):
+    """
+    Reads a trace file
+
+    :returns: (dictionary of pin: name, list of (time in ns since the epoch, pin, is input, level))
+    """
+    with open(filePath, 'rb') as fp:
+        data = fp.read()
+    if data[:4] != kMAGIC:
+        raise ValueError(filePath + ' is not a GPIO trace file')
+    version, namesLen, startTime, nEvents = kHEADER.unpack_from(data, 4)
+    pos = 4 + kHEADER.size
+    pinNames = {int(pin): name for pin, name in json.loads(data[pos:pos + namesLen].decode('utf-8')).items()}
+    pos += namesLen
+    events = []
+    eventTime = startTime
+    for i in range(nEvents):
+        delta = 0
+        shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            delta |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        eventTime += delta
+        events.append((eventTime, data[pos], bool(data[pos + 1] & kINPUT), data[pos + 1] & 1))
+        pos += 2
+    return pinNames, events
+
+
+def showTrace(pinNames, events):
+    """
+    Prints the events of a trace, with times in ms from the first event, then a summary for each pin
+    """
+    if len(events) == 0:
+        print ('no events')
+        return
+    startTime = events[0][0]
+    for eventTime, pin, isInput, level in events:
+        print ('{:12.3f}  {:<10}{:>4}  {:<6}{:d}'.format((eventTime - startTime) / 1e06, pinNames.get(pin, ''), pin,
+                                                       'in' if isInput else 'out', level))
+    print ('{:<10}{:>4}{:>8}{:>12}{:>12}{:>12}'.format('pin', '', 'events', 'first ms', 'last ms', 'high ms'))
+    for pin in sorted(set(event[1] for event in events)):
+        pinEvents = [event for event in events if event[1] == pin]
+        highNs = 0
+        highTime = None
+        for eventTime, p, isInput, level in pinEvents:
+            if level and highTime is None:
+                highTime = eventTime
+            elif not level and highTime is not None:
+                highNs += eventTime - highTime
+                highTime = None
+        print ('{:<10}{:>4}{:>8d}{:>12.3f}{:>12.3f}{:>12.3f}'.format(
+            pinNames.get(pin, ''), pin, len(pinEvents), (pinEvents[0][0] - startTime) / 1e06,
+            (pinEvents[-1][0] - startTime) / 1e06, highNs / 1e06))
+
+
+def exportTrace(pinNames, events, csvPath):
+    """
+    Writes the events of a trace to a CSV file, with absolute times in seconds and times in ms from the first event
+    """
+    with open(csvPath, 'w') as fp:
+        fp.write('time,ms,pin,name,direction,level\n')
+        startTime = events[0][0] if len(events) > 0 else 0
+        for eventTime, pin, isInput, level in events:
+            fp.write('{:.9f},{:.3f},{:d},{:s},{:s},{:d}\n'.format(eventTime / 1e09, (eventTime - startTime) / 1e06, pin,
+                                                                 pinNames.get(pin, ''), 'in' if isInput else 'out', level))
+
+
+# views or exports a trace file, or with --bench, measures the cost of recording on the simulated GPIO backend
+if __name__ == '__main__':
+    import argparse
+    from time import perf_counter
+    parser = argparse.ArgumentParser(description='View or export AutoHeadFix GPIO trace files')
+    parser.add_argument('trace', nargs='?', help='trace file to view')
+    parser.add_argument('--csv', help='export to this CSV file instead of printing')
+    parser.add_argument('--bench', action='store_true', help='measure recording overhead on simulated GPIO')
+    args = parser.parse_args()
+    if args.bench:
+        import AHF_SimGPIO
+        from AHF_LazyImport import lazy_import
+        GPIO = lazy_import('RPi.GPIO')
+        GPIO._use(AHF_SimGPIO)
+        nCalls = 200000
+
+        def timeCalls():
+            startTime = perf_counter()
+            for i in range(nCalls // 2):
+                GPIO.output(23, 1)
+                GPIO.output(23, 0)
+            outputNs = (perf_counter() - startTime) * 1e09 / nCalls
+            startTime = perf_counter()
+            for i in range(nCalls // 2):
+                AHF_SimGPIO.levels[21] = 1
+                GPIO.input(21)
+                AHF_SimGPIO.levels[21] = 0
+                GPIO.input(21)
+            inputNs = (perf_counter() - startTime) * 1e09 / nCalls
+            return outputNs, inputNs
+
+        plainOutput, plainInput = timeCalls()
+        trace = AHF_GPIOTrace(GPIO, {23: 'LED', 21: 'tir'})
+        trace.startTrial()
+        tracedOutput, tracedInput = timeCalls()
+        print ('output: {:.0f} ns plain, {:.0f} ns traced, {:.0f} ns overhead per edge'.format(
+            plainOutput, tracedOutput, tracedOutput - plainOutput))
+        print ('input edge: {:.0f} ns plain, {:.0f} ns traced, {:.0f} ns overhead per edge'.format(
+            plainInput, tracedInput, tracedInput - plainInput))
+        # edges from several threads at once, as from the main loop and callback threads, none may be lost
+        nThreads = 4
+        nEdges = 10000
+        startEvents = trace.nEvents
+
+        def outputEdges(pin):
+            for i in range(nEdges // 2):
+                GPIO.output(pin, 1)
+                GPIO.output(pin, 0)
+
+        threads = [threading.Thread(target=outputEdges, args=(24 + i,)) for i in range(nThreads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        recorded = [trace.pins[i % trace.capacity] for i in range(startEvents, trace.nEvents)]
+        print ('{:d} threads, {:d} edges each: {:d} recorded, {:s}'.format(
+            nThreads, nEdges, trace.nEvents - startEvents,
+            'none lost' if all(recorded.count(24 + i) == nEdges for i in range(nThreads)) else 'EVENTS LOST'))
+        trace.trialStart = trace.nEvents - 5000
+        startTime = perf_counter()
+        nDumped = trace.dumpTrial('benchTrace.trace')
+        dumpSecs = perf_counter() - startTime
+        print ('dumped {:d} events in {:.1f} ms, {:.2f} bytes per event'.format(
+            nDumped, dumpSecs * 1e03, os.path.getsize('benchTrace.trace') / nDumped))
+        pinNames, events = readTrace('benchTrace.trace')
+        print ('read back {:d} events, last {:s}'.format(len(events), str(events[-1])))
+        os.remove('benchTrace.trace')
+        trace.quit()
+    elif args.trace is not None:
+        pinNames, events = readTrace(args.trace)
+        if args.csv is not None:
+            exportTrace(pinNames, events, args.csv)
+        else:
+            showTrace(pinNames, events)
+    else:
+        parser.print_help()
@@ -2,11 +2,32 @@
 #-*-coding: utf-8 -*-
 
 
-import RPi.GPIO as GPIO
+from AHF_LazyImport import lazy_import
+GPIO = lazy_import('RPi.GPIO')
 from time import sleep
 from AHF_TagReader import AHF_TagReader
 from AHF_CageSet import AHF_CageSet
-from time import time
+from AHF_TrialProfiler import percentile, softwareVersion
+from time import time, perf_counter, strftime, localtime
+import os
+import pwd
+import grp
+import json
+import tempfile
+
+"""
+Solenoids are pulsed for this long in the self test, too short for a valve to open far, so hardly any water comes out
+"""
+kPULSESECS = 2e-03
+kNPULSES = 20
+kNTOGGLES = 5000  # LED toggles timed for the toggle rate, a few ms of flicker
+kNLOOPBACKS = 50
+kLOOPBACKTIMEOUT = 0.01  # an input not following its output within this long is taken to not be jumpered
+kTAGSECS = 2.0  # time tag reader frames are counted for, with a tag held in range
+"""
+A value in the history more than this fraction different from the median of the reports before it is marked as drifted
+"""
+kDRIFT = 0.5
 
 if __name__ == '__main__':
     def hardwareTester():
@@ -49,13 +70,14 @@ def htloop(cageSet, tagReader):
     p = pistons solenoid: Energizes the pistons for a 2 second duration, and then de-energizes them
     l = LED: Turns on the brain illumination LED for a 2 second duration, then off
     h = sHow config settings: Prints out the current pinout in the AHF_CageSet object
+    s = self test: Runs the timing self test, see selfTest, and saves its report
     v = saVe modified config file: Saves the the AHF_CageSet object to the file ./AHF_Config.jsn
     q = quit: quits the program
     """
     try:
         while (True):
             inputStr = input(
-                't=tagReader, r=reward solenoid, c=contact check, p=pistons solenoid, l=LED, h=sHow config, v= saVe config, q=quit:')
+                't=tagReader, r=reward solenoid, c=contact check, p=pistons solenoid, l=LED, s=self test, h=sHow config, v= saVe config, q=quit:')
             if inputStr == 't':  # t for tagreader
                 if tagReader == None:
                     cageSet.serialPort = input(
@@ -170,6 +192,8 @@ def htloop(cageSet, tagReader):
                 if inputStr == 'y' or inputStr == "Y":
                     cageSet.ledPin = int(input('Enter New LED Pin:'))
                     GPIO.setup(cageSet.ledPin, GPIO.OUT, initial=GPIO.LOW)
+            elif inputStr == 's':
+                selfTest(cageSet, tagReader)
             elif inputStr == 'h':
                 cageSet.show()
             elif inputStr == 'v':
@@ -182,5 +206,298 @@ def htloop(cageSet, tagReader):
         if __name__ == '__main__':
             GPIO.cleanup()  # this ensures a clean exit
 
+
+def latencyStats(latencies):
+    """
+    Returns a dictionary of the count, median, 99th percentile and max of a list of latencies in seconds, in us
+    """
+    latencies = sorted(latencies)
+    if len(latencies) == 0:
+        return {'n': 0}
+    return {'n': len(latencies), 'median': round(percentile(latencies, 0.5) * 1e06, 2),
+            'p99': round(percentile(latencies, 0.99) * 1e06, 2), 'max': round(latencies[-1] * 1e06, 2)}
+
+
+def solenoidTest(pin):
+    """
+    Times the GPIO output calls that open and close a solenoid, over kNPULSES pulses of kPULSESECS
+
+    :returns: dictionary of latency stats for opening and closing, in us
+    """
+    opens = []
+    closes = []
+    for i in range(kNPULSES):
+        startTime = perf_counter()
+        GPIO.output(pin, GPIO.HIGH)
+        opens.append(perf_counter() - startTime)
+        sleep(kPULSESECS)
+        startTime = perf_counter()
+        GPIO.output(pin, GPIO.LOW)
+        closes.append(perf_counter() - startTime)
+        sleep(kPULSESECS)
+    return {'openUs': latencyStats(opens), 'closeUs': latencyStats(closes)}
+
+
+def ledTest(pin):
+    """
+    Toggles the LED kNTOGGLES times as fast as it can be done, leaving it off
+
+    :returns: dictionary with the toggles per second
+    """
+    startTime = perf_counter()
+    for i in range(kNTOGGLES // 2):
+        GPIO.output(pin, GPIO.HIGH)
+        GPIO.output(pin, GPIO.LOW)
+    secs = perf_counter() - startTime
+    return {'togglesPerSec': round(kNTOGGLES / secs)}
+
+
+def loopbackTest(outPin, inPin):
+    """
+    Times how long an input takes to follow an output jumpered to it, for rising and falling edges
+
+    The input is polled, as an edge detection thread would add its own latency, for up to kLOOPBACKTIMEOUT each edge
+    :returns: dictionary of latency stats for rising and falling edges in us, and the number of edges missed
+    """
+    rises = []
+    falls = []
+    nMissed = 0
+    GPIO.setup(outPin, GPIO.OUT, initial=GPIO.LOW)
+    GPIO.setup(inPin, GPIO.IN)
+    sleep(kLOOPBACKTIMEOUT)
+    for i in range(kNLOOPBACKS):
+        # a fall is only timed after a rise was seen, else an unconnected input that is LOW would look like a fast fall
+        for level, latencies in ((GPIO.HIGH, rises), (GPIO.LOW, falls)):
+            startTime = perf_counter()
+            GPIO.output(outPin, level)
+            while GPIO.input(inPin) != level:
+                if perf_counter() - startTime > kLOOPBACKTIMEOUT:
+                    nMissed += 1
+                    break
+            else:
+                latencies.append(perf_counter() - startTime)
+                continue
+            GPIO.output(outPin, GPIO.LOW)
+            break
+    GPIO.output(outPin, GPIO.LOW)
+    return {'riseUs': latencyStats(rises), 'fallUs': latencyStats(falls), 'missed': nMissed}
+
+
+def tagReaderTest(tagReader):
+    """
+    Counts frames from the tag reader for kTAGSECS, with a tag held in range, checking each frame's checksum
+
+    :returns: dictionary of frames per second, frames read, bad frames, and median time between frames in ms
+    """
+    tagReader.clearBuffer()
+    frameTimes = []
+    nBad = 0
+    startTime = perf_counter()
+    while perf_counter() - startTime < kTAGSECS:
+        if tagReader.serialPort.inWaiting() < 16:
+            sleep(0.005)
+            continue
+        try:
+            tagReader.readTag()
+            frameTimes.append(perf_counter())
+        except (IOError, ValueError):
+            nBad += 1
+            tagReader.clearBuffer()
+    secs = perf_counter() - startTime
+    intervals = sorted(frameTimes[i] - frameTimes[i - 1] for i in range(1, len(frameTimes)))
+    return {'framesPerSec': round(len(frameTimes) / secs, 2), 'frames': len(frameTimes), 'bad': nBad,
+            'intervalMs': round(percentile(intervals, 0.5) * 1e03, 2) if len(intervals) > 0 else None}
+
+
+def cameraTest(camera):
+    """
+    Times starting and stopping a recording to a temporary file, which is then deleted
+
+    :returns: dictionary of start and stop times in ms
+    """
+    fd, videoPath = tempfile.mkstemp(suffix='.' + camera.AHFvideoFormat)
+    os.close(fd)
+    try:
+        startTime = perf_counter()
+        camera.start_recording(videoPath)
+        startMs = (perf_counter() - startTime) * 1e03
+        startTime = perf_counter()
+        camera.stop_recording()
+        stopMs = (perf_counter() - startTime) * 1e03
+    finally:
+        os.remove(videoPath)
+    return {'startMs': round(startMs, 2), 'stopMs': round(stopMs, 2)}
+
+
+def selfTest(cageSet, tagReader=None, camera=None, reportFolder=None):
+    """
+    Runs a non-interactive timing test of the cage hardware, prints the results, and saves them in a timestamped report
+
+    Times the GPIO calls that open and close the reward and pistons solenoids, the LED toggle rate, how long inputs take
+    to follow outputs for each pair in cageSet.loopbackPins, the tag reader frame rate, and how long the camera takes to
+    start and stop recording. Tests that would move hardware near a mouse, the solenoids, are skipped if the tag in range
+    pin says a mouse is in the tube, and the tag reader test is skipped if no tag is in range, as the reader only sends
+    frames for a tag. Skipped tests are listed in the report. Reports are JSON files, one per test, named for the cage and
+    time, in reportFolder, so timing drift can be followed over months with showHistory.
+
+    :param cageSet: AHF_CageSet with the pins, set up for GPIO already
+    :param tagReader: AHF_TagReader, or None to not test the tag reader
+    :param camera: AHF_Camera, or None to not test the camera
+    :param reportFolder: folder reports are saved in, default dataPath/SelfTests/
+    :returns: the report, a dictionary of results for each test
+    """
+    if reportFolder is None:
+        reportFolder = cageSet.dataPath + 'SelfTests/'
+    report = {'time': time(), 'cageID': cageSet.cageID, 'version': softwareVersion(), 'skipped': []}
+    isMouse = GPIO.input(cageSet.tirPin) == GPIO.HIGH
+    if isMouse:
+        report['skipped'] += ['reward', 'pistons']
+    else:
+        report['reward'] = solenoidTest(cageSet.rewardPin)
+        report['pistons'] = solenoidTest(cageSet.pistonsPin)
+    report['led'] = ledTest(cageSet.ledPin)
+    report['loopback'] = {}
+    for outPin, inPin in cageSet.loopbackPins:
+        report['loopback']['{:d}->{:d}'.format(outPin, inPin)] = loopbackTest(outPin, inPin)
+    if tagReader is None:
+        report['skipped'].append('tagReader')
+    elif not isMouse:
+        report['skipped'].append('tagReader: no tag in range')
+    else:
+        report['tagReader'] = tagReaderTest(tagReader)
+    if camera is None:
+        report['skipped'].append('camera')
+    else:
+        report['camera'] = cameraTest(camera)
+    showReport(report)
+    if not os.path.exists(reportFolder):
+        os.makedirs(reportFolder, mode=0o777, exist_ok=True)
+    # named to the ms, with a count added if that name is taken, so a report never replaces another
+    reportName = 'selfTest_' + cageSet.cageID + '_' + strftime('%Y%m%d_%H%M%S', localtime(report['time'])) + \
+        '_{:03d}'.format(int(report['time'] * 1000) % 1000)
+    nTaken = 0
+    while True:
+        reportPath = reportFolder + reportName + ('' if nTaken == 0 else '_' + str(nTaken)) + '.jsn'
+        try:
+            with open(reportPath, 'x') as fp:
+                fp.write(json.dumps(report, indent=1))
+            break
+        except FileExistsError:
+            nTaken += 1
+    try:
+        os.chown(reportPath, pwd.getpwnam('pi').pw_uid, grp.getgrnam('pi').gr_gid)
+    except (KeyError, OSError):
+        pass
+    print ('Self test report saved to ' + reportPath)
+    return report
+
+
+def showReport(report):
+    """
+    Prints the results of a self test
+    """
+    print ('Self test of cage ' + report['cageID'] + ' at ' + strftime('%Y-%m-%d %H:%M:%S', localtime(report['time'])))
+    for name in ('reward', 'pistons'):
+        if name in report:
+            print ('{:s} solenoid command us: open {:s}, close {:s}'.format(name, str(report[name]['openUs']),
+                                                                         str(report[name]['closeUs'])))
+    print ('LED toggles per sec: {:d}'.format(report['led']['togglesPerSec']))
+    for pair, result in report['loopback'].items():
+        print ('loopback {:s} us: rise {:s}, fall {:s}, missed {:d}'.format(pair, str(result['riseUs']),
+                                                                         str(result['fallUs']), result['missed']))
+    if 'tagReader' in report:
+        print ('tag reader: ' + str(report['tagReader']))
+    if 'camera' in report:
+        print ('camera ms: start {:.2f}, stop {:.2f}'.format(report['camera']['startMs'], report['camera']['stopMs']))
+    if len(report['skipped']) > 0:
+        print ('skipped: ' + ', '.join(report['skipped']))
+
+
+def historyValues(report):
+    """
+    Returns the values of a report followed in the history, as a dictionary of column: value, or None if not measured
+    """
+    values = {}
+    for name in ('reward', 'pistons'):
+        values[name + ' open'] = report[name]['openUs'].get('median') if name in report else None
+    values['LED toggle/s'] = report['led']['togglesPerSec']
+    for pair, result in sorted(report['loopback'].items()):
+        values[pair + ' rise'] = result['riseUs'].get('median')
+    values['tag frame/s'] = report['tagReader']['framesPerSec'] if 'tagReader' in report else None
+    values['camera ms'] = report['camera']['startMs'] if 'camera' in report else None
+    return values
+
+
+def showHistory(reportFolder, cageID=None):
+    """
+    Prints the main values of all the self test reports in a folder, oldest first, one line per report
+
+    Values more than kDRIFT different from the median of the same value in earlier reports are marked with a *
+    :param cageID: only show reports for this cage, or None for all
+    :returns: list of (time, column) of each value marked as drifted
+    """
+    reports = []
+    for fileName in sorted(os.listdir(reportFolder)):
+        if fileName.startswith('selfTest_') and fileName.endswith('.jsn'):
+            with open(reportFolder + fileName, 'r') as fp:
+                report = json.loads(fp.read())
+            if cageID is None or report['cageID'] == cageID:
+                reports.append(report)
+    reports.sort(key=lambda report: report['time'])
+    rows = [(report, historyValues(report)) for report in reports]
+    columns = []
+    for report, values in rows:
+        columns += [column for column in values if column not in columns]
+    print ('{:<20}{:<10}'.format('time', 'cage') + ''.join('{:>16}'.format(column) for column in columns))
+    drifts = []
+    earlier = {column: [] for column in columns}
+    for report, values in rows:
+        line = '{:<20}{:<10}'.format(strftime('%Y-%m-%d %H:%M', localtime(report['time'])), report['cageID'])
+        for column in columns:
+            value = values.get(column)
+            if value is None:
+                line += '{:>16}'.format('-')
+                continue
+            mark = ' '
+            if len(earlier[column]) > 0:
+                median = percentile(sorted(earlier[column]), 0.5)
+                if median != 0 and abs(value - median) / median > kDRIFT:
+                    mark = '*'
+                    drifts.append((report['time'], column))
+            line += '{:>15.2f}{:s}'.format(value, mark)
+            earlier[column].append(value)
+        print (line)
+    return drifts
+
+
+# with no arguments, runs the interactive tester. With --selftest, runs the self test on the cage's hardware, with
+# --history, shows the history of saved self test reports, and with --sim, either runs on simulated hardware
 if __name__ == '__main__':
-    hardwareTester()
+    import argparse
+    parser = argparse.ArgumentParser(description='Test AutoHeadFix cage hardware')
+    parser.add_argument('--selftest', action='store_true', help='run the non-interactive timing self test')
+    parser.add_argument('--history', nargs='?', const='', help='show self test reports in this folder, default dataPath/SelfTests/')
+    parser.add_argument('--sim', action='store_true', help='use simulated GPIO, serial port and camera')
+    args = parser.parse_args()
+    if args.sim:
+        os.environ['AHF_SIM'] = '1'
+    if args.history is not None:
+        showHistory(args.history if args.history != '' else AHF_CageSet().dataPath + 'SelfTests/')
+    elif args.selftest:
+        cageSet = AHF_CageSet()
+        GPIO.setwarnings(False)
+        GPIO.setmode(GPIO.BCM)
+        for pin in (cageSet.pistonsPin, cageSet.rewardPin, cageSet.ledPin):
+            GPIO.setup(pin, GPIO.OUT, initial=GPIO.LOW)
+        GPIO.setup(cageSet.tirPin, GPIO.IN)
+        GPIO.setup(cageSet.contactPin, GPIO.IN)
+        try:
+            tagReader = AHF_TagReader(cageSet.serialPort, True)
+        except IOError:
+            tagReader = None
+        try:
+            selfTest(cageSet, tagReader)
+        finally:
+            GPIO.cleanup()
+    else:
+        hardwareTester()
@@ -0,0 +1,98 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import os
+import sys
+import subprocess
+from datetime import datetime
+
+"""
+AutoHeadFix modules timed by default, __main__ is timed under the name AHF_main
+"""
+kMODULES = ('AHF_main', 'AHF_Settings', 'AHF_CageSet', 'AHF_Rewarder', 'AHF_TagReader', 'AHF_Notifier',
+            'AHF_UDPTrig', 'AHF_Stimulator', 'AHF_Stimulator_Rewards', 'AHF_Stimulator_LEDs',
+            'AHF_HardwareTester', 'AHF_ValveControl', 'AHF_Mouse', 'AHF_Camera')
+kHISTORYFILE = 'importTimes.txt'
+
+
+def importTime(moduleName, nRepeats=5):
+    """
+    Measures the cost of importing a module in a fresh python, using python -X importtime
+
+    Each measurement is run in a new process, so nothing is already imported, and the best of nRepeats is kept
+    :param moduleName: name of module to import, AHF_main for the AutoHeadFix __main__ module
+    :returns: tuple of total microseconds for the import including everything it imported, and the 5 slowest
+    modules it imported as a list of (microseconds, name), or None if the import failed
+    """
+    thisDir = os.path.dirname(os.path.abspath(__file__))
+    if moduleName == 'AHF_main':
+        code = 'import importlib.util as u;s=u.spec_from_file_location("AHF_main","__main__.py")' + \
+            ';s.loader.exec_module(u.module_from_spec(s))'
+    else:
+        code = 'import ' + moduleName
+    best = None
+    for i in range(nRepeats):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=thisDir,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            return None
+        selfTimes = []
+        total = 0
+        for line in result.stderr.splitlines():
+            # lines are import time: self [us] | cumulative | imported package
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            fields = line[12:].split('|')
+            selfTime = int(fields[0])
+            total += selfTime
+            selfTimes.append((selfTime, fields[2].strip()))
+        if best is None or total < best[0]:
+            best = (total, sorted(selfTimes, reverse=True)[:5])
+    return best
+
+
+def measure(moduleNames=kMODULES, historyPath=kHISTORYFILE):
+    """
+    Measures import time for each module, prints it, and appends it to the history file, tab separated date, module, microseconds
+    """
+    dateStr = datetime.now().isoformat(' ', 'seconds')
+    with open(historyPath, 'a') as fp:
+        for moduleName in moduleNames:
+            result = importTime(moduleName)
+            if result is None:
+                print ('{:<24}'.format(moduleName) + 'import failed')
+                continue
+            total, slowest = result
+            print ('{:<24}{:>9} us\tslowest: '.format(moduleName, total) +
+                   ', '.join(name + ' ' + str(us) for us, name in slowest))
+            fp.write(dateStr + '\t' + moduleName + '\t' + str(total) + '\n')
+
+
+def showHistory(historyPath=kHISTORYFILE):
+    """
+    Prints import time of each module over time, one column per measurement date, in milliseconds
+    """
+    historyDict = {}
+    dates = []
+    with open(historyPath, 'r') as fp:
+        for line in fp:
+            try:
+                dateStr, moduleName, total = line.rstrip('\n').split('\t')
+                total = int(total)
+            except ValueError:
+                continue
+            if dateStr not in dates:
+                dates.append(dateStr)
+            historyDict.setdefault(moduleName, {})[dateStr] = total
+    print ('{:<24}'.format('module (ms)') + ''.join('{:>12}'.format(dateStr[:10]) for dateStr in dates))
+    for moduleName in sorted(historyDict.keys()):
+        times = historyDict[moduleName]
+        print ('{:<24}'.format(moduleName) + ''.join('{:>12}'.format('{:.1f}'.format(times[dateStr] / 1000)
+                                                                     if dateStr in times else '-') for dateStr in dates))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'history':
+        showHistory()
+    else:
+        measure(sys.argv[1:] if len(sys.argv) > 1 else kMODULES)
@@ -0,0 +1,217 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import os
+import pwd
+import grp
+import json
+from zlib import crc32
+
+"""
+Records written to the journal between snapshots. A snapshot holds every key once, so restart replays at most this
+many records after loading it, and the journal file stays small
+"""
+kSNAPSHOTEVERY = 1000
+
+
+def encodeRecord(data):
+    """
+    Returns a journal line for a JSON-able object: the CRC32 of the JSON in hex, a tab, the JSON, and a newline
+    """
+    body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return b'%08x\t%s\n' % (crc32(body), body)
+
+
+def decodeRecord(line):
+    """
+    Returns the object in a journal line, or None if the line is not whole or its CRC does not match
+    """
+    if len(line) < 10 or line[8:9] != b'\t' or line[-1:] != b'\n':
+        return None
+    body = line[9:-1]
+    try:
+        if int(line[:8], 16) != crc32(body):
+            return None
+        return json.loads(body.decode('utf-8'))
+    except ValueError:
+        return None
+
+
+class AHF_Journal (object):
+    """
+    A crash-safe key-value store, kept as a compact snapshot plus an append-only journal of changes since the snapshot
+
+    Each change, a key and its new value, is appended to the journal as one line with a sequence number and a CRC, and
+    flushed, so it survives the program dying. Every snapshotEvery changes the whole state is written to a new
+    snapshot file, synced, and renamed over the old one, and the journal is emptied. On a restart, recover loads the
+    snapshot and replays journal records newer than it. A record torn by a crash part way through writing it fails its
+    CRC and is cut off, keeping every record before it. A damaged record with good records after it is skipped, so
+    nothing already written is ever thrown away because of a bad record.
+    """
+
+    def __init__(self, basePath, snapshotEvery=kSNAPSHOTEVERY):
+        """
+        Makes a new journal, use recover to load what was saved before writing anything
+
+        :param basePath: path of the journal files without extension, the snapshot is basePath.snap, the journal basePath.jnl
+        :param snapshotEvery: number of records written between snapshots
+        """
+        self.snapPath = basePath + '.snap'
+        self.journalPath = basePath + '.jnl'
+        self.snapshotEvery = snapshotEvery
+        self.state = {}
+        self.seq = 0
+        self.nSinceSnapshot = 0
+        self.fp = None
+
+    def recover(self):
+        """
+        Loads the snapshot and replays the journal after it, and opens the journal for appending
+
+        :returns: (dictionary of key: value, number of journal records replayed, number of torn bytes cut off the journal)
+        """
+        self.state = {}
+        self.seq = 0
+        try:
+            with open(self.snapPath, 'rb') as fp:
+                snapshot = decodeRecord(fp.read())
+            if snapshot is None:
+                # only possible if the disk was corrupted, as a snapshot is renamed into place when complete
+                print ('Journal snapshot ' + self.snapPath + ' is damaged, replaying the journal alone')
+            else:
+                self.seq = snapshot['seq']
+                self.state = snapshot['state']
+        except FileNotFoundError:
+            pass
+        nReplayed = 0
+        nBad = 0
+        goodBytes = 0  # bytes up to the end of the last good record, anything after it is a torn tail
+        nTorn = 0
+        try:
+            with open(self.journalPath, 'rb') as fp:
+                data = fp.read()
+            readBytes = 0
+            for line in data.splitlines(keepends=True):
+                readBytes += len(line)
+                record = decodeRecord(line)
+                if record is None:
+                    nBad += 1
+                    continue
+                goodBytes = readBytes
+                if record['seq'] > self.seq:
+                    self.seq = record['seq']
+                    self.state[record['key']] = record['value']
+                    nReplayed += 1
+            nTorn = len(data) - goodBytes
+            if nTorn > 0:
+                nBad -= 1
+        except FileNotFoundError:
+            pass
+        if nBad > 0:
+            # a damaged record before good ones was not torn by a crash, so the records after it are kept
+            print ('Skipped {:d} damaged records in journal {:s}'.format(nBad, self.journalPath))
+        self.fp = open(self.journalPath, 'ab')
+        if nTorn > 0:
+            self.fp.truncate(goodBytes)
+            print ('Cut {:d} torn bytes off the end of journal {:s}'.format(nTorn, self.journalPath))
+        self.nSinceSnapshot = nReplayed
+        try:
+            os.chown(self.journalPath, pwd.getpwnam('pi').pw_uid, grp.getgrnam('pi').gr_gid)
+        except (KeyError, OSError):
+            pass
+        return dict(self.state), nReplayed, nTorn
+
+    def record(self, key, value):
+        """
+        Records a new value for a key, taking a snapshot if snapshotEvery records were written since the last one
+
+        :param key: a string
+        :param value: anything that can be made into JSON
+        """
+        self.seq += 1
+        self.state[key] = value
+        self.fp.write(encodeRecord({'seq': self.seq, 'key': key, 'value': value}))
+        self.fp.flush()
+        self.nSinceSnapshot += 1
+        if self.nSinceSnapshot >= self.snapshotEvery:
+            self.snapshot()
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def snapshot(self):
+        """
+        Writes the whole state to a new snapshot, then empties the journal
+
+        The snapshot is synced before it replaces the old one, so there is always a whole snapshot on the disk. If the
+        program dies after the rename but before the journal is emptied, the records left are older than the snapshot
+        and are skipped by recover
+        """
+        with open(self.snapPath + '.tmp', 'wb') as fp:
+            fp.write(encodeRecord({'seq': self.seq, 'state': self.state}))
+            fp.flush()
+            os.fsync(fp.fileno())
+        isNew = not os.path.exists(self.snapPath)
+        os.replace(self.snapPath + '.tmp', self.snapPath)
+        if isNew:
+            try:
+                os.chown(self.snapPath, pwd.getpwnam('pi').pw_uid, grp.getgrnam('pi').gr_gid)
+            except (KeyError, OSError):
+                pass
+        self.fp.truncate(0)
+        self.fp.flush()
+        self.nSinceSnapshot = 0
+
+    def quit(self):
+        """
+        Takes a snapshot, so the next start has no journal to replay, and closes the journal
+        """
+        if self.fp is not None:
+            self.snapshot()
+            self.fp.close()
+            self.fp = None
+
+
+# for testing purposes, times writing records and recovering from them, and checks a torn last record loses nothing else
+if __name__ == '__main__':
+    import sys
+    import random
+    import tempfile
+    from time import perf_counter
+    nRecords = int(sys.argv[1]) if len(sys.argv) > 1 else 20500
+    folder = tempfile.mkdtemp()
+    basePath = os.path.join(folder, 'journalTest')
+    # a colony of 30 mice, each record is the state of one mouse after a trial
+    tags = [2018121000 + i for i in range(30)]
+    journal = AHF_Journal(basePath)
+    journal.recover()
+    startTime = perf_counter()
+    for i in range(nRecords):
+        tag = random.choice(tags)
+        mouse = journal.get(str(tag), {'entries': 0, 'headFixes': 0, 'stimResults': {'L': 0, 'C': 0, 'R': 0}})
+        mouse['headFixes'] += 1
+        mouse['stimResults'][random.choice('LCR')] += 1
+        journal.record(str(tag), mouse)
+    writeSecs = perf_counter() - startTime
+    print ('wrote {:d} records in {:.2f} secs, {:.1f} us each, with a snapshot every {:d}'.format(
+        nRecords, writeSecs, writeSecs * 1e06 / nRecords, journal.snapshotEvery))
+    expected = json.loads(json.dumps(journal.state))
+    # the program dies without a last snapshot, part way through writing a record
+    journal.fp.write(encodeRecord({'seq': journal.seq + 1, 'key': 'torn', 'value': 0})[:20])
+    journal.fp.close()
+    print ('snapshot {:d} bytes, journal {:d} bytes'.format(os.path.getsize(journal.snapPath),
+                                                           os.path.getsize(journal.journalPath)))
+    startTime = perf_counter()
+    restarted = AHF_Journal(basePath)
+    state, nReplayed, nTorn = restarted.recover()
+    recoverMs = (perf_counter() - startTime) * 1e03
+    print ('recovered {:d} keys, replaying {:d} records after the snapshot, in {:.2f} ms, {:d} torn bytes cut off'.format(
+        len(state), nReplayed, recoverMs, nTorn))
+    print ('recovered state matches: ' + str(state == expected))
+    restarted.record(str(tags[0]), {'entries': 1})
+    restarted.fp.close()
+    state, nReplayed, nTorn = AHF_Journal(basePath).recover()
+    print ('record after recovery kept: ' + str(state[str(tags[0])] == {'entries': 1} and nTorn == 0))
+    for fileName in os.listdir(folder):
+        os.remove(os.path.join(folder, fileName))
+    os.rmdir(folder)
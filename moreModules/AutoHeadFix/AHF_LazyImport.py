@@ -0,0 +1,97 @@
+#! /usr/bin/python
+#-*-coding: utf-8 -*-
+
+import os
+import importlib
+
+"""
+Simulated stand-ins imported instead of hardware modules when the AHF_SIM environment variable is set, e.g. by AHF_Replay
+"""
+kSIMMODULES = {'RPi.GPIO': 'AHF_SimGPIO', 'serial': 'AHF_SimGPIO'}
+
+
+def import_module(moduleName):
+    """
+    Imports a module, or its simulated stand-in from kSIMMODULES if the AHF_SIM environment variable is set
+    """
+    if os.environ.get('AHF_SIM') and moduleName in kSIMMODULES:
+        moduleName = kSIMMODULES[moduleName]
+    return importlib.import_module(moduleName)
+
+
+class AHF_LazyModule (object):
+    """
+    Stands in for a module that is only imported the first time one of its attributes is used
+
+    Hardware and network modules (RPi.GPIO, serial, requests) are slow to import and are missing on computers that are not
+    a Pi, so AutoHeadFix modules import them with lazy_import, and only pay for them when a feature actually uses them.
+    After the module is imported its attributes are copied into the stand-in, so later uses cost no more than using the module.
+    """
+
+    def __init__(self, moduleName):
+        self.__dict__['_moduleName'] = moduleName
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, name):
+        """
+        Only called for attributes not yet copied into the stand-in, so imports the module and tries again
+        """
+        if self.__dict__['_module'] is None:
+            self._use(import_module(self.__dict__['_moduleName']))
+            if name in self.__dict__:
+                return self.__dict__[name]
+        return getattr(self.__dict__['_module'], name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_module(), name, value)
+        self.__dict__[name] = value
+
+    def __repr__(self):
+        return '<lazy module ' + self.__dict__['_moduleName'] + ('' if self.__dict__['_module'] is None else ', imported') + '>'
+
+    def _get_module(self):
+        """
+        Returns the module, importing it if needed
+        """
+        if self.__dict__['_module'] is None:
+            self._use(import_module(self.__dict__['_moduleName']))
+        return self.__dict__['_module']
+
+    def _use(self, module):
+        """
+        Makes the stand-in use the given module, copying its public attributes into the stand-in
+        """
+        moduleName = self.__dict__['_moduleName']
+        self.__dict__.clear()
+        self.__dict__.update({key: value for key, value in vars(module).items() if not key.startswith('__')})
+        self.__dict__['_moduleName'] = moduleName
+        self.__dict__['_module'] = module
+
+
+lazyModulesDict = {}
+
+
+def lazy_import(moduleName):
+    """
+    Returns a stand-in for the named module, that will import the module when first used
+
+    Every caller asking for the same module name gets the same stand-in
+    :param moduleName: full name of the module, e.g. 'RPi.GPIO'
+    """
+    lazyModule = lazyModulesDict.get(moduleName)
+    if lazyModule is None:
+        lazyModule = AHF_LazyModule(moduleName)
+        lazyModulesDict[moduleName] = lazyModule
+    return lazyModule
+
+
+if __name__ == '__main__':
+    from time import perf_counter
+    json = lazy_import('json')
+    print (json)
+    print (json.dumps({'lazy': True}))
+    print (json)
+    startTime = perf_counter()
+    for i in range(100000):
+        json.dumps
+    print ('{:.3f} microseconds per attribute lookup'.format((perf_counter() - startTime) * 10))
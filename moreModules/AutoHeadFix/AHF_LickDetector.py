@@ -0,0 +1,215 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import os
+import threading
+from time import time
+import numpy as np
+from AHF_LazyImport import lazy_import
+GPIO = lazy_import('RPi.GPIO')
+
+"""
+Number of edges, lick onsets and offsets, kept in the ring buffer. At 10 licks a second, with two edges each, this
+holds over 25 minutes, far longer than any trial, in under 300 kBytes
+"""
+kCAPACITY = 32768
+"""
+Edges closer than this to the last accepted edge are contact bounce and are ignored. Licks last 20-50 ms, so a few ms
+removes bounce without merging licks
+"""
+kDEBOUNCESECS = 2e-03
+"""
+Data type of the per-trial lick arrays, 5 bytes an edge. Times are float32 seconds from the start of the trial, so are
+to better than 10 us for trials up to a few minutes, and level is 1 for a lick onset and 0 for an offset
+"""
+kLICKDTYPE = np.dtype([('time', '<f4'), ('level', 'i1')])
+
+
+class AHF_LickDetector (object):
+    """
+    Captures edges on a lick sensor pin into a timestamped ring buffer, and passes them to subscribers as they happen
+
+    Edges are captured with GPIO edge detection, so the callback runs in the GPIO library's background thread, not in
+    the main loop. Each accepted edge is stored in numpy arrays of times and levels used as a ring buffer, with a total
+    count that only goes up, so a reader can ask for everything since the count it last saw. Subscribers, like closed
+    loop stimulators, are called from the capture thread with each edge, so they hear of a lick within microseconds,
+    and must return quickly. Storing an edge does not allocate, and the buffer is read without locking: the writer
+    stores an edge and then increments the count, and a reader copies what it wants and then checks the writer did not
+    wrap around onto it while copying.
+    """
+
+    def __init__(self, lickPin, capacity=kCAPACITY, debounceSecs=kDEBOUNCESECS):
+        """
+        Makes a new lick detector and starts capturing edges
+
+        :param lickPin: GPIO pin the lick sensor is connected to, HIGH when the mouse touches the spout
+        :param capacity: number of edges the ring buffer holds
+        :param debounceSecs: edges closer than this to the last accepted edge are ignored
+        """
+        self.lickPin = lickPin
+        self.capacity = capacity
+        self.debounceSecs = debounceSecs
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.levels = np.zeros(capacity, dtype=np.int8)
+        self.nEdges = 0  # total edges accepted, the next edge goes at nEdges % capacity
+        self.nLicks = 0
+        self.nBounces = 0
+        self.lastTime = 0.0
+        self.lastLevel = GPIO.LOW
+        self.subscribers = []
+        self.subscribeLock = threading.Lock()
+        self.trialStart = 0
+        GPIO.setup(lickPin, GPIO.IN)
+        self.lastLevel = GPIO.input(lickPin)
+        GPIO.add_event_detect(lickPin, GPIO.BOTH, callback=self.edge)
+
+    def edge(self, channel):
+        """
+        Called from the GPIO library's thread on each edge, stores the edge if it is not bounce, and calls subscribers
+        """
+        edgeTime = time()
+        level = GPIO.input(self.lickPin)
+        if level == self.lastLevel:
+            return
+        if edgeTime - self.lastTime < self.debounceSecs:
+            self.nBounces += 1
+            return
+        self.lastTime = edgeTime
+        self.lastLevel = level
+        pos = self.nEdges % self.capacity
+        self.times[pos] = edgeTime
+        self.levels[pos] = level
+        self.nEdges += 1
+        if level == GPIO.HIGH:
+            self.nLicks += 1
+        for callback in self.subscribers:
+            callback(edgeTime, level)
+
+    def subscribe(self, callback):
+        """
+        Adds a function to be called with (time, level) for each accepted edge, from the capture thread
+
+        The callback must be quick, like putting the edge in a queue or setting a flag, as it holds up capture of the
+        next edge
+        """
+        with self.subscribeLock:
+            self.subscribers = self.subscribers + [callback]
+
+    def unsubscribe(self, callback):
+        with self.subscribeLock:
+            self.subscribers = [x for x in self.subscribers if x != callback]
+
+    def since(self, fromEdge):
+        """
+        Returns copies of the times and levels of edges from edge number fromEdge to now, and the edge number to ask from
+        next time. If edges were overwritten before they were read, the oldest still in the buffer are returned
+
+        :returns: (times, levels, nextEdge)
+        """
+        while True:
+            toEdge = self.nEdges
+            fromEdge = max(fromEdge, toEdge - self.capacity)
+            start = fromEdge % self.capacity
+            stop = toEdge % self.capacity
+            if toEdge == fromEdge:
+                times = self.times[0:0].copy()
+                levels = self.levels[0:0].copy()
+            elif start < stop:
+                times = self.times[start:stop].copy()
+                levels = self.levels[start:stop].copy()
+            else:
+                times = np.concatenate((self.times[start:], self.times[:stop]))
+                levels = np.concatenate((self.levels[start:], self.levels[:stop]))
+            # if the writer wrapped onto the part we copied while we were copying, copy again
+            if self.nEdges - fromEdge <= self.capacity:
+                return times, levels, toEdge
+
+    def isLicking(self):
+        return self.lastLevel == GPIO.HIGH
+
+    def startTrial(self):
+        """
+        Marks the start of a trial, whose edges are saved by saveTrial
+        """
+        self.trialStart = self.nEdges
+
+    def saveTrial(self, filePath, startTime):
+        """
+        Saves the edges since startTrial as a numpy array of kLICKDTYPE, with times from startTime
+
+        :param filePath: path of the .npy file, the folder is made if needed
+        :param startTime: time the trial's lick times are from, e.g., when the LED came on
+        :returns: number of licks in the trial
+        """
+        times, levels, nextEdge = self.since(self.trialStart)
+        licks = np.empty(len(times), dtype=kLICKDTYPE)
+        licks['time'] = times - startTime
+        licks['level'] = levels
+        folder = os.path.dirname(filePath)
+        if folder != '' and not os.path.exists(folder):
+            os.makedirs(folder, mode=0o777, exist_ok=True)
+        np.save(filePath, licks)
+        return int(np.count_nonzero(levels))
+
+    def quit(self):
+        GPIO.remove_event_detect(self.lickPin)
+
+
+# benchmark against the simulated GPIO backend: how many edges a second can be captured, and how soon a subscriber hears
+if __name__ == '__main__':
+    import sys
+    from time import perf_counter
+    import AHF_SimGPIO
+    GPIO._use(AHF_SimGPIO)
+    kPIN = 24
+    nLicks = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    # edges are injected as fast as they can be, far faster than any mouse licks, with no debouncing
+    detector = AHF_LickDetector(kPIN, debounceSecs=0.0)
+    latencies = np.zeros(2 * nLicks, dtype=np.float64)
+    nHeard = 0
+    injectTime = 0.0
+
+    def heard(edgeTime, level):
+        global nHeard
+        latencies[nHeard] = perf_counter() - injectTime
+        nHeard += 1
+
+    # capacity, with no subscribers
+    startTime = perf_counter()
+    for i in range(nLicks):
+        AHF_SimGPIO.inject(kPIN, 1)
+        AHF_SimGPIO.inject(kPIN, 0)
+    captureSecs = perf_counter() - startTime
+    print ('captured {:d} edges in {:.2f} secs, {:.0f} edges/sec, {:.2f} us each'.format(
+        detector.nEdges, captureSecs, detector.nEdges / captureSecs, captureSecs * 1e06 / detector.nEdges))
+    # latency from the edge to a subscriber hearing of it
+    detector.subscribe(heard)
+    for i in range(nLicks):
+        injectTime = perf_counter()
+        AHF_SimGPIO.inject(kPIN, 1)
+        injectTime = perf_counter()
+        AHF_SimGPIO.inject(kPIN, 0)
+    latencies = np.sort(latencies[:nHeard]) * 1e06
+    print ('subscriber latency, us: median {:.2f}, 99% {:.2f}, 99.9% {:.2f}, max {:.2f}'.format(
+        latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)],
+        latencies[int(len(latencies) * 0.999)], latencies[-1]))
+    # reading back, with the buffer wrapped many times
+    startTime = perf_counter()
+    times, levels, nextEdge = detector.since(detector.nEdges - 1000)
+    print ('read 1000 edges in {:.1f} us, {:d} licks in all'.format((perf_counter() - startTime) * 1e06, detector.nLicks))
+    # debouncing: 2 bounces on each onset, 0.5 ms apart, are ignored, with edges timed on the simulated clock
+    time = AHF_SimGPIO.time
+    detector = AHF_LickDetector(kPIN + 1)
+    detector.startTrial()
+    trialStart = time()
+    for i in range(100):
+        for level in (1, 0, 1, 0, 1):
+            AHF_SimGPIO.inject(kPIN + 1, level)
+            AHF_SimGPIO.sleep(0.5e-03)
+        AHF_SimGPIO.sleep(30e-03)
+        AHF_SimGPIO.inject(kPIN + 1, 0)
+        AHF_SimGPIO.sleep(70e-03)
+    print ('debounced: {:d} licks, {:d} bounces ignored'.format(detector.nLicks, detector.nBounces))
+    nSaved = detector.saveTrial('lickTest.npy', trialStart)
+    print ('saved {:d} licks in a trial file of {:d} bytes'.format(nSaved, os.path.getsize('lickTest.npy')))
+    os.remove('lickTest.npy')
@@ -0,0 +1,199 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Metrics for a running AutoHeadFix, served as Prometheus text format over HTTP if a metrics port is set in AHFconfig.jsn
+
+Metrics are kept in a registry in this module, so any module can make and update them without passing them around.
+Counters and histograms are updated only by the main loop, with no locks, so updating is a few attribute operations.
+The HTTP thread only reads them, and a scrape that catches a histogram half updated is off by one event for one scrape.
+Gauges are callbacks, run only when metrics are scraped, so they cost nothing on the trial path.
+"""
+kLATENCYBUCKETS = (1e-04, 2.5e-04, 5e-04, 1e-03, 2.5e-03, 5e-03, 1e-02, 2.5e-02, 5e-02, 0.1, 0.25, 0.5, 1.0)
+kJITTERBUCKETS = (1e-04, 2.5e-04, 5e-04, 1e-03, 2.5e-03, 5e-03, 1e-02, 2.5e-02, 5e-02, 0.1)
+
+registry = {}  # metric name: AHF_Counter, AHF_Gauge, or AHF_Histogram, in the order made
+
+
+class AHF_Counter (object):
+    """
+    A count that only goes up, like entries or trials
+    """
+    __slots__ = ('name', 'helpStr', 'value')
+
+    def __init__(self, name, helpStr):
+        self.name = name
+        self.helpStr = helpStr
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self):
+        return ['# HELP ' + self.name + ' ' + self.helpStr, '# TYPE ' + self.name + ' counter',
+                self.name + ' ' + repr(self.value)]
+
+
+class AHF_Gauge (object):
+    """
+    A value read from a callback when metrics are scraped, like a queue depth or total solenoid open time
+    """
+    __slots__ = ('name', 'helpStr', 'callback')
+
+    def __init__(self, name, helpStr, callback):
+        self.name = name
+        self.helpStr = helpStr
+        self.callback = callback
+
+    def render(self):
+        try:
+            value = float(self.callback())
+        except Exception:
+            value = float('nan')
+        return ['# HELP ' + self.name + ' ' + self.helpStr, '# TYPE ' + self.name + ' gauge', self.name + ' ' + repr(value)]
+
+
+class AHF_Histogram (object):
+    """
+    Counts of observed values, like latencies, in fixed buckets, with their sum and count
+
+    Counts are kept per bucket, not cumulative, so observe changes one bucket, and are made cumulative when scraped
+    """
+    __slots__ = ('name', 'helpStr', 'buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, name, helpStr, buckets):
+        self.name = name
+        self.helpStr = helpStr
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.helpStr, '# TYPE ' + self.name + ' histogram']
+        counts = list(self.counts)
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            lines.append(self.name + '_bucket{le="' + ('+Inf' if bound == float('inf') else repr(bound)) + '"} ' + str(total))
+        lines.append(self.name + '_sum ' + repr(self.sum))
+        lines.append(self.name + '_count ' + str(total))
+        return lines
+
+
+def counter(name, helpStr):
+    """
+    Returns the counter with this name, making it if needed
+    """
+    if name not in registry:
+        registry[name] = AHF_Counter(name, helpStr)
+    return registry[name]
+
+
+def gauge(name, helpStr, callback):
+    """
+    Makes a gauge with this name, or replaces the callback of an existing one, e.g., when a new stimulator is made
+    """
+    if name in registry:
+        registry[name].callback = callback
+    else:
+        registry[name] = AHF_Gauge(name, helpStr, callback)
+    return registry[name]
+
+
+def histogram(name, helpStr, buckets=kLATENCYBUCKETS):
+    """
+    Returns the histogram with this name, making it with the given bucket upper bounds if needed
+    """
+    if name not in registry:
+        registry[name] = AHF_Histogram(name, helpStr, buckets)
+    return registry[name]
+
+
+def render():
+    """
+    Returns all metrics in Prometheus text format
+    """
+    lines = []
+    for metric in list(registry.values()):
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def intervalJitters(eventTimes, interval=None):
+    """
+    Returns how far each interval between event times, e.g. a stimulator's rewardTimes, was from the intended interval
+
+    :param interval: intended interval, if None the mean interval is used
+    """
+    if len(eventTimes) < 2:
+        return []
+    intervals = [eventTimes[i + 1] - eventTimes[i] for i in range(len(eventTimes) - 1)]
+    if interval is None:
+        interval = sum(intervals) / len(intervals)
+    return [abs(x - interval) for x in intervals]
+
+
+class Handler (BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port):
+    """
+    Starts serving metrics at http://<cage>:port/metrics from a daemon thread
+
+    :returns: the HTTP server, call its shutdown method to stop serving
+    """
+    server = ThreadingHTTPServer(('', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# for testing purposes, measures the cost of updating metrics, and serves some made up metrics
+if __name__ == '__main__':
+    import sys
+    from time import perf_counter
+    import urllib.request
+    testCounter = counter('ahf_test_total', 'Test counter')
+    testHistogram = histogram('ahf_test_seconds', 'Test histogram')
+    gauge('ahf_test_gauge', 'Test gauge', lambda: testCounter.value / 2)
+    nLoops = 1000000
+    startTime = perf_counter()
+    for i in range(nLoops):
+        testCounter.inc()
+    incNs = (perf_counter() - startTime) * 1e09 / nLoops
+    startTime = perf_counter()
+    for i in range(nLoops):
+        testHistogram.observe(i * 1e-09)
+    observeNs = (perf_counter() - startTime) * 1e09 / nLoops
+    print ('counter inc {:.0f} ns, histogram observe {:.0f} ns'.format(incNs, observeNs))
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 9100
+    server = serve(port)
+    startTime = perf_counter()
+    with urllib.request.urlopen('http://localhost:{:d}/metrics'.format(port)) as response:
+        text = response.read().decode('utf-8')
+    print ('scrape took {:.1f} ms'.format((perf_counter() - startTime) * 1e03))
+    print (text)
+    server.shutdown()
@@ -1,5 +1,6 @@
 from AHF_Rewarder import AHF_Rewarder
-import RPi.GPIO as GPIO
+from AHF_LazyImport import lazy_import
+GPIO = lazy_import('RPi.GPIO')
 
 
 class Mouse:
@@ -25,19 +26,62 @@ class Mouse:
         self.headFixes = headFixes
         self.headFixRewards = headFixRewards
         self.stimResultsDict = {}
+        self.ledger = None  # AHF_RewardLedger of today's rewards, set by the AHF_Rewarder when the mouse enters
+        # daily counts already added to the AHF_MouseHistory index, counts loaded from quickStats were added before
+        self.historyLast = (entries, entranceRewards, headFixes, headFixRewards)
 
     def clear(self):
         """
         Clears the stats for entries and rewards for this mouse, done at the start of every day
-        Also clears any StimResults dict entries that the stimulator has made
+        Also clears any StimResults dict entries that the stimulator has made, lists to lists of zeros
         """
         self.entries = 0
         self.headFixes = 0
         self.entranceRewards = 0
         self.headFixRewards = 0
+        self.ledger = None
+        self.historyLast = (0, 0, 0, 0)
         if self.stimResultsDict is not None:
             for key in self.stimResultsDict:
-                self.stimResultsDict[key] = 0
+                if isinstance(self.stimResultsDict[key], list):
+                    self.stimResultsDict[key] = [0] * len(self.stimResultsDict[key])
+                else:
+                    self.stimResultsDict[key] = 0
+
+    @property
+    def waterVolume(self):
+        """
+        uL of water given today, from the mouse's reward ledger, 0 if it has none or the solenoid is not calibrated
+        """
+        return 0.0 if self.ledger is None else self.ledger.getVolume()
+
+    def getState(self):
+        """
+        Returns a dictionary of this mouse's daily counts and stimResults, that can be made into JSON, for AHF_Journal
+        """
+        return {'entries': self.entries, 'entranceRewards': self.entranceRewards, 'headFixes': self.headFixes,
+                'headFixRewards': self.headFixRewards, 'stimResults': dict(self.stimResultsDict.items()),
+                'historyLast': list(self.historyLast)}
+
+    def setState(self, stateDict):
+        """
+        Sets this mouse's daily counts and stimResults from a dictionary made by getState
+
+        stimResults are set as a dictionary, copied into the mouse's stim results record when it is next bound to one
+        """
+        self.entries = int(stateDict['entries'])
+        self.entranceRewards = int(stateDict['entranceRewards'])
+        self.headFixes = int(stateDict['headFixes'])
+        self.headFixRewards = int(stateDict['headFixRewards'])
+        self.stimResultsDict = dict(stateDict['stimResults'])
+        self.historyLast = tuple(stateDict['historyLast'])
+
+    def statsStr(self):
+        """
+        Returns this mouse's line in the quick stats file, zero-padded so every line is the same length
+        """
+        return '{:013}\t{:05}\t{:05}\t{:05}\t{:05}\n'.format(self.tag, self.entries, self.entranceRewards,
+                                                            self.headFixes, self.headFixRewards)
 
     def reward(self, rewarder, rewardName):
         """
@@ -56,7 +100,8 @@ class Mouse:
         Prints all the data for this mouse, including any stimResults info
         """
         print ('MouseID:', '{:013}'.format(self.tag), '\tEntries:', self.entries, '\tHeadFixes:',
-               self.headFixes, '\tEntRewards:', self.entranceRewards, '\tHFRewards:', self.headFixRewards)
+               self.headFixes, '\tEntRewards:', self.entranceRewards, '\tHFRewards:', self.headFixRewards,
+               '\tWater uL: {:.1f}'.format(self.waterVolume))
         if self.stimResultsDict is not None:
             stimResults = 'Stim Results:'
             for key in self.stimResultsDict:
@@ -88,9 +133,9 @@ class Mice:
                        ' has already been added')
                 return -1
         self.mouseArray.append(aMouse)
-        # add a blank line to the quik stats file
+        # add a blank line to the quik stats file, at the new mouse's position
         if statsfp is not None:
-            statsfp.seek(39 + 38 * len(self.mouseArray))
+            statsfp.seek(39 + 38 * (len(self.mouseArray) - 1))
             outPutStr = '{:013}'.format(
                 int(aMouse.tag)) + "\t" + '{:05}'.format(0) + "\t" + '{:05}'.format(0) + "\t"
             outPutStr += '{:05}'.format(0) + "\t" + '{:05}'.format(0) + "\n"
@@ -102,24 +147,32 @@ class Mice:
         """
         Adds mouse objects to the mice array, initialzing tagID and initial values for rewards from quickstats file
 
-        If there is a problem with the quickstats file structure, the file is scrubbed and started over with 0 mice
+        Lines that can not be read, like a line torn by a crash, are skipped, and the file is rewritten with the mice
+        that were read, one per line in array order, so one bad line never loses the other mice
         :param statsfp: file pointer to the quickstats file
         returns:nothing
         """
         statsfp.seek(39)
-        aline = statsfp.readline()
-        while aline:
+        nBad = 0
+        for aline in statsfp.read().split('\n'):
+            if aline.strip('\x00 ') == '':
+                continue
             try:
-                mouseID, entries, entRewards, hFixes, hfRewards = str(
-                    aline).split('\t')
+                mouseID, entries, entRewards, hFixes, hfRewards = aline.split('\t')
                 aMouse = Mouse(int(mouseID), int(entries), int(
                     entRewards), int(hFixes), int(hfRewards))
-                self.addMouse(aMouse, statsfp)
-                aline = statsfp.readline()
             except ValueError:
-                statsfp.truncate(39)
-                self.mouseArray = []
-                print ('Daily Quick Stats File overwritten.')
+                nBad += 1
+                continue
+            if self.getMouseFromTag(aMouse.tag) is None:
+                self.addMouse(aMouse, None)
+        if nBad > 0:
+            print ('Skipped {:d} unreadable lines in the Daily Quick Stats File.'.format(nBad))
+        statsfp.seek(39)
+        statsfp.truncate()
+        for aMouse in self.mouseArray:
+            statsfp.write(aMouse.statsStr())
+        statsfp.flush()
         return
 
     def removeMouseByTag(self, tag):
@@ -0,0 +1,237 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import os
+import pwd
+import grp
+from collections import deque
+from time import time
+from datetime import datetime
+
+import numpy as np
+
+"""
+One record is appended to a mouse's history file each time its stats are updated, after each exit. Counts are cumulative
+over the life of the mouse, not per day, so the counts between any two times are the difference of two records
+"""
+kRECORD = np.dtype([('time', '<f8'), ('entries', '<u4'), ('entranceRewards', '<u4'), ('headFixes', '<u4'),
+                    ('headFixRewards', '<u4'), ('tubeSecs', '<f8')])
+kCOUNTS = ('entries', 'entranceRewards', 'headFixes', 'headFixRewards')
+
+
+class AHF_MouseHistory (object):
+    """
+    Append-only history of each mouse's entries, rewards, head fixes and time in the tube, kept across days
+
+    Each mouse has a file, <tag>.hist, of fixed-size records of cumulative counts, so updating is one small append, and
+    a learning curve over months is a binary search and a difference of records. Running sums over the last windowSecs
+    are kept in memory for each mouse, so rolling metrics are also updated in constant time per event.
+    """
+
+    def __init__(self, historyPath, windowSecs=86400.0):
+        """
+        Makes a new history index that keeps its files in historyPath, making the folder if needed
+
+        :param historyPath: folder for the history files, e.g. dataPath + 'mouseHistory/'
+        :param windowSecs: duration of the window for rolling metrics
+        """
+        self.historyPath = historyPath
+        self.windowSecs = windowSecs
+        self.lastDict = {}  # tag: last record written, as a numpy record
+        self.windowDict = {}  # tag: (deque of (time, count deltas, tube secs), list of running sums)
+        if not os.path.exists(historyPath):
+            os.makedirs(historyPath, mode=0o777, exist_ok=True)
+
+    def filePath(self, tag):
+        return os.path.join(self.historyPath, str(tag) + '.hist')
+
+    def readRecords(self, tag):
+        """
+        Returns all the records for a mouse as a numpy structured array, with an empty array for a new mouse
+        """
+        try:
+            records = np.fromfile(self.filePath(tag), dtype=kRECORD)
+        except (IOError, ValueError):
+            return np.zeros(0, dtype=kRECORD)
+        return records
+
+    def getLast(self, tag):
+        """
+        Returns the last record for a mouse, reading it from the end of its file the first time
+        """
+        last = self.lastDict.get(tag)
+        if last is None:
+            last = np.zeros(1, dtype=kRECORD)[0]
+            try:
+                with open(self.filePath(tag), 'rb') as fp:
+                    size = fp.seek(0, 2)
+                    nRecords = size // kRECORD.itemsize
+                    if nRecords > 0:
+                        fp.seek((nRecords - 1) * kRECORD.itemsize)
+                        last = np.frombuffer(fp.read(kRECORD.itemsize), dtype=kRECORD)[0].copy()
+            except IOError:
+                pass
+            self.lastDict[tag] = last
+        return last
+
+    def update(self, mouse, tubeSecs):
+        """
+        Adds the counts a mouse has gained since its last update to its history, called from updateStats after each exit
+
+        The mouse's daily counts are compared with mouse.historyLast, the daily counts already added to the history,
+        which Mouse sets when it is made or cleared at the start of a day
+        :param mouse: the mouse that just left the chamber
+        :param tubeSecs: time the mouse spent in the tube on this entry
+        """
+        counts = (mouse.entries, mouse.entranceRewards, mouse.headFixes, mouse.headFixRewards)
+        deltas = tuple(max(0, count - seen) for count, seen in zip(counts, mouse.historyLast))
+        mouse.historyLast = counts
+        last = self.getLast(mouse.tag)
+        now = time()
+        # get the window before appending, so a window filled from the file does not already hold this record
+        window, sums = self.getWindow(mouse.tag, now)
+        record = np.zeros(1, dtype=kRECORD)
+        record['time'] = now
+        for name, delta in zip(kCOUNTS, deltas):
+            record[name] = last[name] + delta
+        record['tubeSecs'] = last['tubeSecs'] + tubeSecs
+        isNew = not os.path.exists(self.filePath(mouse.tag))
+        with open(self.filePath(mouse.tag), 'ab') as fp:
+            fp.write(record.tobytes())
+        if isNew:
+            try:
+                os.chown(self.filePath(mouse.tag), pwd.getpwnam('pi').pw_uid, grp.getgrnam('pi').gr_gid)
+            except (KeyError, OSError):
+                pass
+        self.lastDict[mouse.tag] = record[0]
+        window.append((now, deltas, tubeSecs))
+        for i, delta in enumerate(deltas):
+            sums[i] += delta
+        sums[4] += tubeSecs
+        self.trimWindow(window, sums, now)
+
+    def getWindow(self, tag, now):
+        """
+        Returns the rolling window and running sums for a mouse, filling it from its file the first time
+        """
+        windowAndSums = self.windowDict.get(tag)
+        if windowAndSums is None:
+            window = deque()
+            sums = [0, 0, 0, 0, 0.0]
+            records = self.readRecords(tag)
+            if len(records) > 0:
+                iStart = np.searchsorted(records['time'], now - self.windowSecs)
+                previous = records[iStart - 1] if iStart > 0 else np.zeros(1, dtype=kRECORD)[0]
+                for record in records[iStart:]:
+                    deltas = tuple(int(record[name]) - int(previous[name]) for name in kCOUNTS)
+                    tubeSecs = float(record['tubeSecs'] - previous['tubeSecs'])
+                    window.append((float(record['time']), deltas, tubeSecs))
+                    for i, delta in enumerate(deltas):
+                        sums[i] += delta
+                    sums[4] += tubeSecs
+                    previous = record
+            windowAndSums = (window, sums)
+            self.windowDict[tag] = windowAndSums
+        return windowAndSums
+
+    def trimWindow(self, window, sums, now):
+        """
+        Drops events older than windowSecs from a rolling window, subtracting them from the running sums
+        """
+        while len(window) > 0 and window[0][0] < now - self.windowSecs:
+            eventTime, deltas, tubeSecs = window.popleft()
+            for i, delta in enumerate(deltas):
+                sums[i] -= delta
+            sums[4] -= tubeSecs
+
+    @staticmethod
+    def metrics(entries, entranceRewards, headFixes, headFixRewards, tubeSecs):
+        """
+        Returns a dictionary of counts, and of head-fix rate, rewards per entry, and tube time per entry
+        """
+        perEntry = 1 / entries if entries > 0 else float('nan')
+        return {'entries': entries, 'entranceRewards': entranceRewards, 'headFixes': headFixes,
+                'headFixRewards': headFixRewards, 'tubeSecs': tubeSecs, 'headFixRate': headFixes * perEntry,
+                'rewardsPerEntry': (entranceRewards + headFixRewards) * perEntry, 'tubeSecsPerEntry': tubeSecs * perEntry}
+
+    def cumulative(self, tag):
+        """
+        Returns metrics for a mouse over its whole history
+        """
+        last = self.getLast(tag)
+        return AHF_MouseHistory.metrics(*([int(last[name]) for name in kCOUNTS] + [float(last['tubeSecs'])]))
+
+    def rolling(self, tag):
+        """
+        Returns metrics for a mouse over the last windowSecs
+        """
+        now = time()
+        window, sums = self.getWindow(tag, now)
+        self.trimWindow(window, sums, now)
+        return AHF_MouseHistory.metrics(*sums)
+
+    def curve(self, tag, startTime, endTime, binSecs=86400.0):
+        """
+        Returns a learning curve for a mouse, with counts and metrics in bins of binSecs from startTime to endTime
+
+        :returns: dictionary of numpy arrays, binStart, the counts in kCOUNTS, tubeSecs, headFixRate, rewardsPerEntry
+        """
+        records = self.readRecords(tag)
+        edges = np.arange(startTime, endTime + binSecs, binSecs)
+        # cumulative counts at each bin edge are those of the last record before the edge
+        iEdges = np.searchsorted(records['time'], edges, side='right') - 1
+        curveDict = {'binStart': edges[:-1]}
+        for name in kCOUNTS + ('tubeSecs',):
+            atEdges = np.where(iEdges >= 0, records[name][np.maximum(iEdges, 0)] if len(records) else 0, 0)
+            curveDict[name] = np.diff(atEdges.astype(np.float64))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            curveDict['headFixRate'] = curveDict['headFixes'] / curveDict['entries']
+            curveDict['rewardsPerEntry'] = (curveDict['entranceRewards'] +
+                                            curveDict['headFixRewards']) / curveDict['entries']
+        return curveDict
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    from time import perf_counter
+    parser = argparse.ArgumentParser(description='Learning curve of a mouse from its AutoHeadFix history')
+    parser.add_argument('historyPath', help='folder of history files, dataPath/mouseHistory/')
+    parser.add_argument('tag', type=int, help='tag of the mouse, or 0 to benchmark a made up mouse')
+    parser.add_argument('--days', type=float, default=30, help='number of days back from now')
+    parser.add_argument('--bin', type=float, default=24, help='hours per bin')
+    args = parser.parse_args()
+    history = AHF_MouseHistory(args.historyPath)
+    if args.tag == 0:
+        # benchmark, 6 months of a mouse entering 100 times a day
+        class BenchMouse:
+            tag = 0
+            entries = entranceRewards = headFixes = headFixRewards = 0
+            historyLast = (0, 0, 0, 0)
+        mouse = BenchMouse()
+        nEvents = 180 * 100
+        startTime = perf_counter()
+        for i in range(nEvents):
+            mouse.entries += 1
+            mouse.headFixes += i % 2
+            mouse.headFixRewards += 5 * (i % 2)
+            history.update(mouse, 30.0)
+        print ('{:.1f} microseconds per update'.format((perf_counter() - startTime) * 1e06 / nEvents))
+        records = history.readRecords(0)
+        records['time'] = time() - 180 * 86400 + np.arange(len(records)) * 864
+        records.tofile(history.filePath(0))
+        history = AHF_MouseHistory(args.historyPath)
+        startTime = perf_counter()
+        curveDict = history.curve(0, time() - 180 * 86400, time())
+        print ('{:.2f} ms for 180 day curve'.format((perf_counter() - startTime) * 1e03))
+        os.remove(history.filePath(0))
+        sys.exit(0)
+    curveDict = history.curve(args.tag, time() - args.days * 86400, time(), args.bin * 3600)
+    print ('bin start\tentries\tentRew\thfixes\thfRew\ttubeMins\thfRate\trewPerEntry')
+    for i in range(len(curveDict['binStart'])):
+        print ('\t'.join([datetime.fromtimestamp(int(curveDict['binStart'][i])).isoformat(' ')] +
+                          [str(int(curveDict[name][i])) for name in kCOUNTS] +
+                          ['{:.1f}'.format(curveDict['tubeSecs'][i] / 60), '{:.2f}'.format(curveDict['headFixRate'][i]),
+                           '{:.2f}'.format(curveDict['rewardsPerEntry'][i])]))
+    print ('cumulative:', history.cumulative(args.tag))
+    print ('rolling:', history.rolling(args.tag))
@@ -1,4 +1,8 @@
-import requests
+from AHF_LazyImport import lazy_import
+requests = lazy_import('requests')
+import queue
+import threading
+from time import time, sleep
 
 
 class AHF_Notifier:
@@ -9,33 +13,59 @@ class AHF_Notifier:
     The best way to install python modules is with pip. Assuming you are using Python 3:
     sudo apt-get install python3-pip
     sudo pip-3.2 install requests
+
+    Messages are sent by a worker thread from a bounded queue, so a slow or unreachable web service never holds
+    up the main loop. The worker reuses one http session, gives up on a request after timeoutSecs, and retries
+    failed requests with exponential backoff. Repeats of the same message for the same mouse are suppressed for
+    repeatSecs, and no more than maxPerHour messages are sent about any one mouse.
     """
 
-    def __init__(self, cageID_p, phoneList_p):
+    def __init__(self, cageID_p, phoneList_p, URL_p='http://textbelt.com/canada', queueSize=32,
+                 timeoutSecs=10.0, maxTries=5, backoffSecs=2.0, repeatSecs=600.0, maxPerHour=6):
         """Makes a new AHF_Notifier object
 
         The notifier will send text messages to a tuple of phone numbers using a web service, textbelt.com
         As it uses http requests to send the message to the web service, you need to be online
         for notifier to work.
         :param cageID_p: identifier for cage, sent in message
-        :param durationSecs_p: duration that mouse has been in tube, sent in message
         :param phoneList_p: tuple of telephone numbers to which the message will be sent
+        :param URL_p: URL of the web service messages are posted to
+        :param queueSize: maximum number of messages waiting to be sent, more are dropped
+        :param timeoutSecs: time to wait for the web service before giving up on a request
+        :param maxTries: number of times to try sending each message
+        :param backoffSecs: wait before first retry, doubled for each following retry
+        :param repeatSecs: time during which an identical message about the same mouse is not sent again
+        :param maxPerHour: maximum number of messages about any one mouse in an hour
         return: nothing
         """
-        self.URL = 'http://textbelt.com/canada'
+        self.URL = URL_p
         self.cageID = str(cageID_p)
         self.phoneList = phoneList_p
+        self.timeoutSecs = timeoutSecs
+        self.maxTries = maxTries
+        self.backoffSecs = backoffSecs
+        self.repeatSecs = repeatSecs
+        self.maxPerHour = maxPerHour
+        self.lastSentDict = {}  # (tag, kind): time message was last queued
+        self.tagTimesDict = {}  # tag: list of times messages were queued in the last hour
+        self.nSent = 0
+        self.nFailed = 0
+        self.nDropped = 0
+        self.queue = queue.Queue(maxsize=queueSize)
+        self.session = requests.Session()
+        self.thread = threading.Thread(target=self.sendLoop, daemon=True)
+        self.thread.start()
 
     def notify(self, tag, durationSecs, isStuck):
         """
-        Sends a text message with the given information.
+        Queues a text message with the given information to be sent to each phone number, and returns without waiting
 
         Two types of message can be sent, depending if isStuck is True or False
         No timing is done by the AHF_Notifier class, the durations are only for building the text mssg
         :param tag: RFID tag of the mouse
         :param durationSecs: how long the mouse has been inside the chamber
         :param isStuck: boolean signifying if the mouse has been inside the chamber for too long, or has just left the chamber
-        :return: nothing
+        :return: True if the message was queued, False if it was suppressed or dropped
         """
 
         if isStuck == True:
@@ -46,6 +76,119 @@ class AHF_Notifier:
             alertString = 'Mouse ' + str(tag) + ', the erstwhile stuck mouse in cage ' + self.cageID + \
                 ' has finally left the chamber after being inside for {:.2f}'.format(
                     durationSecs / 60) + ' minutes.'
-        for i in self.phoneList:
-            requests.post(self.URL, data={'number': i, 'message': alertString})
-        print (alertString, ' Messages have been sent.')
+        return self.queueMessage(tag, isStuck, alertString)
+
+    def queueMessage(self, tag, kind, alertString):
+        """
+        Puts a message on the queue for each phone number, unless it is a repeat or the mouse is over its rate limit
+
+        :param tag: RFID tag of the mouse the message is about, used for de-duplication and rate limiting
+        :param kind: any value identifying the kind of message, identical tag and kind within repeatSecs is a repeat
+        :param alertString: text of the message
+        :return: True if the message was queued, False if it was suppressed or dropped
+        """
+        now = time()
+        lastSent = self.lastSentDict.get((tag, kind))
+        if lastSent is not None and now - lastSent < self.repeatSecs:
+            print ('Repeat message not sent:', alertString)
+            return False
+        tagTimes = [t for t in self.tagTimesDict.get(tag, []) if now - t < 3600]
+        if len(tagTimes) >= self.maxPerHour:
+            print ('Message rate limit reached for mouse ' + str(tag) + ':', alertString)
+            return False
+        # the message goes to every number or none, so a dropped message is not held back as a repeat when retried.
+        # Only the main loop puts messages on the queue, so the free space checked here can only grow till they are put
+        if self.queue.maxsize - self.queue.qsize() < len(self.phoneList):
+            self.nDropped += 1
+            print ('Notifier queue is full, message dropped:', alertString)
+            return False
+        for number in self.phoneList:
+            self.queue.put_nowait((number, alertString))
+        tagTimes.append(now)
+        self.tagTimesDict[tag] = tagTimes
+        self.lastSentDict[(tag, kind)] = now
+        print (alertString, ' Messages have been queued.')
+        return True
+
+    def sendLoop(self):
+        """
+        Run by the worker thread, sends messages from the queue until quit puts None on the queue
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            number, alertString = item
+            if self.send(number, alertString):
+                self.nSent += 1
+            else:
+                self.nFailed += 1
+                print ('Notifier gave up sending to ' + str(number) + ':', alertString)
+
+    def send(self, number, alertString):
+        """
+        Posts one message to the web service, retrying with exponential backoff
+
+        :returns: True if the web service accepted the message
+        """
+        waitSecs = self.backoffSecs
+        for iTry in range(self.maxTries):
+            try:
+                response = self.session.post(self.URL, data={'number': number, 'message': alertString},
+                                             timeout=self.timeoutSecs)
+                if response.ok:
+                    return True
+            except requests.RequestException:
+                pass
+            if iTry < self.maxTries - 1:
+                sleep(waitSecs)
+                waitSecs *= 2
+        return False
+
+    def quit(self, waitSecs=5.0):
+        """
+        Stops the worker thread after it sends the messages already queued, waiting at most waitSecs
+        """
+        try:
+            self.queue.put(None, timeout=waitSecs)
+        except queue.Full:
+            pass
+        self.thread.join(waitSecs)
+        self.session.close()
+
+
+# for testing purposes, with a local stand-in for the web service that fails the first request for each number
+if __name__ == '__main__':
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import parse_qs
+
+    class StandInHandler (BaseHTTPRequestHandler):
+        triesDict = {}
+
+        def do_POST(self):
+            fields = parse_qs(self.rfile.read(
+                int(self.headers['Content-Length'])).decode('utf-8'))
+            number = fields['number'][0]
+            StandInHandler.triesDict[number] = StandInHandler.triesDict.get(number, 0) + 1
+            sleep(0.2)  # a slow web service
+            self.send_response(200 if StandInHandler.triesDict[number] > 1 else 503)
+            self.end_headers()
+            print ('stand-in received', number, fields['message'][0])
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    notifier = AHF_Notifier('testCage', ('5551234', '5555678'), 'http://127.0.0.1:' + str(server.server_port),
+                            backoffSecs=0.1, repeatSecs=0.5, maxPerHour=2)
+    startTime = time()
+    notifier.notify(2525, 610, True)
+    notifier.notify(2525, 620, True)  # repeat, suppressed
+    notifier.notify(2525, 700, False)
+    print ('notify calls returned in {:.2f} ms'.format((time() - startTime) * 1000))
+    sleep(0.6)
+    notifier.notify(2525, 800, True)  # no longer a repeat, but over rate limit, suppressed
+    notifier.quit(10)
+    print ('sent', notifier.nSent, 'failed', notifier.nFailed, 'dropped', notifier.nDropped)
+    server.shutdown()
@@ -0,0 +1,247 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import os
+import gc
+import ctypes
+import ctypes.util
+
+"""
+Real-time priority asked for while a stimulus runs, from 1, lowest, to 99. 50 is the same as the kernel's threaded
+interrupt handlers, so GPIO and USB interrupts are still serviced while the stimulus runs
+"""
+kPRIORITY = 50
+"""
+Flags for mlockall, from sys/mman.h. MCL_CURRENT locks pages already mapped, MCL_FUTURE locks pages mapped later,
+so the memory a trial allocates is not paged out between trials
+"""
+kMCL_CURRENT = 1
+kMCL_FUTURE = 2
+
+
+def isolatedCPUs():
+    """
+    Returns the set of CPUs isolated from the scheduler with isolcpus= on the kernel command line, often empty
+    """
+    try:
+        with open('/sys/devices/system/cpu/isolated', 'r') as fp:
+            text = fp.read().strip()
+    except IOError:
+        return set()
+    cpus = set()
+    for part in text.split(','):
+        if part == '':
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def lockMemory():
+    """
+    Locks all current and future pages of the process into RAM with mlockall, so a trial never waits on a page fault
+
+    :returns: None if memory was locked, else a string saying why not
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if libc.mlockall(kMCL_CURRENT | kMCL_FUTURE) == 0:
+            return None
+        return os.strerror(ctypes.get_errno())
+    except (OSError, AttributeError) as anError:
+        return str(anError)
+
+
+def unlockMemory():
+    try:
+        ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).munlockall()
+    except (OSError, AttributeError):
+        pass
+
+
+class AHF_RealTime (object):
+    """
+    Opt-in real-time mode for the timing critical part of a trial, the stimulator's run method
+
+    Memory is locked once, when made with real-time mode on. Used as a context manager around stimulator.run, the calling thread is pinned to
+    one CPU and given SCHED_FIFO priority, and the cyclic garbage collector is paused, then all are put back as they
+    were on leaving. Pinning and priority are only for the length of the stimulus, so threads the main thread starts,
+    like the camera's when it starts recording, are not pinned or made real-time with it. The CPU is best one kept
+    free of other tasks, with isolcpus=3 on the kernel command line in /boot/cmdline.txt for a 4 core Pi.
+    Each of the settings can be turned off, for comparing their effects, and any the system does not permit, e.g.,
+    SCHED_FIFO when not run as root, is left off and recorded in problems.
+    With cpu less than 0, real-time mode is off, memory is not locked, and entering and leaving do nothing.
+    """
+
+    def __init__(self, cpu, priority=kPRIORITY, doLockMemory=True, doPauseGC=True, doPin=True):
+        """
+        Makes a new AHF_RealTime, locking memory if asked and real-time mode is on
+
+        :param cpu: CPU the stimulus runs on, or -1 for real-time mode off
+        :param priority: SCHED_FIFO priority, 1 to 99, or 0 to not change the scheduler
+        :param doLockMemory: lock memory with mlockall
+        :param doPauseGC: pause the garbage collector while the stimulus runs
+        :param doPin: pin the thread to cpu while the stimulus runs
+        """
+        self.isOn = cpu >= 0
+        self.cpu = cpu if doPin else -1
+        self.priority = priority if self.isOn else 0
+        self.doPauseGC = doPauseGC and self.isOn
+        self.problems = []
+        self.isMemoryLocked = False
+        self.oldAffinity = None
+        self.oldScheduler = None
+        self.gcWasEnabled = False
+        if self.cpu < 0:
+            pass
+        elif not hasattr(os, 'sched_setaffinity'):
+            self.problems.append('CPU affinity is not supported on this system')
+            self.cpu = -1
+        else:
+            self.allCPUs = os.sched_getaffinity(0)
+            if cpu not in self.allCPUs:
+                self.problems.append('CPU {:d} is not available, have {:s}'.format(cpu, str(sorted(self.allCPUs))))
+                self.cpu = -1
+            elif cpu not in isolatedCPUs():
+                self.problems.append('CPU {:d} is not isolated, add isolcpus={:d} to the kernel command line'.format(
+                    cpu, cpu))
+        if self.priority > 0:
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.priority))
+                os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+            except AttributeError:
+                self.problems.append('SCHED_FIFO is not supported on this system')
+                self.priority = 0
+            except OSError as anError:
+                self.problems.append('SCHED_FIFO is not permitted: ' + anError.strerror)
+                self.priority = 0
+        if doLockMemory and self.isOn:
+            result = lockMemory()
+            if result is None:
+                self.isMemoryLocked = True
+            else:
+                self.problems.append('could not lock memory: ' + result)
+
+    def describe(self):
+        """
+        Returns a one line description of the settings in force, and any that could not be used
+        """
+        if not self.isOn:
+            return 'real-time mode off, memory locked={:s}'.format(str(self.isMemoryLocked))
+        text = 'real-time mode: cpu={:d}, SCHED_FIFO priority={:d}, memory locked={:s}, GC paused={:s}'.format(
+            self.cpu, self.priority, str(self.isMemoryLocked), str(self.doPauseGC))
+        if len(self.problems) > 0:
+            text += ' (' + '; '.join(self.problems) + ')'
+        return text
+
+    def __enter__(self):
+        if not self.isOn:
+            return self
+        if self.cpu >= 0:
+            self.oldAffinity = os.sched_getaffinity(0)
+            os.sched_setaffinity(0, {self.cpu})
+        if self.priority > 0:
+            self.oldScheduler = (os.sched_getscheduler(0), os.sched_getparam(0))
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.priority))
+        if self.doPauseGC:
+            self.gcWasEnabled = gc.isenabled()
+            gc.disable()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if not self.isOn:
+            return False
+        if self.doPauseGC and self.gcWasEnabled:
+            gc.enable()
+        if self.oldScheduler is not None:
+            os.sched_setscheduler(0, self.oldScheduler[0], self.oldScheduler[1])
+            self.oldScheduler = None
+        if self.oldAffinity is not None:
+            os.sched_setaffinity(0, self.oldAffinity)
+            self.oldAffinity = None
+        return False
+
+    def quit(self):
+        if self.isMemoryLocked:
+            unlockMemory()
+            self.isMemoryLocked = False
+
+
+def timingLoop(nEvents, interval, sleepMin=1e-03, garbage=0):
+    """
+    Times events the way AHF_Stimulator_LEDs does, sleeping till sleepMin before each, then spinning on the clock
+
+    :param garbage: number of reference cycles made between events, to give the garbage collector something to do
+    :returns: sorted list of how late each event was, in seconds
+    """
+    from time import perf_counter, sleep
+    lates = []
+    cycles = []
+    target = perf_counter() + interval
+    for i in range(nEvents):
+        for j in range(garbage):
+            cycle = [j]
+            cycle.append(cycle)
+            cycles.append({'cycle': cycle})
+        if len(cycles) > 10000:
+            cycles = []
+        sleepTime = target - perf_counter() - sleepMin
+        if sleepTime > 0:
+            sleep(sleepTime)
+        while perf_counter() < target:
+            pass
+        lates.append(perf_counter() - target)
+        target += interval
+    lates.sort()
+    return lates
+
+
+def loadProcess(secs):
+    """
+    Keeps a CPU busy, and churns memory, for secs, standing in for the camera and other programs on the Pi
+    """
+    from time import perf_counter
+    endTime = perf_counter() + secs
+    while perf_counter() < endTime:
+        junk = bytearray(1 << 20)
+        del junk
+
+
+# jitter benchmark: times a stimulus-like loop under CPU and memory load with each real-time setting on its own, and all
+if __name__ == '__main__':
+    import argparse
+    import multiprocessing
+    from time import perf_counter
+    parser = argparse.ArgumentParser(description='Timing jitter with each real-time setting')
+    parser.add_argument('--cpu', type=int, default=max(os.sched_getaffinity(0)), help='CPU to pin the timing loop to')
+    parser.add_argument('--events', type=int, default=2000, help='timed events for each setting')
+    parser.add_argument('--interval', type=float, default=2e-03, help='seconds between timed events')
+    parser.add_argument('--garbage', type=int, default=200, help='reference cycles made between events')
+    parser.add_argument('--load', type=int, default=os.cpu_count(), help='number of CPU load processes')
+    args = parser.parse_args()
+    tests = (('none', False, 0, False, False), ('affinity', True, 0, False, False),
+             ('SCHED_FIFO', False, kPRIORITY, False, False), ('mlockall', False, 0, True, False),
+             ('GC paused', False, 0, False, True), ('all', True, kPRIORITY, True, True))
+    secsPerTest = args.events * args.interval * 1.2 + 1
+    loads = [multiprocessing.Process(target=loadProcess, args=(secsPerTest * len(tests) + 2,), daemon=True)
+             for i in range(args.load)]
+    for load in loads:
+        load.start()
+    print ('{:d} events every {:.1f} ms with {:d} load processes, lateness in us'.format(
+        args.events, args.interval * 1e03, args.load))
+    print ('{:<12}{:>10}{:>10}{:>10}{:>10}   {:s}'.format('setting', 'median', '99%', '99.9%', 'max', 'problems'))
+    for name, doPin, priority, doLock, doPause in tests:
+        realTime = AHF_RealTime(-1 if name == 'none' else args.cpu, priority, doLock, doPause, doPin)
+        startTime = perf_counter()
+        with realTime:
+            lates = timingLoop(args.events, args.interval, garbage=args.garbage)
+        realTime.quit()
+        n = len(lates)
+        print ('{:<12}{:>10.0f}{:>10.0f}{:>10.0f}{:>10.0f}   {:s}'.format(
+            name, lates[n // 2] * 1e06, lates[int(n * 0.99)] * 1e06, lates[int(n * 0.999)] * 1e06,
+            lates[-1] * 1e06, '; '.join(realTime.problems)))
+    for load in loads:
+        load.terminate()
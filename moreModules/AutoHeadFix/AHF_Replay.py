@@ -0,0 +1,367 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import os
+import sys
+import json
+import difflib
+import contextlib
+import importlib.util
+from bisect import bisect_right
+from time import perf_counter
+from statistics import median
+
+from AHF_Settings import SETTINGS_SCHEMA
+
+"""
+Pins and settings for the simulated cage. The pin numbers only need to be different from each other
+"""
+kCAGEDICT = {'Pistons Pin': 12, 'Reward Pin': 13, 'Tag In Range Pin': 21, 'Head Contact Pin': 20, 'LED Pin': 23,
+             'Serial Port': '/dev/simulated', 'Event Database': False, 'Fleet Host': '', 'Metrics Port': 0,
+             'Stall Secs': 3600.0}
+"""
+Modules whose time functions are replaced with the virtual clock. Only modules run by the main thread are listed, so
+threads like the settings watcher and watchdog keep real time and do not move the virtual clock
+"""
+kPATCHED = ('AHF_main', 'AHF_Rewarder', 'AHF_Stimulator', 'AHF_Stimulator_Rewards', 'AHF_Stimulator_LEDs', 'AHF_Mouse',
+            'AHF_MouseHistory', 'AHF_Camera', 'AHF_LickDetector', 'AHF_Stimulator_Reactive',
+            'AHF_Stimulator_LickReward', 'AHF_GPIOTrace')
+kCLOCKNAMES = ('time', 'sleep', 'perf_counter', 'monotonic', 'localtime', 'time_ns')
+kSETTLESECS = 0.15  # runTrial sleeps this long after energizing the pistons before logging check+ or check-
+kTRIALEVENTS = ('check+', 'check-', 'check No Fix Trial')
+
+
+def readLog(logPath):
+    """
+    Reads a headFix log file as a list of (tag, time, event), skipping lines that are not in that format
+    """
+    events = []
+    with open(logPath, 'r', errors='replace') as fp:
+        for line in fp:
+            fields = line.rstrip('\n').split('\t', 2)
+            if len(fields) < 3:
+                continue
+            try:
+                events.append((int(fields[0]), float(fields[1]), fields[2]))
+            except ValueError:
+                continue
+    return events
+
+
+def makeScript(events, cageDict=kCAGEDICT):
+    """
+    Turns the events of a log into the edges a mouse would have made on the tag-in-range and head contact pins
+
+    A mouse enters just before its entry event, with its tag readable at the same time. It touches the contacts just
+    before each trial event, long enough before a check+ or check- for the pistons to settle, lets go just before the
+    check for a check-, and just after a complete, and leaves at its exit event
+    :returns: list of (time, pin, level), list of (time, tag) for tags to be read, and list of (time, is a head fix trial)
+    """
+    tirPin = cageDict['Tag In Range Pin']
+    contactPin = cageDict['Head Contact Pin']
+    edges = []
+    tags = []
+    trials = []
+    isTouching = False
+    for tag, eventTime, event in events:
+        if event == 'entry':
+            edges.append((eventTime - 1e-03, tirPin, 1))
+            tags.append((eventTime - 1e-03, tag))
+        elif event == 'exit':
+            if isTouching:
+                edges.append((eventTime - 2e-03, contactPin, 0))
+                isTouching = False
+            edges.append((eventTime, tirPin, 0))
+        elif event in kTRIALEVENTS:
+            isHeadFix = event != 'check No Fix Trial'
+            touchTime = eventTime - (kSETTLESECS + 1e-03 if isHeadFix else 1e-03)
+            edges.append((touchTime, contactPin, 1))
+            trials.append((touchTime, isHeadFix))
+            if event == 'check-':
+                edges.append((touchTime + kSETTLESECS / 2, contactPin, 0))
+            else:
+                isTouching = True
+        elif event == 'complete' and isTouching:
+            edges.append((eventTime + 1e-03, contactPin, 0))
+            isTouching = False
+    return edges, tags, trials
+
+
+def inferSettings(events):
+    """
+    Guesses experiment settings for AHF_Stimulator_Rewards from a log
+
+    nRewards and rewardInterval are from the reward events in trials. propHeadFix is only 0 or 1 if the log has only one
+    kind of trial, as the replay chooses head fix or not by returning 0 or nearly 1 from random
+    :returns: dictionary of experiment settings, as in an experiment config file
+    """
+    kinds = set(event for tag, eventTime, event in events if event in kTRIALEVENTS)
+    if 'check No Fix Trial' not in kinds:
+        propHeadFix = 1.0
+    elif len(kinds) == 1:
+        propHeadFix = 0.0
+    else:
+        propHeadFix = 0.5
+    nRewardsList = []
+    intervals = []
+    rewardTimes = None
+    for tag, eventTime, event in events:
+        if event in kTRIALEVENTS:
+            rewardTimes = []
+        elif event == 'reward' and rewardTimes is not None:
+            rewardTimes.append(eventTime)
+        elif event == 'complete' and rewardTimes is not None:
+            nRewardsList.append(len(rewardTimes))
+            intervals.extend(rewardTimes[i + 1] - rewardTimes[i] for i in range(len(rewardTimes) - 1))
+            rewardTimes = None
+    stimParams = {'nRewards': int(median(nRewardsList)) if nRewardsList else 5,
+                  'rewardInterval': round(median(intervals), 2) if intervals else 2.5}
+    return {'stimulator': 'AHF_Stimulator_Rewards', 'stimParams': stimParams, 'propHeadFix': propHeadFix}
+
+
+def eventKeys(events):
+    """
+    Returns (tag, event) for each event, with runs of 6 or more digits, like the time in a video file name, replaced by #
+    """
+    keys = []
+    for tag, eventTime, event in events:
+        normalized = []
+        digits = ''
+        for char in event:
+            if char.isdigit():
+                digits += char
+                continue
+            normalized.append('#' if len(digits) >= 6 else digits)
+            digits = ''
+            normalized.append(char)
+        normalized.append('#' if len(digits) >= 6 else digits)
+        keys.append((tag, ''.join(normalized)))
+    return keys
+
+
+def diffLogs(originalEvents, replayEvents, nShow=10):
+    """
+    Compares the events of two logs, by tag and event, and the times of matching events
+
+    Session start and end events are not compared, as the replay starts and ends its own sessions
+    :returns: dictionary of numbers of events compared in each log, numbers of matching, missing and extra events, the
+    median and max time difference of matching events in seconds, and up to nShow lines of differences in unified diff format
+    """
+    originalEvents = [event for event in originalEvents if event[2] not in ('SeshStart', 'SeshEnd')]
+    replayEvents = [event for event in replayEvents if event[2] not in ('SeshStart', 'SeshEnd')]
+    originalKeys = eventKeys(originalEvents)
+    replayKeys = eventKeys(replayEvents)
+    matcher = difflib.SequenceMatcher(None, originalKeys, replayKeys, autojunk=False)
+    timeErrors = []
+    nMissing = 0
+    nExtra = 0
+    for tagOp, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tagOp == 'equal':
+            timeErrors.extend(abs(replayEvents[j][1] - originalEvents[i][1]) for i, j in zip(range(i1, i2), range(j1, j2)))
+        else:
+            nMissing += i2 - i1
+            nExtra += j2 - j1
+    diffLines = [line for line in difflib.unified_diff(
+        ['{:013}\t{:s}'.format(*key) for key in originalKeys], ['{:013}\t{:s}'.format(*key) for key in replayKeys],
+        'original', 'replay', n=1, lineterm='') if not line.startswith('@@')]
+    return {'nOriginal': len(originalEvents), 'nReplay': len(replayEvents),
+            'matching': len(timeErrors), 'missing': nMissing, 'extra': nExtra,
+            'medianTimeError': median(timeErrors) if timeErrors else float('nan'),
+            'maxTimeError': max(timeErrors) if timeErrors else float('nan'), 'diff': diffLines[2:2 + nShow]}
+
+
+def patchClock(modules, simGPIO):
+    """
+    Replaces the time functions each module imported from the time module with those of the virtual clock
+    """
+    import time as realTime
+    for module in modules:
+        for name in kCLOCKNAMES:
+            if getattr(module, name, None) is getattr(realTime, name):
+                setattr(module, name, getattr(simGPIO, name))
+
+
+def replay(logPath, outPath, configPath=None, verbose=False):
+    """
+    Re-runs the entries and trials of a day's log through AutoHeadFix's main loop, on simulated hardware and a virtual clock
+
+    A cage config and experiment config are written in outPath, which is also the data folder for the run, and
+    AutoHeadFix is started unattended from there, in this process, with the AHF_SIM environment variable set so
+    hardware modules are replaced by AHF_SimGPIO. The head fix choice that is made at random is made as in the log.
+    The run ends when the virtual clock passes the last event of the log.
+    :param logPath: path to a headFix_<cageID>_<date>.txt log file
+    :param outPath: folder for the config files and data of the run, made if needed
+    :param configPath: experiment config file to use, with texting and UDP turned off, default is settings for
+    AHF_Stimulator_Rewards guessed from the log by inferSettings
+    :param verbose: if True, what AutoHeadFix prints is shown
+    :returns: the events of the log, the events of the log made by the replay, and the real seconds the run took
+    """
+    events = readLog(logPath)
+    if len(events) == 0:
+        raise ValueError('No events in ' + logPath)
+    fileName = os.path.basename(logPath)
+    cageID = fileName[len('headFix_'):].rsplit('_', 1)[0] if fileName.startswith('headFix_') else 'replay'
+    outPath = os.path.abspath(outPath)
+    os.makedirs(outPath, exist_ok=True)
+    cageDict = dict(kCAGEDICT)
+    cageDict.update({'Cage ID': cageID, 'Path to Save Data': os.path.join(outPath, 'data') + '/'})
+    if configPath is None:
+        expDict = inferSettings(events)
+    else:
+        with open(configPath, 'r') as fp:
+            expDict = json.loads(fp.read())
+    expDict.update({'hasTextMsg': False, 'hasUDP': False})
+    thisDir = os.path.dirname(os.path.abspath(__file__))
+    if thisDir not in sys.path:
+        sys.path.insert(0, thisDir)
+    oldDir = os.getcwd()
+    os.chdir(outPath)
+    try:
+        with open('AHFconfig.jsn', 'w') as fp:
+            fp.write(json.dumps(cageDict))
+        with open('AFHexp_replay.jsn', 'w') as fp:
+            fp.write(json.dumps(expDict))
+        os.environ['AHF_SIM'] = '1'
+        os.environ['AHF_EXP'] = 'replay'
+        import AHF_SimGPIO
+        sys.modules['picamera'] = AHF_SimGPIO
+        spec = importlib.util.spec_from_file_location('AHF_main', os.path.join(thisDir, '__main__.py'))
+        mainModule = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mainModule)
+        sys.modules['AHF_main'] = mainModule
+        modules = []
+        for moduleName in kPATCHED:
+            modules.append(importlib.import_module(moduleName))
+        patchClock(modules, AHF_SimGPIO)
+
+        # closed-loop stimulators wait for sensor events on the virtual clock, moving it to the next scripted edge, when
+        # sensor callbacks may queue an event, or to the timeout, whichever is sooner
+        def simWaitForEvent(stimulator, timeout):
+            if stimulator.queue.empty():
+                AHF_SimGPIO.advance(min(AHF_SimGPIO.now + timeout, AHF_SimGPIO.nextEdgeTime()))
+            return None if stimulator.queue.empty() else stimulator.queue.get_nowait()
+        sys.modules['AHF_Stimulator_Reactive'].AHF_Stimulator_Reactive.waitForEvent = simWaitForEvent
+
+        # the simulated cage has no pi user, files are owned by whoever runs the replay
+        class Owner:
+            pw_uid = os.getuid()
+            gr_gid = os.getgid()
+        mainModule.getpwnam = mainModule.getgrnam = lambda name: Owner
+        edges, tags, trials = makeScript(events, cageDict)
+        trialTimes = [trial[0] for trial in trials]
+        nextTrial = [0]  # the scripted trial main will run next, in a list so the functions below can change it
+        runTrial = mainModule.runTrial
+
+        def scriptedRunTrial(*args, **kwargs):
+            # the trial being run is the last one whose contact has been made, whether or not earlier ones were run
+            nextTrial[0] = bisect_right(trialTimes, AHF_SimGPIO.now)
+            try:
+                return runTrial(*args, **kwargs)
+            finally:
+                nextTrial[0] = max(nextTrial[0], bisect_right(trialTimes, AHF_SimGPIO.now))
+
+        def scriptedRandom():
+            # head fix or not for the next trial, as it was in the log. main draws after an entrance reward too, which
+            # can end after the contact for the next trial was made, so the next trial is the next one not yet run
+            iTrial = nextTrial[0]
+            return 0.0 if iTrial < len(trials) and trials[iTrial][1] else 1.0 - 1e-09
+        mainModule.runTrial = scriptedRunTrial
+        mainModule.random = scriptedRandom
+        AHF_SimGPIO.reset(events[0][1] - 1.0, events[-1][1] + 1.0)
+        AHF_SimGPIO.script(edges)
+        for tagTime, tag in tags:
+            AHF_SimGPIO.scriptTag(tagTime, tag)
+        startTime = perf_counter()
+        with contextlib.redirect_stdout(sys.stdout if verbose else open(os.devnull, 'w')):
+            try:
+                mainModule.main()
+            except AHF_SimGPIO.AHF_ReplayEnd:
+                pass
+        runSecs = perf_counter() - startTime
+    finally:
+        os.chdir(oldDir)
+    replayEvents = []
+    for folder, subFolders, fileNames in os.walk(cageDict['Path to Save Data']):
+        for fileName in sorted(fileNames):
+            if fileName.startswith('headFix_'):
+                replayEvents.extend(readLog(os.path.join(folder, fileName)))
+    replayEvents.sort(key=lambda event: event[1])
+    return events, replayEvents, runSecs
+
+
+def makeTestLog(logPath, nHours=12.0, nMice=8, seed=1):
+    """
+    Writes a made up day's log, for testing the replay, with entries, entrance rewards, head fix and no fix trials
+
+    Entrance rewards follow the rule in main, with the default settings the replay uses: a mouse gets one entryRewardDelay
+    after it enters, if it is still in the tube and has not touched the contacts, up to maxEntryRewards a day, so a
+    replay of the log should match it
+    """
+    import random
+    rng = random.Random(seed)
+    entryRewardDelay = SETTINGS_SCHEMA['entryRewardDelay'][1]
+    maxEntryRewards = SETTINGS_SCHEMA['maxEntryRewards'][1]
+    entranceRewardTime = SETTINGS_SCHEMA['entranceRewardTime'][1]
+    entryRewardsDict = {}  # tag: entrance rewards given
+    lines = []
+    eventTime = 1.7e09
+    lines.append((0, eventTime, 'SeshStart'))
+    while eventTime < 1.7e09 + nHours * 3600:
+        eventTime += rng.expovariate(1 / 120)
+        tag = 1000 + rng.randrange(nMice)
+        entryTime = eventTime
+        lines.append((tag, entryTime, 'entry'))
+        entryLines = []
+        firstTouch = None
+        for iTrial in range(rng.randrange(4)):
+            eventTime += rng.uniform(0.6, 5.0) if iTrial > 0 else rng.uniform(0.6, 2.0)
+            kind = rng.choice(('check+', 'check+', 'check-', 'check No Fix Trial'))
+            if firstTouch is None:
+                # when the mouse touches the contacts, as makeScript works it out from the time in the log
+                firstTouch = round(eventTime, 2) - (kSETTLESECS + 1e-03 if kind != 'check No Fix Trial' else 1e-03)
+            entryLines.append((tag, eventTime, kind))
+            if kind == 'check-':
+                continue
+            entryLines.append((tag, eventTime + 1e-03, '{:d}_stim_{:d}.h264'.format(tag, int(eventTime))))
+            for iReward in range(5):
+                entryLines.append((tag, eventTime + 0.01 + iReward * 2.5, 'reward'))
+            eventTime += 12.6
+            entryLines.append((tag, eventTime, 'complete'))
+        eventTime += rng.uniform(0.6, 10)
+        rewardTime = round(entryTime, 2) + entryRewardDelay
+        if (firstTouch is None or firstTouch > rewardTime) and eventTime > rewardTime and \
+                entryRewardsDict.get(tag, 0) < maxEntryRewards:
+            lines.append((tag, rewardTime + entranceRewardTime, 'entryReward'))
+            entryRewardsDict[tag] = entryRewardsDict.get(tag, 0) + 1
+        lines.extend(entryLines)
+        lines.append((tag, eventTime, 'exit'))
+    with open(logPath, 'w') as fp:
+        for tag, eventTime, event in lines:
+            fp.write('{:013}\t{:.2f}\t{:s}\n'.format(tag, eventTime, event))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Replay a day of an AutoHeadFix log through the main loop on simulated hardware')
+    parser.add_argument('logPath', help='headFix_<cageID>_<date>.txt log file, or test to make up and replay a test log')
+    parser.add_argument('outPath', help='folder for the config files and data of the replay')
+    parser.add_argument('--config', help='experiment config file to use, default is guessed from the log')
+    parser.add_argument('--verbose', action='store_true', help='show what AutoHeadFix prints')
+    parser.add_argument('--diff', type=int, default=20, help='number of lines of differences to show')
+    args = parser.parse_args()
+    logPath = args.logPath
+    if logPath == 'test':
+        os.makedirs(args.outPath, exist_ok=True)
+        logPath = os.path.join(args.outPath, 'headFix_test_19700101.txt')
+        makeTestLog(logPath)
+    events, replayEvents, runSecs = replay(logPath, args.outPath, args.config, args.verbose)
+    result = diffLogs(events, replayEvents, args.diff)
+    simHours = (events[-1][1] - events[0][1]) / 3600
+    print ('{:d} events in log, {:d} in replay, not counting session start and end: {:d} matching, {:d} missing, {:d} extra'.format(
+        result['nOriginal'], result['nReplay'], result['matching'], result['missing'], result['extra']))
+    print ('time difference of matching events: median {:.3f} secs, max {:.3f} secs'.format(
+        result['medianTimeError'], result['maxTimeError']))
+    print ('{:.1f} simulated hours in {:.1f} secs, {:.1f} simulated hours per sec'.format(
+        simHours, runSecs, simHours / runSecs))
+    if len(result['diff']) > 0:
+        print ('\n'.join(result['diff']))
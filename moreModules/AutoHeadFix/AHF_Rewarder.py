@@ -1,6 +1,82 @@
 #! /usr/bin/python
-import RPi.GPIO as GPIO
+from AHF_LazyImport import lazy_import
+GPIO = lazy_import('RPi.GPIO')
 from time import sleep
+import os
+import pwd
+import grp
+import json
+
+
+class AHF_RewardLedger (object):
+    """
+    Running totals of the rewards given to one mouse, the count, solenoid open time, and volume of each reward type
+
+    Totals are added to as each reward is given, so any total, for a type or over all types, is had without adding up.
+    """
+
+    def __init__(self, typeDict=None):
+        """
+        Makes a new ledger, empty or with totals loaded from a saved ledger
+
+        :param typeDict: dictionary of reward type: [count, secs, uL], as from toDict, or None for an empty ledger
+        """
+        self.typeDict = {}
+        self.count = 0
+        self.duration = 0.0
+        self.volume = 0.0
+        if typeDict is not None:
+            for rewardName, (count, duration, volume) in typeDict.items():
+                self.typeDict[rewardName] = [int(count), float(duration), float(volume)]
+                self.count += int(count)
+                self.duration += float(duration)
+                self.volume += float(volume)
+
+    def add(self, rewardName, duration, volume):
+        """
+        Adds a reward to the totals
+
+        :param duration: solenoid open time, in seconds
+        :param volume: volume in uL, or None if the solenoid is not calibrated
+        """
+        entry = self.typeDict.get(rewardName)
+        if entry is None:
+            entry = self.typeDict[rewardName] = [0, 0.0, 0.0]
+        entry[0] += 1
+        entry[1] += duration
+        self.count += 1
+        self.duration += duration
+        if volume is not None:
+            entry[2] += volume
+            self.volume += volume
+
+    def getCount(self, rewardName=None):
+        """Returns the number of rewards of a type, or of all types if rewardName is None"""
+        if rewardName is None:
+            return self.count
+        return self.typeDict.get(rewardName, (0, 0.0, 0.0))[0]
+
+    def getDuration(self, rewardName=None):
+        """Returns the solenoid open time in seconds for rewards of a type, or of all types if rewardName is None"""
+        if rewardName is None:
+            return self.duration
+        return self.typeDict.get(rewardName, (0, 0.0, 0.0))[1]
+
+    def getVolume(self, rewardName=None):
+        """Returns the volume in uL of rewards of a type, or of all types if rewardName is None"""
+        if rewardName is None:
+            return self.volume
+        return self.typeDict.get(rewardName, (0, 0.0, 0.0))[2]
+
+    def toDict(self):
+        return {rewardName: list(entry) for rewardName, entry in self.typeDict.items()}
+
+    def toStr(self):
+        """
+        Returns a formatted string of the count, time, and volume of each reward type
+        """
+        return '\t'.join('{:s}:{:d} {:.3f}s {:.1f}uL'.format(rewardName, count, duration, volume)
+                         for rewardName, (count, duration, volume) in self.typeDict.items())
 
 
 class AHF_Rewarder:
@@ -12,56 +88,167 @@ class AHF_Rewarder:
     type that have been delivered. The Rewarder class is inited with a default duration to be used if
     a non-existent key is later requested, and the pin number of the GPIO pin used to
     control the solenoid. Be sure to run GPIO.setmode and GPIO.setup before using the rewarder
-    TODO:1)include a measure of flow rate and record/return values in litres delivered, not
-    seconds open.2)make doReward threaded, so main program does not have to stop for long reards
+    With an AHF_FlowCalibration for the valve, reward sizes can be given in uL, and the volume of each reward type is
+    worked out when the type is added, so each reward adds its volume to running totals for the cage.
+    Each reward is also added to the AHF_RewardLedger of the current mouse, set with setCurrentMouse, whatever gave the
+    reward, the main loop or a stimulator. Ledgers are kept by tag, and saved and loaded with saveLedgers and loadLedgers.
+    TODO: make doReward threaded, so main program does not have to stop for long reards
     """
 
-    def __init__(self, defaultTimeVal, rewardPin):
+    def __init__(self, defaultTimeVal, rewardPin, flowCalibration=None):
         """
         Makes a new Rewarder object with a GPIO pin and default opening time
 
         :param defaultTimeVal: opening suration to be used if requested reward Type is not in dictionary
         :param rewardPin: GPIO pin number connected to the solenoid
+        :param flowCalibration: AHF_FlowCalibration for the solenoid, or None if not calibrated, when volumes are not tracked
         :return: returns nothing
         """
+        self.flowCalibration = flowCalibration
         self.rewardDict = {'default': defaultTimeVal}
+        self.volumeDict = {'default': self.volumeOf(defaultTimeVal)}
         self.totalsDict = {'default': 0}
+        self.totalDur = 0.0
+        self.totalVolume = 0.0
+        self.ledgers = {}  # tag: AHF_RewardLedger for each mouse
+        self.ledger = None  # ledger of the mouse in the chamber
         self.rewardPin = rewardPin
         GPIO.setup(self.rewardPin, GPIO.OUT, initial=GPIO.LOW)
 
-    def addToDict(self, rewardName, rewardSize):
+    def volumeOf(self, duration):
+        """
+        Returns the volume in uL of an opening of a duration in seconds, or None if the solenoid is not calibrated
+        """
+        if self.flowCalibration is None:
+            return None
+        return self.flowCalibration.volumeFor(duration)
+
+    def addToDict(self, rewardName, rewardSize, rewardVolume=0.0):
         """
         Adds a new reward type with defined size to the dictionary of reward sizes
 
         param: rewardName: name of new reward type to add
         param:rewardSize: opening duration of solenoid, in seconds        
+        param:rewardVolume: volume in uL, used instead of rewardSize if greater than 0 and the solenoid is calibrated
         """
-        self.rewardDict.update({rewardName: rewardSize})
+        self.setRewardSize(rewardName, rewardSize, rewardVolume)
         self.totalsDict.update({rewardName: 0})
 
-    def giveReward(self, rewardName):
+    def setRewardSize(self, rewardName, rewardSize, rewardVolume=0.0):
+        """
+        Sets the size of a reward type, keeping the count of rewards of that type given so far
+
+        param:rewardSize: opening duration of solenoid, in seconds
+        param:rewardVolume: volume in uL, used instead of rewardSize if greater than 0 and the solenoid is calibrated
+        :raises ValueError: if rewardVolume is more than the largest volume the solenoid was calibrated for
+        """
+        if rewardVolume > 0:
+            if self.flowCalibration is None:
+                print ('Solenoid is not calibrated, ' + rewardName + ' rewards will be {:.3f} secs'.format(rewardSize))
+            else:
+                rewardSize = self.flowCalibration.durationFor(rewardVolume)
+        self.rewardDict.update({rewardName: rewardSize})
+        self.volumeDict.update({rewardName: self.volumeOf(rewardSize)})
+
+    def setCurrentMouse(self, mouse):
+        """
+        Sets the mouse whose ledger each reward is added to, or None for no mouse, when rewards go in no ledger
+
+        The mouse keeps its ledger too, for Mouse.waterVolume
+        """
+        self.ledger = None if mouse is None else self.ledgerFor(mouse.tag)
+        if mouse is not None:
+            mouse.ledger = self.ledger
+
+    def ledgerFor(self, tag):
+        """
+        Returns the AHF_RewardLedger of a mouse, making an empty one if the mouse has had no rewards
+        """
+        ledger = self.ledgers.get(tag)
+        if ledger is None:
+            ledger = self.ledgers[tag] = AHF_RewardLedger()
+        return ledger
+
+    def clearLedgers(self):
+        """
+        Empties the ledgers of all the mice, done at the start of every day
+        """
+        self.ledgers = {}
+        self.ledger = None
+
+    def saveLedgers(self, filePath):
+        """
+        Saves the ledgers of all the mice to a json file, written to a temporary file first so a crash never leaves half a file
+        """
+        isNew = not os.path.exists(filePath)
+        with open(filePath + '.tmp', 'w') as fp:
+            fp.write(json.dumps({str(tag): ledger.toDict() for tag, ledger in self.ledgers.items()}))
+        os.replace(filePath + '.tmp', filePath)
+        if isNew:
+            try:
+                os.chown(filePath, pwd.getpwnam('pi').pw_uid, grp.getgrnam('pi').gr_gid)
+            except (KeyError, OSError):
+                pass
+
+    def loadLedgers(self, filePath):
+        """
+        Loads ledgers saved with saveLedgers, e.g., on a restart, keeping none if the file does not exist
+
+        :returns: number of ledgers loaded
+        :raises ValueError: if the file can not be read as ledgers
+        """
+        self.clearLedgers()
+        try:
+            with open(filePath, 'r') as fp:
+                data = json.loads(fp.read())
+        except FileNotFoundError:
+            return 0
+        try:
+            for tag, typeDict in data.items():
+                self.ledgers[int(tag)] = AHF_RewardLedger(typeDict)
+        except (TypeError, ValueError, AttributeError) as anError:
+            self.clearLedgers()
+            raise ValueError('Bad reward ledger file ' + filePath + ': ' + str(anError))
+        return len(self.ledgers)
+
+    def giveReward(self, rewardName, rewardVolume=None):
         """
         Gives a reward of the requested type, if the requested reward type is found in the dictionary
 
         If the requested reward type is not found, the default reward size is used
         param:rewardName: the tyoe of the reward to be given, should already be in dictionary
+        param:rewardVolume: volume in uL to give instead of the size of the reward type, needs a calibrated solenoid
+        :returns: the opening duration, in seconds
+        :raises ValueError: if a volume is given and the solenoid is not calibrated, or not calibrated for that much water
         """
-        if rewardName in self.rewardDict:
+        if rewardVolume is not None:
+            if self.flowCalibration is None:
+                raise ValueError('Solenoid is not calibrated, can not give a reward of {:.2f} uL'.format(rewardVolume))
+            sleepTime = self.flowCalibration.durationFor(rewardVolume)
+        elif rewardName in self.rewardDict:
             sleepTime = self.rewardDict.get(rewardName)
+            rewardVolume = self.volumeDict.get(rewardName)
         else:
             sleepTime = self.rewardDict.get('default')
+            rewardVolume = self.volumeDict.get('default')
         GPIO.output(self.rewardPin, 1)
         sleep(sleepTime)  # not very accurate timing, but good enough
         GPIO.output(self.rewardPin, 0)
         self.totalsDict[rewardName] += 1
+        self.totalDur += sleepTime
+        if rewardVolume is not None:
+            self.totalVolume += rewardVolume
+        if self.ledger is not None:
+            self.ledger.add(rewardName, sleepTime, rewardVolume)
         return sleepTime
 
     def getTotalDur(self):
         """Returns the total duration in seconds of solenoid openings, of all reward types"""
-        total = 0
-        for key in self.totalsDict.keys():
-            total += self.totalsDict[key] * self.rewardDict[key]
-        return total
+        return self.totalDur
+
+    def getTotalVolume(self):
+        """Returns the total volume in uL of water given, of all reward types, 0 if the solenoid is not calibrated"""
+        return self.totalVolume
 
     def getNumOfType(self, rewardName):
         """
@@ -75,7 +262,11 @@ class AHF_Rewarder:
         """
         Sets number of rewards of a particular type, if, for example, a rewarder is associated with an existing mouse
         """
+        change = rewardNum - self.totalsDict.get(rewardName, 0)
         self.totalsDict[rewardName] = rewardNum
+        self.totalDur += change * self.rewardDict[rewardName]
+        if self.volumeDict[rewardName] is not None:
+            self.totalVolume += change * self.volumeDict[rewardName]
 
     def zeroTotals(self):
         """
@@ -85,6 +276,8 @@ class AHF_Rewarder:
         """
         for key in self.totalsDict.keys():
             self.totalsDict[key] = 0
+        self.totalDur = 0.0
+        self.totalVolume = 0.0
 
     def totalsToStr(self):
         """
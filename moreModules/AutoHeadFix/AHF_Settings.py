@@ -4,11 +4,46 @@
 import os
 import sys
 import json
+import pickle
+import hashlib
 import pwd
 import grp
 
 from AHF_Stimulator import AHF_Stimulator
-from AHF_Camera import AHF_Camera
+from AHF_TrialProfiler import softwareVersion
+
+
+"""
+Schema for experiment config files, key: (type, default or None if required, key of a bool setting that must be True
+for this setting to be used or None, (minimum, maximum) or None). Settings are checked in this order.
+"""
+SETTINGS_SCHEMA = {
+    'entranceRewardTime': (float, 30e-03, None, (0, 10)),
+    'taskRewardTime': (float, 30e-03, None, (0, 10)),
+    'entranceRewardVolume': (float, 0.0, None, (0, 100)),
+    'taskRewardVolume': (float, 0.0, None, (0, 100)),
+    'maxEntryRewards': (int, 100, None, (0, 100000)),
+    'entryRewardDelay': (float, 0.5, None, (0, 3600)),
+    'propHeadFix': (float, 1.0, None, (0, 1)),
+    'skeddadleTime': (float, 0.25, None, (0, 3600)),
+    'inChamberTimeLimit': (float, 600, None, (0, 86400)),
+    'hasTextMsg': (bool, False, None, None),
+    'phoneList': (tuple, None, 'hasTextMsg', None),
+    'hasUDP': (bool, False, None, None),
+    'UDPList': (tuple, None, 'hasUDP', None),
+    'UDPGroup': (str, '', 'hasUDP', None),
+    'cameraStartDelay': (float, None, 'hasUDP', (0, 60)),
+    'camParams': (dict, {}, None, None),
+    'stimulator': (str, None, None, None),
+    'stimParams': (dict, {}, None, None)
+}
+
+
+def schemaHash():
+    """
+    Returns a hash of SETTINGS_SCHEMA, that changes if any setting is added or removed, or has its type, default, or range changed
+    """
+    return hashlib.sha1(repr(SETTINGS_SCHEMA).encode('utf-8')).hexdigest()
 
 
 class AHF_Settings (object):
@@ -20,7 +55,9 @@ class AHF_Settings (object):
         """
         Makes a new settings object, loading from a given file, letting user choose from existing files, or making new settings from user
 
-        Will try to load a file if file name is passed in, 
+        Will try to load a file if file name is passed in, without asking the user anything, so AutoHeadFix can restart unattended
+        :param fileName: name of an experiment config file, with or without the AFHexp_ prefix and .jsn extension, or None to choose from the user
+        :raises ValueError: if settings in the file are missing or of the wrong type
         """
         if fileName is not None:
             self.load(fileName)
@@ -62,6 +99,10 @@ class AHF_Settings (object):
             input('Solenoid opening duration, in seconds, for entrance rewards:'))
         self.taskRewardTime = float(
             input('Solenoid opening duration,in seconds, for task rewards:'))
+        self.entranceRewardVolume = float(
+            input('Volume, in uL, for entrance rewards, used instead of the duration if the solenoid is calibrated, or 0:'))
+        self.taskRewardVolume = float(
+            input('Volume, in uL, for task rewards, used instead of the duration if the solenoid is calibrated, or 0:'))
         self.maxEntryRewards = int(
             input('Maximum number of entry rewards that will be given per day:'))
         self.entryRewardDelay = float(
@@ -85,7 +126,8 @@ class AHF_Settings (object):
             self.inChamberTimeLimit = float(
                 input('In-Chamber duration limit, seconds, before stopping head-fix trials:'))
        # Camera related settings, in a dictionary, static function, don't need
-       # a camera object to be created
+       # a camera object to be created, but does need picamera, so import it only now
+        from AHF_Camera import AHF_Camera
         self.camParamsDict = AHF_Camera.dict_from_user({})
         # UDP stuff - make a tuple of IP address of other computers
         tempInput = input(
@@ -94,6 +136,8 @@ class AHF_Settings (object):
         if self.hasUDP == True:
             self.UDPList = tuple(
                 input('IP addresses of Pis running secondary cameras:').split(','))
+            self.UDPGroup = input(
+                'Multicast group or broadcast address to trigger all cameras with one message, or enter to use the list:')
             self.cameraStartDelay = float(
                 input('Delay in seconds between sending UDP and toggling blue LED.'))
         # Stimulator class
@@ -125,6 +169,8 @@ class AHF_Settings (object):
         configDict = {}
         configDict['entranceRewardTime'] = self.entranceRewardTime
         configDict['taskRewardTime'] = self.taskRewardTime
+        configDict['entranceRewardVolume'] = self.entranceRewardVolume
+        configDict['taskRewardVolume'] = self.taskRewardVolume
         configDict['maxEntryRewards'] = self.maxEntryRewards
         configDict['entryRewardDelay'] = self.entryRewardDelay
         configDict['propHeadFix'] = self.propHeadFix
@@ -136,6 +182,7 @@ class AHF_Settings (object):
         configDict['hasUDP'] = self.hasUDP
         if self.hasUDP == True:
             configDict['UDPList'] = self.UDPList
+            configDict['UDPGroup'] = self.UDPGroup
             configDict['cameraStartDelay'] = self.cameraStartDelay
         configDict['camParams'] = self.camParamsDict
         configDict['stimulator'] = self.stimulator
@@ -151,32 +198,129 @@ class AHF_Settings (object):
             os.chown(newConfig, uid, gid)
 
     def load(self, file):
+        """
+        Loads settings from a json experiment config file, checking them against SETTINGS_SCHEMA
+
+        The checked settings are cached in a hidden file next to the config file, keyed by the modification time and size of the
+        config file, the schema, and the software version, so an unchanged config file is not re-parsed and re-checked on the next start
+        :param file: name of the config file, with or without the AFHexp_ prefix and .jsn extension
+        :raises ValueError: if settings in the file are missing or of the wrong type
+        """
+        file = AHF_Settings.find_file(file)
+        self.fileName = file
+        self.set_from_dict(AHF_Settings.load_cached(file))
+
+    def set_from_dict(self, configDict):
+        """
+        Sets all the settings from a dictionary that has already been checked with validate
+
+        :param configDict: dictionary as returned by validate or load_cached
+        """
+        self.entranceRewardTime = configDict['entranceRewardTime']
+        self.taskRewardTime = configDict['taskRewardTime']
+        self.entranceRewardVolume = configDict['entranceRewardVolume']
+        self.taskRewardVolume = configDict['taskRewardVolume']
+        self.maxEntryRewards = configDict['maxEntryRewards']
+        self.entryRewardDelay = configDict['entryRewardDelay']
+        self.propHeadFix = configDict['propHeadFix']
+        self.skeddadleTime = configDict['skeddadleTime']
+        self.inChamberTimeLimit = configDict['inChamberTimeLimit']
+        self.hasTextMsg = configDict['hasTextMsg']
+        if self.hasTextMsg == True:
+            self.phoneList = configDict['phoneList']
+        self.hasUDP = configDict['hasUDP']
+        if self.hasUDP == True:
+            self.UDPList = configDict['UDPList']
+            self.UDPGroup = configDict['UDPGroup']
+            self.cameraStartDelay = configDict['cameraStartDelay']
+        self.camParamsDict = configDict['camParams']
+        self.stimulator = configDict['stimulator']
+        self.stimDict = configDict['stimParams']
+
+    @staticmethod
+    def find_file(name):
+        """
+        Returns the name of an experiment config file in the current directory, given either the full name or the part between AFHexp_ and .jsn
+
+        :raises FileNotFoundError: if there is no such file
+        """
+        for fileName in (name, 'AFHexp_' + name + '.jsn', 'AFHexp_' + name, name + '.jsn'):
+            if os.path.isfile(fileName):
+                return fileName
+        raise FileNotFoundError('No experiment config file named ' + name)
+
+    @staticmethod
+    def load_cached(file):
+        """
+        Returns the checked settings dictionary for a config file, from the cache if the cache matches the file's modification time and size,
+        the schema, and the software version
+
+        :param file: name of the config file
+        :raises ValueError: if settings in the file are missing or of the wrong type
+        """
+        fileStat = os.stat(file)
+        # a hash of the whole schema, with types, defaults and ranges, and the software version that did the checking
+        # are part of the key, so a cache checked against other rules is not used
+        fileKey = (fileStat.st_mtime_ns, fileStat.st_size, schemaHash(), softwareVersion())
+        cachePath = os.path.join(os.path.dirname(file), '.' + os.path.basename(file) + '.cache')
+        try:
+            with open(cachePath, 'rb') as fp:
+                cacheKey, configDict = pickle.load(fp)
+            if cacheKey == fileKey:
+                return configDict
+        except Exception:
+            pass
         with open(file, 'r') as fp:
-            configDict = json.loads(fp.read())
-            fp.close()
-            self.fileName = file
-            self.entranceRewardTime = float(
-                configDict.get('entranceRewardTime', 30e-03))
-            self.taskRewardTime = float(
-                configDict.get('taskRewardTime', 30e-03))
-            self.maxEntryRewards = int(configDict.get('maxEntryRewards', 100))
-            self.entryRewardDelay = float(
-                configDict.get('entryRewardDelay', 0.5))
-            self.propHeadFix = float(configDict.get('propHeadFix', 1.0))
-            self.skeddadleTime = float(configDict.get('skeddadleTime', 0.25))
-            self.inChamberTimeLimit = float(
-                configDict.get('inChamberTimeLimit', 600))
-            self.hasTextMsg = bool(configDict.get('hasTextMsg', False))
-            if self.hasTextMsg == True:
-                self.phoneList = tuple(configDict.get('phoneList'))
-            self.hasUDP = bool(configDict.get('hasUDP', False))
-            if self.hasUDP == True:
-                self.UDPList = tuple(configDict.get('UDPList'))
-                self.cameraStartDelay = float(
-                    configDict.get('cameraStartDelay'))
-            self.camParamsDict = configDict.get('camParams', {})
-            self.stimulator = configDict.get('stimulator')
-            self.stimDict = configDict.get('stimParams')
+            configDict = AHF_Settings.validate(json.loads(fp.read()))
+        try:
+            with open(cachePath, 'wb') as fp:
+                pickle.dump((fileKey, configDict), fp, pickle.HIGHEST_PROTOCOL)
+        except IOError:
+            pass  # no cache, we just check the file again next time
+        return configDict
+
+    @staticmethod
+    def validate(configDict):
+        """
+        Checks a dictionary loaded from a json experiment config file against SETTINGS_SCHEMA
+
+        Missing optional settings get their default values, and values are converted to the types in the schema
+        :param configDict: dictionary as loaded from the json file
+        :returns: a new dictionary with every setting in the schema that applies, converted to the right type
+        :raises ValueError: listing every setting that is missing, of the wrong type, or out of range
+        """
+        checkedDict = {}
+        errors = []
+        for key, (kind, default, condition, limits) in SETTINGS_SCHEMA.items():
+            if condition is not None and checkedDict.get(condition) != True:
+                continue
+            value = configDict.get(key, default)
+            if value is None:
+                errors.append(key + ' is missing')
+                continue
+            try:
+                if kind is tuple:
+                    if isinstance(value, str):
+                        value = value.split(',')
+                    value = tuple(str(x) for x in value)
+                elif kind is dict:
+                    if not isinstance(value, dict):
+                        raise ValueError
+                    value = dict(value)
+                elif kind is bool and isinstance(value, str):
+                    value = value[0] in 'YyTt1'
+                else:
+                    value = kind(value)
+            except (ValueError, TypeError, IndexError):
+                errors.append(key + ' = ' + str(value) + ' is not a ' + kind.__name__)
+                continue
+            if limits is not None and not limits[0] <= value <= limits[1]:
+                errors.append(key + ' = ' + str(value) + ' is not between ' + str(limits[0]) + ' and ' + str(limits[1]))
+                continue
+            checkedDict[key] = value
+        if len(errors) > 0:
+            raise ValueError('Bad experiment settings: ' + '; '.join(errors))
+        return checkedDict
 
     def show(self):
         """
@@ -188,7 +332,9 @@ class AHF_Settings (object):
         print ('****************Current Auto-Head-Fix experiment Settings********************************')
         print ('1:Entrance Reward Time (secs) =' +
                str(self.entranceRewardTime))
+        print ('\t1_a:Entrance Reward Volume (uL, 0 to use time) =' + str(self.entranceRewardVolume))
         print ('2:Task Reward Time (secs) =' + str(self.taskRewardTime))
+        print ('\t2_a:Task Reward Volume (uL, 0 to use time) =' + str(self.taskRewardVolume))
         print ('3:Maximum Daily Entry Rewards =' + str(self.maxEntryRewards))
         print ('4:Entry Reward Delay (secs) =' + str(self.entryRewardDelay))
         print ('5:Proportion of Contacts to Head Fix (0-1) =' +
@@ -208,6 +354,8 @@ class AHF_Settings (object):
             print ('\t9_a:List of ip addresses for UDP = ' + str(self.UDPList))
             print ('\t9_b:Camera start to LED ON delay (secs) =' +
                    str(self.cameraStartDelay))
+            print ('\t9_c:Multicast group or broadcast address for UDP = ' +
+                   str(self.UDPGroup))
         print ('10:Stimulator = ' + self.stimulator)
         i = 0
         for key in sorted(self.stimDict.keys()):
@@ -236,9 +384,15 @@ class AHF_Settings (object):
             elif editNum == '1':
                 self.entranceRewardTime = float(
                     input('Solenoid opening duration, in seconds, for entrance rewards:'))
+            elif editNum == '1a':
+                self.entranceRewardVolume = float(
+                    input('Volume, in uL, for entrance rewards, used instead of the duration if the solenoid is calibrated, or 0:'))
             elif editNum == '2':
                 self.taskRewardTime = float(
                     input('Solenoid opening duration,in seconds, for task rewards:'))
+            elif editNum == '2a':
+                self.taskRewardVolume = float(
+                    input('Volume, in uL, for task rewards, used instead of the duration if the solenoid is calibrated, or 0:'))
             elif editNum == '3':
                 self.maxEntryRewards = int(
                     input('Maximum number of entry rewards that will be given per day:'))
@@ -282,6 +436,9 @@ class AHF_Settings (object):
             elif editNum == '9b':
                 self.cameraStartDelay = float(
                     input('Delay in seconds between sending UDP and toggling blue LED.'))
+            elif editNum == '9c':
+                self.UDPGroup = input(
+                    'Multicast group or broadcast address to trigger all cameras with one message, or enter to use the list:')
             elif editNum == '10':
                 self.stimulator = AHF_Stimulator.get_stimulator_from_user()
                 editVal = editVal | 2
@@ -0,0 +1,186 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import os
+import threading
+from time import time, sleep
+
+from AHF_Settings import AHF_Settings
+from AHF_Stimulator import AHF_Stimulator
+
+"""
+Settings that need objects made at start up (notifier, UDP trigger, camera) and so are not changed by reloading, only by a restart
+"""
+kRESTARTATTRS = ('hasTextMsg', 'phoneList', 'hasUDP', 'UDPList', 'UDPGroup', 'camParamsDict')
+
+
+class AHF_SettingsWatcher (object):
+    """
+    Watches an experiment config file, AFHexp_*.jsn, and reloads it when it changes, without stopping the trial loop
+
+    A thread checks the modification time and size of the file every pollSecs. When they change, the thread loads the file
+    and checks it with AHF_Settings.validate. Checked settings wait as pending until the main loop calls apply between trials,
+    so a trial never sees a mix of old and new settings. Files that fail the check are reported and ignored.
+    """
+
+    def __init__(self, fileName, pollSecs=1.0):
+        """
+        Makes a new watcher for a config file and starts its thread
+
+        :param fileName: name of the experiment config file that was loaded, as in AHF_Settings.fileName
+        :param pollSecs: time between checks of the file
+        """
+        self.fileName = fileName
+        self.pollSecs = pollSecs
+        self.pending = None  # (checked settings dictionary, time the change was seen), read by apply
+        self.fileKey = self.getFileKey()
+        self.nApplied = 0
+        self.nRejected = 0
+        self.isRunning = True
+        self.thread = threading.Thread(target=self.watchLoop, daemon=True)
+        self.thread.start()
+
+    def getFileKey(self):
+        """
+        Returns modification time and size of the watched file, or None if it can not be read
+        """
+        try:
+            fileStat = os.stat(self.fileName)
+            return (fileStat.st_mtime_ns, fileStat.st_size)
+        except OSError:
+            return None
+
+    def watchLoop(self):
+        """
+        Run by the watcher thread, checks the file every pollSecs, and makes changed, checked settings pending
+        """
+        while self.isRunning:
+            sleep(self.pollSecs)
+            fileKey = self.getFileKey()
+            if fileKey is None or fileKey == self.fileKey:
+                continue
+            self.fileKey = fileKey
+            try:
+                self.pending = (AHF_Settings.load_cached(self.fileName), time())
+            except (ValueError, OSError) as anError:
+                self.nRejected += 1
+                print ('Changed settings in ' + self.fileName + ' not loaded: ' + str(anError))
+
+    def apply(self, expSettings, rewarder, stimulator):
+        """
+        Applies pending settings, if there are any, and returns the stimulator to use from now on
+
+        Called from the main loop between trials. Reward sizes in the rewarder are updated in place, so reward counts are kept.
+        The stimulator is re-configured with change_config if only its settings changed, or a new stimulator is made if the
+        stimulator class changed. Settings in kRESTARTATTRS keep their old values. If a reward volume is more than the
+        solenoid was calibrated for, or the stimulator can not be made or configured, all the old settings are kept.
+        :param expSettings: the AHF_Settings object in use
+        :param rewarder: the AHF_Rewarder in use
+        :param stimulator: the stimulator in use
+        :returns: the stimulator to use, a new one if the stimulator class was changed
+        """
+        pending = self.pending
+        if pending is None:
+            return stimulator
+        self.pending = None
+        configDict, changeTime = pending
+        oldVars = dict(vars(expSettings))
+        oldStimDict = dict(stimulator.configDict)
+        expSettings.set_from_dict(configDict)
+        for attr in kRESTARTATTRS:
+            if attr in oldVars and getattr(expSettings, attr, None) != oldVars[attr]:
+                print ('Change to ' + attr + ' will be used after AutoHeadFix is restarted')
+                setattr(expSettings, attr, oldVars[attr])
+        try:
+            rewarder.setRewardSize('entrance', expSettings.entranceRewardTime, expSettings.entranceRewardVolume)
+            rewarder.setRewardSize('task', expSettings.taskRewardTime, expSettings.taskRewardVolume)
+            if expSettings.stimulator != oldVars['stimulator']:
+                newStimulator = AHF_Stimulator.get_class(expSettings.stimulator)(
+                    expSettings.stimDict, rewarder, expSettings.logFP)
+                stimulator.quitting()
+                stimulator = newStimulator
+            elif expSettings.stimDict != oldStimDict:
+                stimulator.change_config(expSettings.stimDict)
+        except Exception as anError:
+            print ('Could not apply changed reward or stimulator settings, keeping old settings: ' + str(anError))
+            stimulator.change_config(oldStimDict)
+            vars(expSettings).clear()
+            vars(expSettings).update(oldVars)
+            rewarder.setRewardSize('entrance', expSettings.entranceRewardTime, expSettings.entranceRewardVolume)
+            rewarder.setRewardSize('task', expSettings.taskRewardTime, expSettings.taskRewardVolume)
+            self.nRejected += 1
+            return stimulator
+        expSettings.stimDict = stimulator.configDict
+        self.nApplied += 1
+        print ('Settings reloaded from ' + self.fileName + ' {:.3f} secs after change was seen'.format(time() - changeTime))
+        return stimulator
+
+    def quit(self):
+        """
+        Stops the watcher thread
+        """
+        self.isRunning = False
+
+
+# for testing purposes, rewrites a config file many times while a stand-in for the trial loop runs, and checks that
+# every trial runs, that settings only change between trials, and how long changes take to be applied
+if __name__ == '__main__':
+    import json
+
+    class RewardDictHolder:
+        def __init__(self, expSettings):
+            self.rewardDict = {'default': 30e-03, 'entrance': expSettings.entranceRewardTime,
+                               'task': expSettings.taskRewardTime}
+
+        def setRewardSize(self, rewardName, rewardSize, rewardVolume=0.0):
+            self.rewardDict[rewardName] = rewardSize
+
+    fileName = 'AFHexp_watcherTest.jsn'
+    configDict = {'stimulator': 'AHF_Stimulator', 'stimParams': {'version': 0}, 'taskRewardTime': 0.0}
+    with open(fileName, 'w') as fp:
+        fp.write(json.dumps(configDict))
+    expSettings = AHF_Settings(fileName)
+    expSettings.logFP = None
+    rewarder = RewardDictHolder(expSettings)
+    stimulator = AHF_Stimulator(expSettings.stimDict, rewarder, None)
+    watcher = AHF_SettingsWatcher(fileName, pollSecs=0.01)
+    nVersions = 50
+    writeTimes = []
+    applyLatencies = []
+    nTrials = 0
+    nMixed = 0
+    lastVersion = 0
+
+    def writer():
+        for version in range(1, nVersions + 1):
+            sleep(0.05)
+            configDict['stimParams']['version'] = version
+            configDict['taskRewardTime'] = version * 1e-03
+            with open(fileName + '.tmp', 'w') as fp:
+                fp.write(json.dumps(configDict))
+            os.replace(fileName + '.tmp', fileName)
+            writeTimes.append(time())
+    writerThread = threading.Thread(target=writer)
+    writerThread.start()
+    while writerThread.is_alive() or lastVersion < nVersions:
+        nApplied = watcher.nApplied
+        stimulator = watcher.apply(expSettings, rewarder, stimulator)
+        if watcher.nApplied > nApplied:
+            applyLatencies.append(time() - writeTimes[-1])
+        # a trial, settings must not change during it, and must match each other
+        version = stimulator.configDict['version']
+        if abs(rewarder.rewardDict['task'] - version * 1e-03) > 1e-09:
+            nMixed += 1
+        sleep(2e-03)
+        if stimulator.configDict['version'] != version:
+            nMixed += 1
+        lastVersion = version
+        nTrials += 1
+    watcher.quit()
+    os.remove(fileName)
+    os.remove('.' + fileName + '.cache')
+    applyLatencies.sort()
+    print ('trials run:', nTrials, ' settings versions written:', nVersions, ' applied:', watcher.nApplied,
+           ' rejected:', watcher.nRejected, ' trials with mixed settings:', nMixed)
+    print ('write to apply latency, median {:.1f} ms, max {:.1f} ms'.format(
+        applyLatencies[len(applyLatencies) // 2] * 1e03, applyLatencies[-1] * 1e03))
@@ -0,0 +1,315 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+"""
+Simulated cage hardware on a virtual clock, used instead of RPi.GPIO, serial and picamera when the AHF_SIM environment
+variable is set, e.g. by AHF_Replay
+
+The module-level functions have the same names and arguments as those in RPi.GPIO. Inputs change only by scripted edges,
+(time, pin, level), or by inject. Nothing waits in real time: sleep and wait_for_edge move the virtual clock forward,
+applying scripted edges as they are passed, and each reading of the clock moves it forward by kTICK, so busy-waits end.
+Serial is a stand-in for serial.Serial that reads tags scripted with scriptTag, and PiCamera is a stand-in for
+picamera.PiCamera that writes empty video files. When the clock passes the end time, AHF_ReplayEnd is raised, once.
+"""
+import time as realTime
+from bisect import insort
+
+BCM = 11
+BOARD = 10
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+RISING = 31
+FALLING = 32
+BOTH = 33
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RPI_INFO = {'TYPE': 'simulated'}
+VERSION = 'AHF_SimGPIO'
+
+kTICK = 1e-06  # seconds the clock moves each time it is read
+
+
+class AHF_ReplayEnd (BaseException):
+    """
+    Raised when the virtual clock passes the end time. Derived from BaseException, not Exception, so it is not caught
+    by the except Exception handlers in the main loop, and stops the program as a KeyboardInterrupt at the menu would
+    """
+    pass
+
+
+now = 0.0  # virtual time, seconds since the epoch
+endTime = float('inf')
+isEnded = False
+levels = {}  # pin: current level
+directions = {}  # pin: IN or OUT
+edges = []  # scripted (time, pin, level) in time order, not yet applied
+iEdge = 0  # index of the next scripted edge
+detectDict = {}  # pin: [edge, list of callbacks, event detected flag]
+outputCounts = {}  # pin: number of times output was set HIGH
+tagBytes = b''  # bytes waiting to be read from the simulated tag reader serial port
+tagScript = []  # scripted (time, bytes) in time order, added to tagBytes when the clock passes their time
+iTag = 0
+
+
+def reset(startTime, stopTime=float('inf')):
+    """
+    Sets the virtual clock to startTime, with the end at stopTime, and clears all pins, scripts and callbacks
+    """
+    global now, endTime, isEnded, edges, iEdge, tagBytes, tagScript, iTag
+    now = startTime
+    endTime = stopTime
+    isEnded = False
+    levels.clear()
+    directions.clear()
+    detectDict.clear()
+    outputCounts.clear()
+    edges = []
+    iEdge = 0
+    tagBytes = b''
+    tagScript = []
+    iTag = 0
+
+
+def script(edgeList):
+    """
+    Adds scripted input edges, a list of (time, pin, level), to those already scripted
+    """
+    global edges, iEdge
+    edges = sorted(edges[iEdge:] + list(edgeList))
+    iEdge = 0
+
+
+def scriptTag(tagTime, tag):
+    """
+    Scripts a tag to be readable from the serial port from tagTime, formatted as an ID-20LA tag reader sends it
+    """
+    insort(tagScript, (tagTime, b'\x02' + '{:010X}'.format(tag).encode('ascii') + b'00\r\n\x03'))
+
+
+def inject(pin, level):
+    """
+    Sets an input pin to a level now, running any edge detection callbacks
+    """
+    setLevel(pin, level)
+
+
+def setLevel(pin, level):
+    oldLevel = levels.get(pin, LOW)
+    levels[pin] = level
+    if level == oldLevel:
+        return
+    detect = detectDict.get(pin)
+    if detect is not None and (detect[0] == BOTH or detect[0] == (RISING if level == HIGH else FALLING)):
+        detect[2] = True
+        for callback in detect[1]:
+            callback(pin)
+
+
+def advance(toTime):
+    """
+    Moves the virtual clock forward to toTime, applying scripted edges and tags as they are passed
+
+    :raises AHF_ReplayEnd: the first time the clock passes endTime
+    """
+    global now, iEdge, iTag, tagBytes, isEnded
+    while iEdge < len(edges) and edges[iEdge][0] <= toTime:
+        edgeTime, pin, level = edges[iEdge]
+        iEdge += 1
+        now = max(now, edgeTime)
+        setLevel(pin, level)
+    while iTag < len(tagScript) and tagScript[iTag][0] <= toTime:
+        tagBytes += tagScript[iTag][1]
+        iTag += 1
+    now = max(now, toTime)
+    if now > endTime and not isEnded:
+        isEnded = True
+        raise AHF_ReplayEnd()
+
+
+def nextEdgeTime():
+    """
+    Returns the time of the next scripted edge, on any pin, or infinity if there are no more
+    """
+    return edges[iEdge][0] if iEdge < len(edges) else float('inf')
+
+
+# clock functions, AHF_Replay puts these in place of the ones from the time module
+def time():
+    advance(now + kTICK)
+    return now
+
+
+def time_ns():
+    return int(time() * 1e09)
+
+
+def perf_counter():
+    return time()
+
+
+def monotonic():
+    return time()
+
+
+def sleep(secs):
+    advance(now + max(0.0, secs))
+
+
+def localtime(secs=None):
+    return realTime.localtime(now if secs is None else secs)
+
+
+# RPi.GPIO functions
+def setmode(mode):
+    pass
+
+
+def setwarnings(flag):
+    pass
+
+
+def setup(pin, direction, pull_up_down=PUD_OFF, initial=LOW):
+    directions[pin] = direction
+    if direction == OUT:
+        levels[pin] = initial
+    elif pin not in levels:
+        levels[pin] = HIGH if pull_up_down == PUD_UP else LOW
+
+
+def output(pin, value):
+    if value and not levels.get(pin, LOW):
+        outputCounts[pin] = outputCounts.get(pin, 0) + 1
+    levels[pin] = HIGH if value else LOW
+
+
+def input(pin):
+    advance(now)
+    return levels.get(pin, LOW)
+
+
+def wait_for_edge(channel, edge, bouncetime=None, timeout=None):
+    """
+    Moves the clock to the next scripted edge of the given kind on the pin, or on by timeout ms if there is none sooner
+
+    :returns: the pin if an edge was found, else None
+    """
+    stopTime = endTime + 1.0 if timeout is None else now + timeout / 1000
+    level = levels.get(channel, LOW)
+    for i in range(iEdge, len(edges)):
+        edgeTime, pin, newLevel = edges[i]
+        if edgeTime > stopTime:
+            break
+        if pin == channel:
+            if newLevel != level and (edge == BOTH or edge == (RISING if newLevel == HIGH else FALLING)):
+                advance(edgeTime)
+                return channel
+            level = newLevel
+    advance(stopTime)
+    return None
+
+
+def add_event_detect(channel, edge, callback=None, bouncetime=None):
+    detectDict[channel] = [edge, [] if callback is None else [callback], False]
+
+
+def add_event_callback(channel, callback):
+    detectDict[channel][1].append(callback)
+
+
+def remove_event_detect(channel):
+    detectDict.pop(channel, None)
+
+
+def event_detected(channel):
+    detect = detectDict.get(channel)
+    if detect is None or not detect[2]:
+        return False
+    detect[2] = False
+    return True
+
+
+def cleanup(channel=None):
+    if channel is None:
+        detectDict.clear()
+    else:
+        detectDict.pop(channel, None)
+
+
+class Serial (object):
+    """
+    Stand-in for serial.Serial, reading scripted tags
+    """
+
+    def __init__(self, port=None, baudrate=9600, timeout=None):
+        self.port = port
+
+    def isOpen(self):
+        return True
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def flushInput(self):
+        global tagBytes
+        advance(now)
+        tagBytes = b''
+
+    def inWaiting(self):
+        advance(now)
+        return len(tagBytes)
+
+    def read(self, size=1):
+        global tagBytes
+        advance(now)
+        data = tagBytes[:size]
+        tagBytes = tagBytes[size:]
+        return data
+
+
+class PiCamera (object):
+    """
+    Stand-in for picamera.PiCamera, with the attributes AHF_Camera sets, that writes an empty file for each video
+    """
+
+    def __init__(self):
+        self.resolution = (640, 480)
+        self.framerate = 30
+        self.iso = 0
+        self.shutter_speed = 30000
+        self.awb_mode = 'auto'
+        self.awb_gains = (1.0, 1.0)
+        self.exposure_mode = 'auto'
+        self.analog_gain = 1.0
+        self.digital_gain = 1.0
+        self.led = False
+        self.preview = None
+        self.ports = set()  # splitter ports that are recording
+
+    @property
+    def recording(self):
+        return len(self.ports) > 0
+
+    def start_preview(self, **kwargs):
+        self.preview = True
+
+    def stop_preview(self):
+        self.preview = None
+
+    def start_recording(self, output, format=None, splitter_port=1, **kwargs):
+        open(output, 'wb').close()
+        self.ports.add(splitter_port)
+
+    def wait_recording(self, timeout=0, splitter_port=1):
+        sleep(timeout)
+
+    def stop_recording(self, splitter_port=1):
+        self.ports.discard(splitter_port)
+
+    def close(self):
+        pass
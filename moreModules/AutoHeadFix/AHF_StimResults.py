@@ -0,0 +1,279 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import os
+import pwd
+import grp
+import json
+import queue
+import struct
+import threading
+from time import time
+import numpy as np
+
+"""
+Stim results file format: kMAGIC, the length of a JSON header, the header, with the results fields, then fixed-size
+records of kRECORDHEAD plus the fields, each the totals of a mouse after a trial, appended as trials end
+"""
+kMAGIC = b'AHFR'
+kHEADERLEN = struct.Struct('<I')
+kRECORDHEAD = [('time', '<f8'), ('tag', '<u8')]
+kCAPACITY = 64  # mice with rows made at first, doubled when more are seen
+
+
+def fieldDtype(fields):
+    """
+    Returns the numpy dtype of a stimulator's results fields
+
+    :param fields: tuple of (name, numpy type, count), e.g. (('stimCount', '<u4', 1), ('LCR', '<u4', 3))
+    """
+    return [(name, kind) if count == 1 else (name, kind, (count,)) for name, kind, count in fields]
+
+
+class AHF_StimRecord (object):
+    """
+    The results of one mouse, a row of an AHF_StimResults, used as a mouse's stimResultsDict
+
+    Works like the dictionary stimulators used before, with get, update, in, and iterating over keys, but has only the
+    fields the stimulator declared, at a fixed size. A field with a count of one reads as a number, and a field with a
+    larger count as a numpy array that can be changed in place, like the lists stimulators kept.
+    """
+
+    def __init__(self, results, index):
+        self.results = results
+        self.index = index
+
+    def __getitem__(self, key):
+        return self.results.rows[self.index][key]
+
+    def __setitem__(self, key, value):
+        if key not in self.results.fieldNames:
+            raise KeyError(key + ' is not a declared result field of ' + self.results.stimulator)
+        self.results.rows[self.index][key] = value
+
+    def __contains__(self, key):
+        return key in self.results.fieldNames
+
+    def __iter__(self):
+        return iter(self.results.fieldNames)
+
+    def __len__(self):
+        return len(self.results.fieldNames)
+
+    def keys(self):
+        return list(self.results.fieldNames)
+
+    def get(self, key, default=None):
+        return self[key] if key in self.results.fieldNames else default
+
+    def update(self, changesDict):
+        for key, value in changesDict.items():
+            self[key] = value
+
+    def items(self):
+        """
+        Returns (field, value) for each field, with values as plain python numbers and lists
+        """
+        row = self.results.rows[self.index]
+        return [(key, row[key].tolist()) for key in self.results.fieldNames]
+
+
+class AHF_StimResults (object):
+    """
+    Typed, fixed-size per-mouse stimulator results, with an append-only file of each mouse's totals after each trial
+
+    A stimulator declares its result fields, each a name, numpy type, and count, in its resultFields. The totals of all
+    mice are rows of one numpy structured array, so each mouse takes the same few bytes whatever the stimulator does,
+    and mouse.stimResultsDict is an AHF_StimRecord pointing at the mouse's row. After each trial saveTrial queues the
+    mouse's row, with the time and tag, and a writer thread appends it to the file, so the trial never waits on the
+    disk. Loading the file at start-up takes the last record of each mouse as its totals, a torn record at the end, from
+    a crash, is cut off.
+    """
+
+    def __init__(self, filePath, fields, stimulator=''):
+        """
+        Makes new results, loading the totals of each mouse from the file if it exists, and starts the writer thread
+
+        If the file has different fields, from a different version of the stimulator, it is renamed with .old added
+        :param filePath: path of the results file, e.g. dayFolderPath/TextFiles/stimResults_<cage>_<date>_<stimulator>.stim
+        :param fields: tuple of (name, numpy type, count) of each result field
+        :param stimulator: name of the stimulator class, saved in the header
+        """
+        self.filePath = filePath
+        self.fields = tuple((name, kind, count) for name, kind, count in fields)
+        self.fieldNames = tuple(name for name, kind, count in self.fields)
+        self.stimulator = stimulator
+        self.rowDtype = np.dtype(fieldDtype(self.fields))
+        self.recordDtype = np.dtype(kRECORDHEAD + fieldDtype(self.fields))
+        self.rows = np.zeros(kCAPACITY, dtype=self.rowDtype)
+        self.indexDict = {}  # tag: row
+        self.nLoaded = 0
+        self.load()
+        self.queue = queue.Queue()
+        self.nWritten = 0
+        self.thread = threading.Thread(target=self.writeLoop, daemon=True)
+        self.thread.start()
+
+    def header(self):
+        return json.dumps({'stimulator': self.stimulator, 'fields': self.fields}).encode('utf-8')
+
+    def load(self):
+        """
+        Loads each mouse's last record from the file, or writes the header of a new file
+        """
+        header = self.header()
+        try:
+            fileHeader, records, nTorn = AHF_StimResults.readFile(self.filePath)
+            if fileHeader['fields'] != json.loads(header.decode('utf-8'))['fields']:
+                print ('Stim results in ' + self.filePath + ' have different fields, renamed to .old')
+                os.replace(self.filePath, self.filePath + '.old')
+                raise FileNotFoundError
+        except FileNotFoundError:
+            with open(self.filePath, 'wb') as fp:
+                fp.write(kMAGIC + kHEADERLEN.pack(len(header)) + header)
+            try:
+                os.chown(self.filePath, pwd.getpwnam('pi').pw_uid, grp.getgrnam('pi').gr_gid)
+            except (KeyError, OSError):
+                pass
+            return
+        if nTorn > 0:
+            with open(self.filePath, 'r+b') as fp:
+                fp.truncate(os.path.getsize(self.filePath) - nTorn)
+            print ('Cut {:d} torn bytes off the end of stim results {:s}'.format(nTorn, self.filePath))
+        # the last record of each tag, found from the end
+        tags, lastFromEnd = np.unique(records['tag'][::-1], return_index=True)
+        for tag, fromEnd in zip(tags.tolist(), lastFromEnd.tolist()):
+            record = records[len(records) - 1 - fromEnd]
+            index = self.addRow(tag)
+            for name in self.fieldNames:
+                self.rows[index][name] = record[name]
+        self.nLoaded = len(records)
+
+    def addRow(self, tag):
+        index = len(self.indexDict)
+        if index == len(self.rows):
+            self.rows = np.concatenate((self.rows, np.zeros(len(self.rows), dtype=self.rowDtype)))
+        self.indexDict[tag] = index
+        return index
+
+    def recordFor(self, tag, oldResults=None):
+        """
+        Returns the AHF_StimRecord of a mouse, making a row of zeros for a mouse with no results yet
+
+        :param oldResults: results the mouse had before, a dictionary or the record of another stimulator, copied into a
+        new row where fields match, e.g. restored from the journal when the results file was lost
+        """
+        index = self.indexDict.get(tag)
+        if index is None:
+            index = self.addRow(tag)
+            if oldResults is not None:
+                for key, value in oldResults.items():
+                    if key in self.fieldNames:
+                        try:
+                            self.rows[index][key] = value
+                        except (ValueError, TypeError):
+                            pass
+        return AHF_StimRecord(self, index)
+
+    def saveTrial(self, tag):
+        """
+        Queues a record of a mouse's totals, with the time, to be appended to the file, returning without waiting
+        """
+        record = np.zeros(1, dtype=self.recordDtype)
+        record['time'] = time()
+        record['tag'] = tag
+        row = self.rows[self.indexDict[tag]]
+        for name in self.fieldNames:
+            record[name] = row[name]
+        self.queue.put(record.tobytes())
+
+    def writeLoop(self):
+        """
+        Run by the writer thread, appends queued records to the file, all that are waiting in one write
+        """
+        isRunning = True
+        with open(self.filePath, 'ab') as fp:
+            while isRunning:
+                records = [self.queue.get()]
+                while True:
+                    try:
+                        records.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in records:
+                    isRunning = False
+                    records = [record for record in records if record is not None]
+                fp.write(b''.join(records))
+                fp.flush()
+                self.nWritten += len(records)
+
+    def quit(self, waitSecs=10.0):
+        """
+        Writes any queued records and stops the writer thread
+        """
+        self.queue.put(None)
+        self.thread.join(waitSecs)
+
+    @staticmethod
+    def readFile(filePath):
+        """
+        Reads a stim results file
+
+        :returns: (header dictionary, numpy array of records, number of bytes of a torn record at the end)
+        :raises ValueError: if the file is not a stim results file
+        """
+        with open(filePath, 'rb') as fp:
+            data = fp.read()
+        if data[:4] != kMAGIC:
+            raise ValueError(filePath + ' is not a stim results file')
+        headerLen, = kHEADERLEN.unpack_from(data, 4)
+        start = 4 + kHEADERLEN.size + headerLen
+        fileHeader = json.loads(data[4 + kHEADERLEN.size:start].decode('utf-8'))
+        fileHeader['fields'] = [list(field) for field in fileHeader['fields']]
+        recordDtype = np.dtype(kRECORDHEAD + fieldDtype(fileHeader['fields']))
+        nTorn = (len(data) - start) % recordDtype.itemsize
+        records = np.frombuffer(data, dtype=recordDtype, offset=start,
+                                count=(len(data) - start) // recordDtype.itemsize)
+        return fileHeader, records, nTorn
+
+
+# for testing purposes, a colony's worth of trials written and loaded back, with a torn record at the end, and the size
+# of results kept in records compared with the dictionaries stimulators kept before
+if __name__ == '__main__':
+    import sys
+    import random
+    import tempfile
+    from time import perf_counter
+    nTrials = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    fields = (('stimCount', '<u4', 1), ('LCR', '<u4', 3))
+    filePath = os.path.join(tempfile.mkdtemp(), 'stimTest.stim')
+    tags = [2018121000 + i for i in range(100)]
+    results = AHF_StimResults(filePath, fields, 'AHF_Stimulator_LEDs')
+    startTime = perf_counter()
+    for i in range(nTrials):
+        tag = random.choice(tags)
+        stimResults = results.recordFor(tag)
+        # what AHF_Stimulator.configStim and AHF_Stimulator_LEDs.configStim do with mouse.stimResultsDict
+        stimResults.update({'stimCount': stimResults.get('stimCount') + 1})
+        stimArray = stimResults.get('LCR')
+        stimArray[random.randrange(3)] += 5
+        results.saveTrial(tag)
+    trialUs = (perf_counter() - startTime) * 1e06 / nTrials
+    results.quit()
+    print ('{:d} trials, {:.1f} us each for updating and queueing, {:d} records written, {:d} bytes a record'.format(
+        nTrials, trialUs, results.nWritten, results.recordDtype.itemsize))
+    with open(filePath, 'ab') as fp:
+        fp.write(b'\x01' * 7)
+    startTime = perf_counter()
+    loaded = AHF_StimResults(filePath, fields, 'AHF_Stimulator_LEDs')
+    loadMs = (perf_counter() - startTime) * 1e03
+    loaded.quit()
+    print ('loaded {:d} mice from {:d} records in {:.1f} ms'.format(len(loaded.indexDict), loaded.nLoaded, loadMs))
+    matches = all(dict(results.recordFor(tag).items()) == dict(loaded.recordFor(tag).items()) for tag in tags)
+    print ('loaded totals match: ' + str(matches))
+    asDict = {'stimCount': 12345, 'LCR': [1000, 2000, 3000]}
+    dictBytes = sys.getsizeof(asDict) + sum(sys.getsizeof(value) for value in asDict.values()) + \
+        sum(sys.getsizeof(value) for value in asDict['LCR'])
+    print ('results per mouse: {:d} bytes in a row, {:d} bytes as a dictionary'.format(results.rowDtype.itemsize, dictBytes))
+    os.remove(filePath)
+    os.rmdir(os.path.dirname(filePath))
@@ -18,7 +18,11 @@ class AHF_Stimulator (object):
 
     All events and their timings in a head fix, including rewards, are controlled by a Stimulator.
 
+    Results a stimulator keeps for each mouse, in mouse.stimResultsDict, are declared in resultFields, each a name, numpy
+    type, and count, so they can be stored in fixed-size records by AHF_StimResults. A subclass that keeps more results
+    adds its own fields to those of its superclass.
     """
+    resultFields = (('stimCount', '<u4', 1),)
 
     def __init__(self, configDict, rewarder, textfp):
         """
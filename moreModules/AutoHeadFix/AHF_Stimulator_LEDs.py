@@ -4,13 +4,16 @@
 from AHF_Stimulator_Rewards import AHF_Stimulator_Rewards
 from AHF_Rewarder import AHF_Rewarder
 from AHF_Mouse import Mouse, Mice
-import RPi.GPIO as GPIO
+from AHF_LazyImport import lazy_import
+GPIO = lazy_import('RPi.GPIO')
 from time import time, localtime, timezone, sleep
 from datetime import datetime
 from random import random
 
 
 class AHF_Stimulator_LEDs (AHF_Stimulator_Rewards):
+    # rewards given with the left, center, and right LED
+    resultFields = AHF_Stimulator_Rewards.resultFields + (('LCR', '<u4', 3),)
 
     def __init__(self, configDict, rewarder, textfp):
         # init of superclass sets number of rewards  and reward interval
@@ -0,0 +1,118 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+from AHF_Stimulator_Reactive import AHF_Stimulator_Reactive
+from AHF_Rewarder import AHF_Rewarder
+from AHF_Mouse import Mouse
+from AHF_LazyImport import lazy_import
+GPIO = lazy_import('RPi.GPIO')
+from time import time
+
+
+class AHF_Stimulator_LickReward (AHF_Stimulator_Reactive):
+    """
+    Rewards the first lick inside each response window, as soon as the lick is seen
+
+    A trial has nWindows response windows, one every windowInterval secs, each open for windowSecs, with a cue pin, e.g.,
+    an LED or a buzzer, HIGH while the window is open if cuePin is not 0. The first lick in an open window gets a task
+    reward, and a reaction later than maxReactMs after the lick is counted as late. Needs a lick sensor, connected
+    with connect(lickDetector, 'lick').
+    """
+
+    def setup(self):
+        self.nWindows = int(self.configDict.get('nWindows', 5))
+        self.windowInterval = float(self.configDict.get('windowInterval', 2.5))
+        self.windowSecs = float(self.configDict.get('windowSecs', 1.0))
+        self.maxReactMs = float(self.configDict.get('maxReactMs', 5.0))
+        self.cuePin = int(self.configDict.get('cuePin', 0))
+        self.configDict.update({'nWindows': self.nWindows, 'windowInterval': self.windowInterval,
+                                'windowSecs': self.windowSecs, 'maxReactMs': self.maxReactMs, 'cuePin': self.cuePin})
+        self.configDict.update({'trialSecs': self.nWindows * self.windowInterval})
+        super().setup()
+        if self.cuePin != 0:
+            GPIO.setup(self.cuePin, GPIO.OUT, initial=GPIO.LOW)
+
+    @staticmethod
+    def dict_from_user(stimDict):
+        for key, value in (('nWindows', 5), ('windowInterval', 2.5), ('windowSecs', 1.0), ('maxReactMs', 5.0),
+                           ('cuePin', 0)):
+            if not key in stimDict:
+                stimDict.update({key: value})
+        return super(AHF_Stimulator_LickReward, AHF_Stimulator_LickReward).dict_from_user(stimDict)
+
+    def onStart(self):
+        self.isOpen = False
+        self.isRewarded = False
+        self.windowEvents = []  # (time, event) for the log file
+        self.nLate = 0
+        for iWindow in range(self.nWindows):
+            self.schedule(iWindow * self.windowInterval, self.openWindow)
+            self.schedule(iWindow * self.windowInterval + self.windowSecs, self.closeWindow)
+
+    def openWindow(self):
+        self.isOpen = True
+        self.isRewarded = False
+        if self.cuePin != 0:
+            GPIO.output(self.cuePin, GPIO.HIGH)
+
+    def closeWindow(self):
+        if self.cuePin != 0:
+            GPIO.output(self.cuePin, GPIO.LOW)
+        if self.isOpen and not self.isRewarded:
+            self.windowEvents.append((time(), 'no lick'))
+        self.isOpen = False
+
+    def onEvent(self, event):
+        queuedTime, eventTime, kind, level = event
+        if kind != 'lick' or level != GPIO.HIGH or not self.isOpen or self.isRewarded:
+            return
+        # the reaction is the solenoid opening, at the start of giveReward
+        latency = self.reacted(event)
+        self.rewarder.giveReward('task')
+        self.isRewarded = True
+        self.mouse.headFixRewards += 1
+        if latency * 1e03 > self.maxReactMs:
+            self.nLate += 1
+        self.windowEvents.append((eventTime, 'lick reward'))
+
+    def onEnd(self):
+        if self.cuePin != 0:
+            GPIO.output(self.cuePin, GPIO.LOW)
+
+    def logfile(self):
+        for eventTime, event in self.windowEvents:
+            self.logLine(eventTime, event)
+        self.logLine(time(), self.latencyStr() + ' late={:d}'.format(self.nLate))
+        if self.textfp != None:
+            self.textfp.flush()
+
+
+# for testing purposes, runs a trial on simulated hardware, with a made up mouse licking in some windows
+if __name__ == '__main__':
+    import threading
+    from time import sleep
+    import AHF_SimGPIO
+    GPIO._use(AHF_SimGPIO)
+    from AHF_LickDetector import AHF_LickDetector
+    kLICKPIN = 24
+    rewarder = AHF_Rewarder(30e-03, 13)
+    rewarder.addToDict('task', 30e-03)
+    thisMouse = Mouse(2525, 0, 0, 0, 0)
+    lickDetector = AHF_LickDetector(kLICKPIN)
+    stimulator = AHF_Stimulator_LickReward({'nWindows': 5, 'windowInterval': 0.4, 'windowSecs': 0.2}, rewarder, None)
+    stimulator.connect(lickDetector, 'lick')
+
+    def mouseLicks():
+        # licks every 50 ms for the first 3 windows, then stops
+        for i in range(24):
+            AHF_SimGPIO.inject(kLICKPIN, 1)
+            sleep(0.02)
+            AHF_SimGPIO.inject(kLICKPIN, 0)
+            sleep(0.03)
+
+    print (stimulator.configStim(thisMouse))
+    threading.Thread(target=mouseLicks, daemon=True).start()
+    stimulator.run()
+    stimulator.logfile()
+    stimulator.quitting()
+    print ('rewards: ' + str(thisMouse.headFixRewards))
@@ -0,0 +1,204 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+from AHF_Stimulator import AHF_Stimulator
+from AHF_TrialProfiler import percentile
+from AHF_LazyImport import lazy_import
+GPIO = lazy_import('RPi.GPIO')
+import heapq
+from queue import Queue, Empty
+from time import time, perf_counter
+from datetime import datetime
+
+
+class AHF_Stimulator_Reactive (AHF_Stimulator):
+    """
+    Base class for closed-loop stimulators, that react to sensor events during a trial instead of just sleeping
+
+    Sensor events, e.g., lick, contact, and tagInRange, are put in a queue by the threads that see them, each with the
+    time it happened and the perf_counter time it was queued. The run method waits on the queue, with a timeout of the
+    time till the next scheduled action, so it wakes when an event comes or an action is due, and never polls. Subclasses
+    override onStart, to schedule actions for the trial, and onEvent, to react to events, calling reacted with the event
+    when they act on it, so the time from the event being queued to the reaction is recorded. Percentiles of the
+    reaction latencies are written to the log file after each trial by logfile.
+
+    Sources are connected with connect, either a GPIO pin, watched with edge detection only while a trial runs, or an
+    object with a subscribe method that takes a callback(time, level), like AHF_LickDetector.
+
+    The base class stimulator gives no rewards, it only runs for trialSecs, reacting to nothing.
+    """
+
+    def __init__(self, configDict, rewarder, textfp):
+        self.queue = Queue()
+        self.sources = {}  # kind: source, a pin number or an object with a subscribe method
+        self.callbacks = {}  # kind: callback subscribed to a source that is not a pin
+        self.timers = []  # heap of (time, sequence number, action, args)
+        self.nTimers = 0
+        self.latencies = []
+        self.isRunning = False
+        super().__init__(configDict, rewarder, textfp)
+
+    def setup(self):
+        self.trialSecs = float(self.configDict.get('trialSecs', 10.0))
+        self.configDict.update({'trialSecs': self.trialSecs})
+
+    @staticmethod
+    def dict_from_user(stimDict):
+        if not 'trialSecs' in stimDict:
+            stimDict.update({'trialSecs': 10.0})
+        return super(AHF_Stimulator_Reactive, AHF_Stimulator_Reactive).dict_from_user(stimDict)
+
+    def change_config(self, changesDict):
+        super().change_config(changesDict)
+        self.setup()
+
+    def config_from_user(self):
+        super().config_from_user()
+        self.setup()
+
+    def connect(self, source, kind):
+        """
+        Connects a source of sensor events of the given kind, doing nothing if it is already connected
+
+        :param source: a GPIO pin number, or an object with a subscribe method taking a callback(time, level)
+        :param kind: name given to events from this source, e.g., 'lick'
+        """
+        if self.sources.get(kind) == source:
+            return
+        self.disconnect(kind)
+        if not isinstance(source, int):
+            def callback(eventTime, level):
+                self.queue.put((perf_counter(), eventTime, kind, level))
+            source.subscribe(callback)
+            self.callbacks[kind] = callback
+        self.sources[kind] = source
+
+    def disconnect(self, kind):
+        source = self.sources.pop(kind, None)
+        callback = self.callbacks.pop(kind, None)
+        if callback is not None:
+            source.unsubscribe(callback)
+
+    def pinEdge(self, channel):
+        """
+        Called from the GPIO library's thread on an edge of a connected pin
+        """
+        for kind, source in self.sources.items():
+            if source == channel and isinstance(source, int):
+                self.queue.put((perf_counter(), time(), kind, GPIO.input(channel)))
+
+    def schedule(self, delay, action, *args):
+        """
+        Schedules action(*args) to be run delay seconds from now, in the run loop
+        """
+        self.nTimers += 1
+        heapq.heappush(self.timers, (perf_counter() + delay, self.nTimers, action, args))
+
+    def reacted(self, event):
+        """
+        Records the latency of a reaction to an event, call it when acting on an event passed to onEvent
+
+        :returns: the reaction latency, in seconds
+        """
+        latency = perf_counter() - event[0]
+        self.latencies.append(latency)
+        return latency
+
+    def stop(self):
+        """
+        Ends the trial before trialSecs, when the stimulator is done
+        """
+        self.isRunning = False
+
+    def onStart(self):
+        """
+        Called at the start of each trial, before any events, override to schedule actions
+        """
+        pass
+
+    def onEvent(self, event):
+        """
+        Called in the run loop for each sensor event, override to react to events
+
+        :param event: (perf_counter time queued, time, kind, level)
+        """
+        pass
+
+    def onEnd(self):
+        """
+        Called at the end of each trial, override to finish up
+        """
+        pass
+
+    def run(self):
+        """
+        Runs the trial for trialSecs, reacting to events from the queue and running scheduled actions as they come due
+        """
+        # events from between trials are stale
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                break
+        pins = [source for source in self.sources.values() if isinstance(source, int)]
+        for pin in pins:
+            GPIO.add_event_detect(pin, GPIO.BOTH, callback=self.pinEdge)
+        self.timers = []
+        self.latencies = []
+        self.isRunning = True
+        self.schedule(self.trialSecs, self.stop)
+        try:
+            self.onStart()
+            while self.isRunning:
+                now = perf_counter()
+                while self.timers and self.timers[0][0] <= now and self.isRunning:
+                    dueTime, n, action, args = heapq.heappop(self.timers)
+                    action(*args)
+                if not self.isRunning:
+                    break
+                event = self.waitForEvent(max(0.0, self.timers[0][0] - perf_counter()))
+                if event is not None:
+                    self.onEvent(event)
+        finally:
+            self.isRunning = False
+            for pin in pins:
+                GPIO.remove_event_detect(pin)
+            self.onEnd()
+
+    def waitForEvent(self, timeout):
+        """
+        Returns the next event from the queue, waiting up to timeout secs for one, or None if none came
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def logLine(self, eventTime, event):
+        """
+        Writes a line to the log file in the format used by writeToLogFile in __main__.py, and prints it
+        """
+        mStr = '{:013}'.format(self.mouse.tag) + '\t'
+        print (mStr + datetime.fromtimestamp(int(eventTime)).isoformat(' ') + '\t' + event)
+        if self.textfp != None:
+            self.textfp.write(mStr + '{:.2f}'.format(eventTime) + '\t' + event + '\n')
+
+    def latencyStr(self):
+        """
+        Returns the count and median, 90%, 99%, and max of this trial's reaction latencies, in ms, as a short string
+        """
+        latencies = sorted(self.latencies)
+        if len(latencies) == 0:
+            return 'reactions n=0'
+        return 'reactions n={:d} median={:.3f} p90={:.3f} p99={:.3f} max={:.3f} ms'.format(
+            len(latencies), percentile(latencies, 0.5) * 1e03, percentile(latencies, 0.9) * 1e03,
+            percentile(latencies, 0.99) * 1e03, latencies[-1] * 1e03)
+
+    def logfile(self):
+        self.logLine(time(), self.latencyStr())
+        if self.textfp != None:
+            self.textfp.flush()
+
+    def quitting(self):
+        for kind in list(self.sources.keys()):
+            self.disconnect(kind)
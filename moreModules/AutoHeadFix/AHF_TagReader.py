@@ -1,7 +1,8 @@
 #! /usr/bin/python
 #-*-coding: utf-8 -*-
 
-import serial
+from AHF_LazyImport import lazy_import
+serial = lazy_import('serial')
 
 
 class AHF_TagReader:
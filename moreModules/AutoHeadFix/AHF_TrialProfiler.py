@@ -0,0 +1,185 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import os
+import pwd
+import grp
+import subprocess
+from functools import lru_cache
+from array import array
+from time import time, monotonic_ns
+
+"""
+Phases of runTrial that are timed, in the order they are written to the profile file. A phase that did not run in a
+trial, like UDPTrigger with no UDP, or everything after contactCheck for a check- trial, is written as -1
+"""
+kPHASES = ('pistons', 'contactCheck', 'configStim', 'UDPTrigger', 'cameraStart', 'LEDOn', 'stimRun', 'LEDOff',
+           'cameraStop', 'chown', 'logfile', 'skedaddle')
+kVERSION = '1.01a'  # used when the version can not be had from git
+
+
+@lru_cache(maxsize=None)
+def softwareVersion():
+    """
+    Returns the version of AutoHeadFix from git describe, e.g. 1.01a-12-g3f2c1d0, or kVERSION if git can not tell
+
+    git is run once, the first time, as the settings cache, profiler, and self test all ask for the version at start up
+    """
+    try:
+        result = subprocess.run(['git', 'describe', '--tags', '--always', '--dirty'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True, timeout=5)
+        if result.returncode == 0 and result.stdout.strip() != '':
+            return result.stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        pass
+    return kVERSION
+
+
+class AHF_TrialProfiler (object):
+    """
+    Times each phase of runTrial with monotonic nanosecond stamps, and writes one line per trial to a daily profile file
+
+    Stamps go in an array made once, so timing a phase is a dictionary lookup, a clock read and an array store, with no
+    objects made during the trial. The line for a trial is written after the trial is over.
+    """
+
+    def __init__(self):
+        self.phaseDict = {phase: i for i, phase in enumerate(kPHASES)}
+        self.stamps = array('q', [0] * (2 * len(kPHASES)))
+        self.zeroStamps = array('q', [0] * (2 * len(kPHASES)))
+        self.version = softwareVersion()
+        self.fp = None
+        self.tag = 0
+        self.trialTime = 0.0
+
+    def newDay(self, filePath):
+        """
+        Closes the profile file for the old day, if any, and opens the file for the new day, writing a header if it is new
+        """
+        if self.fp is not None:
+            self.fp.close()
+        isNew = not os.path.exists(filePath)
+        self.fp = open(filePath, 'a')
+        if isNew:
+            self.fp.write('time\ttag\tversion\t' + '\t'.join(kPHASES) + '\n')
+            self.fp.flush()
+            try:
+                os.chown(filePath, pwd.getpwnam('pi').pw_uid, grp.getgrnam('pi').gr_gid)
+            except (KeyError, OSError):
+                pass
+
+    def startTrial(self, tag):
+        """
+        Clears the stamps for a new trial
+        """
+        self.stamps[:] = self.zeroStamps
+        self.tag = tag
+        self.trialTime = time()
+
+    def begin(self, phase):
+        self.stamps[2 * self.phaseDict[phase]] = monotonic_ns()
+
+    def end(self, phase):
+        self.stamps[2 * self.phaseDict[phase] + 1] = monotonic_ns()
+
+    def writeTrial(self):
+        """
+        Writes the trial's phase durations to the profile file, in microseconds
+        """
+        if self.fp is None:
+            return
+        durations = []
+        for i in range(len(kPHASES)):
+            if self.stamps[2 * i] == 0 or self.stamps[2 * i + 1] == 0:
+                durations.append('-1')
+            else:
+                durations.append(str((self.stamps[2 * i + 1] - self.stamps[2 * i]) // 1000))
+        self.fp.write('{:.2f}\t{:013}\t'.format(self.trialTime, self.tag) + self.version + '\t' +
+                      '\t'.join(durations) + '\n')
+        self.fp.flush()
+
+    def quit(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+
+def readProfiles(dataPath, cageID=None):
+    """
+    Reads all profile files under a data folder, dataPath/<date>/<cageID>/TextFiles/profile_*.txt
+
+    :returns: dictionary of version: (time the version was first seen, list of per-phase lists of durations in us)
+    """
+    versionDict = {}
+    for folder, subFolders, fileNames in os.walk(dataPath):
+        for fileName in fileNames:
+            if not (fileName.startswith('profile_') and fileName.endswith('.txt')):
+                continue
+            if cageID is not None and not fileName.startswith('profile_' + cageID + '_'):
+                continue
+            with open(os.path.join(folder, fileName), 'r', errors='replace') as fp:
+                fp.readline()  # header
+                for line in fp:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 3 + len(kPHASES):
+                        continue
+                    try:
+                        trialTime = float(fields[0])
+                        durations = [int(x) for x in fields[3:]]
+                    except ValueError:
+                        continue
+                    firstSeen, phaseLists = versionDict.setdefault(fields[2], [trialTime, [[] for p in kPHASES]])
+                    versionDict[fields[2]][0] = min(firstSeen, trialTime)
+                    for phaseList, duration in zip(phaseLists, durations):
+                        if duration >= 0:
+                            phaseList.append(duration)
+    return versionDict
+
+
+def percentile(sortedList, fraction):
+    return sortedList[min(len(sortedList) - 1, int(fraction * len(sortedList)))]
+
+
+def summarize(versionDict, threshold=0.2):
+    """
+    Prints median, 90th and 99th percentile and max of each phase for each version, in order first seen, and flags phases
+    whose median is more than threshold slower than in the version before
+
+    :returns: list of (version, phase, old median, new median) for each regression
+    """
+    regressions = []
+    lastMedians = None
+    for version, (firstSeen, phaseLists) in sorted(versionDict.items(), key=lambda item: item[1][0]):
+        print ('version ' + version + ', {:d} trials'.format(max(len(phaseList) for phaseList in phaseLists)))
+        print ('{:<14}{:>8}{:>10}{:>10}{:>10}{:>10}   (ms)'.format('phase', 'n', 'median', '90%', '99%', 'max'))
+        medians = {}
+        for phase, phaseList in zip(kPHASES, phaseLists):
+            if len(phaseList) == 0:
+                continue
+            phaseList.sort()
+            medians[phase] = percentile(phaseList, 0.5)
+            flag = ''
+            if lastMedians is not None and phase in lastMedians and \
+                    medians[phase] > lastMedians[phase] * (1 + threshold) and medians[phase] - lastMedians[phase] > 100:
+                flag = '  slower, was {:.2f}'.format(lastMedians[phase] / 1000)
+                regressions.append((version, phase, lastMedians[phase], medians[phase]))
+            print ('{:<14}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+                phase, len(phaseList), medians[phase] / 1000, percentile(phaseList, 0.9) / 1000,
+                percentile(phaseList, 0.99) / 1000, phaseList[-1] / 1000) + flag)
+        lastMedians = medians
+    return regressions
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser(description='Per-phase timing of AutoHeadFix trials, by software version')
+    parser.add_argument('dataPath', help='base data folder, containing <date>/<cageID>/TextFiles/profile_*.txt')
+    parser.add_argument('--cage', help='only this cage ID')
+    parser.add_argument('--threshold', type=float, default=0.2, help='fraction slower to count as a regression')
+    args = parser.parse_args()
+    regressions = summarize(readProfiles(args.dataPath, args.cage), args.threshold)
+    if len(regressions) > 0:
+        print (str(len(regressions)) + ' phases slower than in the version before')
+        sys.exit(1)
@@ -3,8 +3,13 @@
 
 
 import socket
+import struct
+import threading
+from time import perf_counter, sleep
 
 UDP_PORT = 5005  # one of many non-assigned port numbers
+# default administratively-scoped multicast group for secondary cameras
+UDP_GROUP = '239.255.0.5'
 
 
 class AHF_UDPTrig:
@@ -13,30 +18,55 @@ class AHF_UDPTrig:
 
     AHF_UDPTrig uses the socket module to do the UDP stuff, but it should be part of
     the default install
+
+    Triggers can be sent to a list of ip addresses, with one sendto per address, or, if a multicast
+    group (e.g. 239.255.0.5) or a broadcast address (e.g. 192.168.0.255) is given, with a single
+    sendto that reaches every secondary camera at once, so start skew does not grow with the number of cameras.
     """
 
-    def __init__(self, UDPlist_p):
+    def __init__(self, UDPlist_p, UDPgroup_p='', UDPport_p=UDP_PORT):
         """Makes a new AHF_UDPtrig object using passed in list of ip addresses.
 
         stores UDPlist in the new object
         sets hasUDP to false if object creation fails because of network error, else True
+        :param UDPlist_p: tuple of ip addresses to send triggers to, used when no group is given
+        :param UDPgroup_p: multicast group or broadcast address for a single-send fan-out, or '' to send to each address in UDPlist
+        :param UDPport_p: port number the secondary cameras listen on
         """
         try:
             self.UDPlist = UDPlist_p
+            self.UDPgroup = UDPgroup_p
+            self.UDPport = UDPport_p
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.sock.bind(('', UDP_PORT))
-            hasUDP = True
+            # bind to any free port, leaving UDPport free for a camera listening on this same Pi
+            self.sock.bind(('', 0))
+            if self.UDPgroup:
+                if AHF_UDPTrig.is_multicast(self.UDPgroup):
+                    # time-to-live of 1 keeps triggers on the local subnet
+                    self.sock.setsockopt(
+                        socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+                    self.sock.setsockopt(
+                        socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+                else:
+                    self.sock.setsockopt(
+                        socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                self.destList = ((self.UDPgroup, self.UDPport),)
+            else:
+                self.destList = tuple(
+                    (address, self.UDPport) for address in self.UDPlist)
+            self.hasUDP = True
         except socket.error:
-            hasUDP = False
+            self.hasUDP = False
             print ('AHF_UDPTrig failed to create a socket.')
 
     def doTrigger(self, message):
         """
-        Sends a UDP message to the stored list of  ip addresses
+        Sends a UDP message to the multicast group, or to the stored list of ip addresses
         """
         try:
-            for address in self.UDPlist:
-                self.sock.sendto(bytes(message, "utf-8"), (address, UDP_PORT))
+            data = bytes(message, "utf-8")
+            for dest in self.destList:
+                self.sock.sendto(data, dest)
         except socket.error:
             print ('AHF_UDPTrig failed to send a message')
 
@@ -48,13 +78,106 @@ class AHF_UDPTrig:
         dataStr = data.decode("utf-8")
         return (addr[0], dataStr)
 
+    @staticmethod
+    def is_multicast(address):
+        """
+        Returns True if address is an IPv4 multicast address, 224.0.0.0 to 239.255.255.255
+        """
+        try:
+            return 224 <= int(address.split('.')[0]) <= 239
+        except ValueError:
+            return False
+
+    @staticmethod
+    def make_listener(port, group='', interface=''):
+        """
+        Makes a UDP socket to receive triggers, as used by a secondary camera
+
+        :param port: port number to listen on
+        :param group: multicast group to join, or '' to receive only unicast and broadcast triggers
+        :param interface: ip address of the interface to listen on, or '' for all interfaces
+        :returns: the bound socket
+        :raises socket.error: if the port can not be bound or the group can not be joined
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if group and AHF_UDPTrig.is_multicast(group):
+            # bind to the port on all addresses so datagrams sent to the group are delivered
+            sock.bind(('', port))
+            mreq = struct.pack('4s4s', socket.inet_aton(group),
+                               socket.inet_aton(interface or '0.0.0.0'))
+            sock.setsockopt(socket.IPPROTO_IP,
+                            socket.IP_ADD_MEMBERSHIP, mreq)
+        else:
+            sock.bind((interface, port))
+        return sock
+
+
+def skewBenchmark(nCamerasList=(1, 2, 4, 8, 16, 32), nTrials=50, port=5011):
+    """
+    Measures start skew, the time between the first and last camera receiving a trigger, against number of cameras
+
+    Each camera is simulated by a thread blocked on a local socket. For sending to a list, each camera
+    binds its own loopback address, 127.0.0.2, 127.0.0.3, etc. For multicast, every camera joins the same group
+    on the loopback interface. Skew printed is median and maximum over nTrials, in microseconds.
+    """
+    def receiver(sock, stamps, index, nMessages):
+        for i in range(nMessages):
+            sock.recv(64)
+            stamps[i][index] = perf_counter()
+
+    print ('cameras\tlist median\tlist max\tgroup median\tgroup max (microseconds)')
+    for nCameras in nCamerasList:
+        results = []
+        for mode in ('list', 'group'):
+            if mode == 'list':
+                socks = [AHF_UDPTrig.make_listener(port, '', '127.0.0.' + str(i + 2))
+                         for i in range(nCameras)]
+                trigger = AHF_UDPTrig(
+                    tuple('127.0.0.' + str(i + 2) for i in range(nCameras)), '', port)
+            else:
+                try:
+                    socks = [AHF_UDPTrig.make_listener(port, UDP_GROUP, '127.0.0.1')
+                             for i in range(nCameras)]
+                except socket.error:
+                    results += [float('nan'), float('nan')]
+                    continue
+                trigger = AHF_UDPTrig((), UDP_GROUP, port)
+                trigger.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                        socket.inet_aton('127.0.0.1'))
+            stamps = [[0.0] * nCameras for i in range(nTrials)]
+            threads = [threading.Thread(target=receiver, args=(sock, stamps, i, nTrials), daemon=True)
+                       for i, sock in enumerate(socks)]
+            for thread in threads:
+                thread.start()
+            for i in range(nTrials):
+                trigger.doTrigger('benchmark')
+                sleep(5e-03)
+            for thread in threads:
+                thread.join(1.0)
+            skews = sorted((max(trial) - min(trial)) * 1e06
+                           for trial in stamps if min(trial) > 0)
+            for sock in socks:
+                sock.close()
+            trigger.sock.close()
+            if len(skews) == 0:
+                results += [float('nan'), float('nan')]
+            else:
+                results += [skews[len(skews) // 2], skews[-1]]
+        print (str(nCameras) + '\t' + '\t'.join('{:.1f}'.format(x) for x in results))
+
 
 # for testing purposes
 if __name__ == '__main__':
-    hasUDP = True
-    trigger = AHF_UDPTrig(('127.0.0.1',))
-
-    if hasUDP == True:
-        message = 'hello_from_AHF_UDPTrig'
-        trigger.doTrigger(message)
-        print (trigger.getTrigger())
+    from sys import argv
+    if len(argv) > 1 and argv[1] == 'bench':
+        skewBenchmark()
+    else:
+        listener = AHF_UDPTrig.make_listener(UDP_PORT, UDP_GROUP)
+        for group in ('', UDP_GROUP):
+            trigger = AHF_UDPTrig(('127.0.0.1',), group)
+            if trigger.hasUDP == True:
+                message = 'hello_from_AHF_UDPTrig'
+                trigger.doTrigger(message)
+                data, addr = listener.recvfrom(1024)
+                print (addr[0], data.decode("utf-8"))
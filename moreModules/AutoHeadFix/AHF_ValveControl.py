@@ -2,8 +2,17 @@
 #-*-coding: utf-8 -*-
 
 
-import RPi.GPIO as GPIO
+from AHF_LazyImport import lazy_import
+GPIO = lazy_import('RPi.GPIO')
 from AHF_CageSet import AHF_CageSet
+from time import sleep
+
+"""
+Opening durations, in seconds, of the batches of openings weighed to calibrate the solenoid, covering the usual reward sizes
+"""
+kCALDURATIONS = (0.01, 0.02, 0.04, 0.08)
+kCALOPENINGS = 100  # openings in a batch, enough that a drop more or less hardly changes the weight
+kCALINTERVAL = 0.2  # secs between openings in a batch, for the drop to fall and the line to refill
 
 if __name__ == '__main__':
     def valveControl():
@@ -11,7 +20,8 @@ if __name__ == '__main__':
         Opens and closes valve, as for testing, or draining the lines
 
         When run as main, valveControl takes no paramaters and first loads/makes the AHF_CageSet instance
-        and sets up GPIO. After setting up, valveControl runs in a loop with options 1 to open, 0 to close, q to quit the program
+        and sets up GPIO. After setting up, valveControl runs in a loop with options 1 to open, 0 to close, c to calibrate,
+        q to quit the program
         """
         cageSet = AHF_CageSet()
         GPIO.setmode(GPIO.BCM)
@@ -34,25 +44,27 @@ else:
 
 def runLoop(cageSet):
     """
-    main loop asks user to open or close solenoid; Opens on 1, closes on 0, quits on q
+    main loop asks user to open or close solenoid; Opens on 1, closes on 0, calibrates flow on c, quits on q
 
     param:cageSet: an instance of AHF_CageSet describing which pin is used for water reward solenoid
     returns:nothing
     """
     try:
         while (True):
-            s = input("1 to open, 0 to close, q to quit: ")
+            s = input("1 to open, 0 to close, c to calibrate flow, q to quit: ")
             if s == '1':
                 print ("valve is open")
                 GPIO.output(cageSet.rewardPin, 1)
             elif s == '0':
                 print ("valve is closed")
                 GPIO.output(cageSet.rewardPin, 0)
+            elif s == 'c':
+                calibrate(cageSet)
             elif s == 'q':
                 print ("AHF_ValveControl quitting")
                 break
             else:
-                print ("I understand 1 for open, 0 for close, q for quit.")
+                print ("I understand 1 for open, 0 for close, c for calibrate, q for quit.")
     except KeyboardInterrupt:
         print ("i also quit")
         return
@@ -62,5 +74,44 @@ def runLoop(cageSet):
             print ('cleanup')
 
 
+def calibrate(cageSet, durations=kCALDURATIONS, nOpenings=kCALOPENINGS, interval=kCALINTERVAL):
+    """
+    Calibrates the flow of the water delivery solenoid, by weighing the water from batches of timed openings
+
+    For each duration, the user puts a weighed tube under the spout, the solenoid is opened nOpenings times for that
+    duration, timed the same way as AHF_Rewarder.giveReward, and the user enters the weight of water collected, 1 mg
+    being 1 uL. The fit is shown, and if the user agrees, saved as the cage's calibration, which AutoHeadFix loads
+    when it starts.
+    param:cageSet: an instance of AHF_CageSet describing which pin is used for water reward solenoid
+    returns: the new AHF_FlowCalibration, or None if too few batches were weighed or it was not saved
+    """
+    from AHF_FlowCalibration import AHF_FlowCalibration, calibrationPath
+    points = []
+    print ('Fill the water line and open the valve till no air comes out before calibrating.')
+    for duration in durations:
+        input('Put a weighed tube under the spout, then press enter to open the valve {:d} times for {:.0f} ms:'.format(
+            nOpenings, duration * 1e03))
+        for i in range(nOpenings):
+            GPIO.output(cageSet.rewardPin, 1)
+            sleep(duration)
+            GPIO.output(cageSet.rewardPin, 0)
+            sleep(interval)
+        weight = input('Enter the weight of water collected, in mg, or nothing to skip this duration:')
+        if weight != '':
+            points.append((duration, nOpenings, float(weight)))
+    try:
+        calibration = AHF_FlowCalibration(points, cageSet.cageID)
+    except ValueError as anError:
+        print ('No calibration made: ' + str(anError))
+        return None
+    print (calibration.residualsStr())
+    print (calibration.describe())
+    inputStr = input('Save this calibration to ' + calibrationPath(cageSet) + ' (Y or N):')
+    if inputStr == '' or not (inputStr[0] == 'y' or inputStr[0] == 'Y'):
+        return None
+    calibration.save(calibrationPath(cageSet))
+    return calibration
+
+
 if __name__ == '__main__':
     valveControl()
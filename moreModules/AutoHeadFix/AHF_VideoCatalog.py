@@ -0,0 +1,162 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import os
+import pwd
+import grp
+import queue
+import sqlite3
+import threading
+from datetime import datetime
+
+
+class AHF_VideoCatalog (object):
+    """
+    SQLite catalog of trial videos, linking each video file to its mouse, stimulus and timing
+
+    runTrial calls addVideo after each trial; the row is written by a writer thread, so the trial never waits on the
+    database or on getting the size of the video file. The catalog has indexes on tag and on start time, so finding all
+    videos for a mouse, a stimulus, or a date range is a query instead of listing folders and parsing file names.
+    """
+
+    def __init__(self, dbPath):
+        """
+        Makes a new catalog, creating the database file and table if needed, and starts the writer thread
+
+        :param dbPath: path to the SQLite database file, e.g. dataPath + 'videoCatalog_' + cageID + '.db'
+        """
+        self.dbPath = dbPath
+        isNew = not os.path.exists(dbPath)
+        AHF_VideoCatalog.connect(dbPath).close()
+        if isNew:
+            # we run AutoHeadFix as root for GPIO, so the pi user is given the new database, like other data files
+            try:
+                os.chown(dbPath, pwd.getpwnam('pi').pw_uid, grp.getgrnam('pi').gr_gid)
+            except (KeyError, OSError):
+                pass
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.writeLoop, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def connect(dbPath):
+        """
+        Opens the database, making the videos table and its indexes if they do not exist
+        """
+        db = sqlite3.connect(dbPath, timeout=10.0)
+        db.execute('CREATE TABLE IF NOT EXISTS videos (tag INTEGER, stim TEXT, startTime REAL, stopTime REAL, '
+                   'ledOnTime REAL, ledOffTime REAL, path TEXT, size INTEGER, duration REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS videos_tag ON videos (tag, startTime)')
+        db.execute('CREATE INDEX IF NOT EXISTS videos_time ON videos (startTime)')
+        db.commit()
+        return db
+
+    def addVideo(self, tag, stimStr, startTime, stopTime, ledOnTime, ledOffTime, videoPath):
+        """
+        Queues a video to be added to the catalog, returning without waiting
+
+        :param tag: RFID tag of the mouse
+        :param stimStr: stimulus string from the stimulator's configStim, as used in the video name
+        :param startTime, stopTime: times recording was started and stopped
+        :param ledOnTime, ledOffTime: times the brain illumination LED was turned on and off
+        :param videoPath: path to the video file
+        """
+        self.queue.put((tag, stimStr, startTime, stopTime, ledOnTime, ledOffTime, videoPath))
+
+    def writeLoop(self):
+        """
+        Run by the writer thread, adds queued videos to the database, all videos waiting in the queue in one transaction
+        """
+        db = AHF_VideoCatalog.connect(self.dbPath)
+        isRunning = True
+        while isRunning:
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            rows = []
+            for item in items:
+                if item is None:
+                    isRunning = False
+                    continue
+                tag, stimStr, startTime, stopTime, ledOnTime, ledOffTime, videoPath = item
+                try:
+                    size = os.path.getsize(videoPath)
+                except OSError:
+                    size = -1
+                rows.append((tag, stimStr, startTime, stopTime, ledOnTime, ledOffTime, videoPath, size,
+                             stopTime - startTime))
+            try:
+                db.executemany('INSERT INTO videos VALUES (?,?,?,?,?,?,?,?,?)', rows)
+                db.commit()
+            except sqlite3.Error as anError:
+                print ('AHF_VideoCatalog could not add videos: ' + str(anError))
+        db.close()
+
+    def quit(self):
+        """
+        Writes any queued videos and stops the writer thread
+        """
+        self.queue.put(None)
+        self.thread.join(10.0)
+
+    @staticmethod
+    def query(dbPath, tag=None, stim=None, fromTime=None, toTime=None):
+        """
+        Returns catalog rows matching all the given conditions, ordered by start time
+
+        :param tag: only videos of this mouse
+        :param stim: only videos whose stimulus string contains this text
+        :param fromTime, toTime: only videos started in this range of times, seconds since the epoch
+        :returns: list of tuples, tag, stim, startTime, stopTime, ledOnTime, ledOffTime, path, size, duration
+        """
+        conditions = []
+        values = []
+        if tag is not None:
+            conditions.append('tag = ?')
+            values.append(tag)
+        if stim is not None:
+            conditions.append('stim LIKE ?')
+            values.append('%' + stim + '%')
+        if fromTime is not None:
+            conditions.append('startTime >= ?')
+            values.append(fromTime)
+        if toTime is not None:
+            conditions.append('startTime < ?')
+            values.append(toTime)
+        sql = 'SELECT * FROM videos'
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        db = AHF_VideoCatalog.connect(dbPath)
+        try:
+            return db.execute(sql + ' ORDER BY startTime', values).fetchall()
+        finally:
+            db.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Find AutoHeadFix trial videos by mouse, stimulus and date')
+    parser.add_argument('dbPath', help='catalog database, dataPath/videoCatalog_<cageID>.db')
+    parser.add_argument('--mouse', type=int, help='tag of the mouse')
+    parser.add_argument('--stim', help='text in the stimulus string, e.g. " L"')
+    parser.add_argument('--from', dest='fromDate', help='first date, YYYYMMDD')
+    parser.add_argument('--to', dest='toDate', help='last date, YYYYMMDD, inclusive')
+    parser.add_argument('--paths', action='store_true', help='print only the video paths')
+    args = parser.parse_args()
+    fromTime = None if args.fromDate is None else datetime.strptime(args.fromDate, '%Y%m%d').timestamp()
+    toTime = None if args.toDate is None else datetime.strptime(args.toDate, '%Y%m%d').timestamp() + 86400
+    rows = AHF_VideoCatalog.query(args.dbPath, args.mouse, args.stim, fromTime, toTime)
+    if not args.paths:
+        print ('tag\tstim\tstart\tsecs\tLED on delay\tsize\tpath')
+    for tag, stimStr, startTime, stopTime, ledOnTime, ledOffTime, videoPath, size, duration in rows:
+        if args.paths:
+            print (videoPath)
+        else:
+            print ('{:013}\t{:s}\t{:s}\t{:.2f}\t{:.3f}\t{:d}\t{:s}'.format(
+                tag, stimStr, datetime.fromtimestamp(int(startTime)).isoformat(' '), duration,
+                ledOnTime - startTime, size, videoPath))
+    if not args.paths:
+        print (str(len(rows)) + ' videos')
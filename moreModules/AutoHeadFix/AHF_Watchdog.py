@@ -0,0 +1,139 @@
+#! /usr/bin/python3
+#-*-coding: utf-8 -*-
+
+import sys
+import threading
+import traceback
+from time import monotonic, sleep
+from datetime import datetime
+
+
+class AHF_Watchdog (object):
+    """
+    Watches for the main loop stalling, and records where every thread was when it did
+
+    The main loop calls beat each time round, which only stores the time. A thread checks the time of the last beat
+    every quarter of stallSecs. When no beat has come for stallSecs, the stacks of all threads are appended to a stall
+    file with the length of the stall, and a text message is sent if there is a notifier. Stacks are sampled again every
+    stallSecs while the stall lasts, up to maxSamples times, so a stall that moves from one place to another can be seen.
+    The end of a stall is also recorded.
+    """
+
+    def __init__(self, stallSecs, stallPath, notifier=None, maxSamples=5):
+        """
+        Makes a new watchdog and starts its thread
+
+        :param stallSecs: time with no beat after which the main loop is stalled, longer than the longest trial
+        :param stallPath: path to the text file stacks are appended to
+        :param notifier: AHF_Notifier used to send a message when a stall is found, or None
+        :param maxSamples: most times stacks are sampled in one stall
+        """
+        self.stallSecs = stallSecs
+        self.stallPath = stallPath
+        self.notifier = notifier
+        self.maxSamples = maxSamples
+        self.lastBeat = monotonic()
+        self.mainThreadID = threading.get_ident()
+        self.nStalls = 0
+        self.isRunning = True
+        self.thread = threading.Thread(target=self.watchLoop, daemon=True)
+        self.thread.start()
+
+    def beat(self):
+        """
+        Called by the main loop to show it is still running
+        """
+        self.lastBeat = monotonic()
+
+    def pause(self):
+        """
+        Stops watching till the next beat, for waits that are expected to be long, like the menu waiting for input
+        """
+        self.lastBeat = None
+
+    def watchLoop(self):
+        """
+        Run by the watchdog thread, checks the time since the last beat and records stalls
+        """
+        stallBeat = None  # the beat that was last before the current stall
+        nSamples = 0
+        nextSample = 0.0
+        while self.isRunning:
+            lastBeat = self.lastBeat
+            now = monotonic()
+            if lastBeat is None or now - lastBeat < self.stallSecs:
+                if stallBeat is not None and lastBeat != stallBeat:
+                    self.record('Main loop stall ended after {:.1f} secs\n'.format(
+                        (lastBeat or now) - stallBeat))
+                    stallBeat = None
+            elif lastBeat != stallBeat:
+                stallBeat = lastBeat
+                nSamples = 1
+                nextSample = now + self.stallSecs
+                self.nStalls += 1
+                self.record(self.stacks(now - lastBeat))
+                if self.notifier is not None:
+                    self.notifier.queueMessage(0, 'stall', 'AutoHeadFix main loop in cage ' + self.notifier.cageID +
+                                               ' has stalled for {:.0f} secs'.format(now - lastBeat))
+            elif nSamples < self.maxSamples and now >= nextSample:
+                nSamples += 1
+                nextSample = now + self.stallSecs
+                self.record(self.stacks(now - lastBeat))
+            sleep(self.stallSecs / 4)
+
+    def stacks(self, stallSecs):
+        """
+        Returns the stacks of all threads, main thread first, as text headed with the time and stall length
+        """
+        lines = [datetime.now().isoformat(' ', 'seconds') + ' main loop stalled for {:.1f} secs\n'.format(stallSecs)]
+        names = {aThread.ident: aThread.name for aThread in threading.enumerate()}
+        frames = sys._current_frames()
+        for threadID in sorted(frames.keys(), key=lambda threadID: threadID != self.mainThreadID):
+            if threadID == threading.get_ident():
+                continue
+            lines.append('Thread ' + names.get(threadID, str(threadID)) + ':\n')
+            lines.extend(traceback.format_stack(frames[threadID]))
+        return ''.join(lines)
+
+    def record(self, text):
+        """
+        Appends text to the stall file, and prints it
+        """
+        print (text)
+        try:
+            with open(self.stallPath, 'a') as fp:
+                fp.write(text + '\n')
+        except IOError as anError:
+            print ('Could not write to stall file ' + self.stallPath + ': ' + str(anError))
+
+    def quit(self):
+        """
+        Stops the watchdog thread
+        """
+        self.isRunning = False
+
+
+# for testing purposes, stalls a stand-in main loop in a blocking wait, and shows what was recorded, and the cost of beat
+if __name__ == '__main__':
+    import os
+    from time import perf_counter
+    stallPath = 'watchdogTest.txt'
+
+    def blockingWait():
+        sleep(2.5)
+
+    watchdog = AHF_Watchdog(1.0, stallPath, maxSamples=2)
+    nBeats = 1000000
+    startTime = perf_counter()
+    for i in range(nBeats):
+        watchdog.beat()
+    print ('beat takes {:.0f} ns'.format((perf_counter() - startTime) * 1e09 / nBeats))
+    for i in range(20):
+        watchdog.beat()
+        sleep(0.05)
+    blockingWait()
+    watchdog.beat()
+    sleep(0.5)
+    watchdog.quit()
+    print ('stalls found: ' + str(watchdog.nStalls))
+    os.remove(stallPath)
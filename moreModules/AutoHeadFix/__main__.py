@@ -1,18 +1,35 @@
 #! /usr/bin/python
 #-*-coding: utf-8 -*-
 
+# timing of start up starts before anything else is imported
+from time import perf_counter
+kSTARTTIME = perf_counter()
 # local files, part of AutoHeadFix
 from AHF_Settings import AHF_Settings
 from AHF_CageSet import AHF_CageSet
-from AHF_Rewarder import AHF_Rewarder
-from AHF_Camera import AHF_Camera
+from AHF_Rewarder import AHF_Rewarder, AHF_RewardLedger
 from AHF_TagReader import AHF_TagReader
 from AHF_Notifier import AHF_Notifier
 from AHF_UDPTrig import AHF_UDPTrig
 from AHF_Stimulator import AHF_Stimulator
-from AHF_HardwareTester import hardwareTester
+from AHF_SettingsWatcher import AHF_SettingsWatcher
+from AHF_HardwareTester import hardwareTester, selfTest
 from AHF_ValveControl import valveControl
 from AHF_Mouse import Mouse, Mice
+from AHF_MouseHistory import AHF_MouseHistory
+from AHF_VideoCatalog import AHF_VideoCatalog
+from AHF_EventStore import AHF_EventStore, AHF_EventTee
+from AHF_Fleet import AHF_FleetPublisher
+import AHF_Metrics
+from AHF_TrialProfiler import AHF_TrialProfiler
+from AHF_Watchdog import AHF_Watchdog
+from AHF_RealTime import AHF_RealTime
+from AHF_LickDetector import AHF_LickDetector
+from AHF_ContactFilter import AHF_ContactFilter
+from AHF_GPIOTrace import AHF_GPIOTrace
+from AHF_FlowCalibration import AHF_FlowCalibration, calibrationPath
+from AHF_Journal import AHF_Journal
+from AHF_StimResults import AHF_StimResults
 # Python modules - should all be present in default distribution
 from os import path
 from os import makedirs
@@ -23,9 +40,12 @@ from time import time, localtime, timezone, sleep
 from datetime import datetime
 from random import random
 from sys import argv
+from os import environ
 # library import - need to have RPi.GPIO installed, but should be standard
-# on Raspbian Woody or Jessie
-import RPi.GPIO as GPIO
+# on Raspbian Woody or Jessie. Hardware libraries are imported when first used,
+# so importing this module works on computers that are not a Pi
+from AHF_LazyImport import lazy_import
+GPIO = lazy_import('RPi.GPIO')
 
 # constants used for calculating when to start a new day
 # we put each day's movies and text files in a separate folder, and keep
@@ -40,6 +60,15 @@ or callling sleep and maybe missing the thing we were waiting for, we loop using
 """
 kTIMEOUTmS = 50
 
+# live metrics, updated from the main loop, served over HTTP if a metrics port is set in AHFconfig.jsn
+entriesCounter = AHF_Metrics.counter('ahf_entries_total', 'Entries of mice into the chamber')
+trialsCounter = AHF_Metrics.counter('ahf_trials_total', 'Trials started by head bar contact, head fixed or not')
+checkFailCounter = AHF_Metrics.counter('ahf_check_failures_total', 'Head fixes released because contact was lost, check-')
+contactLatency = AHF_Metrics.histogram('ahf_contact_to_piston_seconds', 'Time from head bar contact seen to pistons energized')
+stimJitter = AHF_Metrics.histogram('ahf_stimulus_jitter_seconds', 'Error in intervals between rewards in a trial',
+                                   AHF_Metrics.kJITTERBUCKETS)
+logFlushTime = AHF_Metrics.histogram('ahf_log_flush_seconds', 'Time to write and flush a line of the log file')
+
 
 def main():
     """
@@ -47,18 +76,20 @@ def main():
 
     It initializes or loads settings and configurations, then endlessly loops running entries and head fix trials
     Ctrl-C is used to enter a menu-driven mode where settings can be altered.
+    If an experiment is named on the command line, with --exp name, or in the AHF_EXP environment variable,
+    AutoHeadFix starts without asking the user anything, so it can be restarted unattended after a crash.
     """
     try:
-        #print (str (argv))
+        expName = getExperimentName()
         # load general settings for this cage, mostly hardward pinouts
         # things not expected to change often - there is only one AHFconfig.jsn
         # file, in the enclosing folder
-        cageSettings = AHF_CageSet()
+        cageSettings = AHF_CageSet(interactive=(expName is None))
         # get settings that may vary by experiment, including rewarder, camera pramaters, and stimulator
         # More than one of these files can exist, and the user needs to choose one or make one
         # we will add some other  variables to expSettings so we can pass them as a single argument to functions
         # logFP, statsFP, dateStr, dayFolderPath,   doHeadFix,
-        expSettings = AHF_Settings(None)
+        expSettings = AHF_Settings(expName)
         # nextDay starts tomorrow at KDAYSTARTHOUR
         nextDay = (int((time() - timezone) / KSECSPERDAY) + 1) * \
             KSECSPERDAY + timezone + (KDAYSTARTHOUR * KSECSPERHOUR)
@@ -66,46 +97,143 @@ def main():
         makeDayFolderPath(expSettings, cageSettings)
         # initialize mice with zero mice
         mice = Mice()
+        # per-mouse history, kept across days
+        mouseHistory = AHF_MouseHistory(cageSettings.dataPath + 'mouseHistory/')
+        # catalog of trial videos, indexed by mouse and time, kept across days
+        videoCatalog = AHF_VideoCatalog(cageSettings.dataPath + 'videoCatalog_' + cageSettings.cageID + '.db')
+        # log events can also go to a database, kept across days, for indexed queries
+        if cageSettings.eventDB == True:
+            expSettings.eventStore = AHF_EventStore(
+                cageSettings.dataPath + 'events_' + cageSettings.cageID + '.db')
+        else:
+            expSettings.eventStore = None
+        # and can be published to a fleet aggregator, for monitoring many cages from one place
+        if cageSettings.fleetHost != '':
+            expSettings.fleetPublisher = AHF_FleetPublisher(cageSettings.cageID, cageSettings.fleetHost)
+        else:
+            expSettings.fleetPublisher = None
+        # times each phase of each trial, written to a daily profile file made with the log file
+        expSettings.profiler = AHF_TrialProfiler()
         # make daily Log files and quick stats file
         makeLogFile(expSettings, cageSettings)
         makeQuickStatsFile(expSettings, cageSettings, mice)
         # set up the GPIO headers each for their respective functionalities.
         GPIO.setmode(GPIO.BCM)
         GPIO.setwarnings(False)
+        # installed before anything else uses GPIO, so every output and input edge is recorded
+        if cageSettings.gpioTrace == True:
+            pinNames = {cageSettings.pistonsPin: 'pistons', cageSettings.rewardPin: 'reward',
+                        cageSettings.tirPin: 'tir', cageSettings.contactPin: 'contact', cageSettings.ledPin: 'LED'}
+            if cageSettings.lickPin != 0:
+                pinNames[cageSettings.lickPin] = 'lick'
+            for key, value in expSettings.stimDict.items():
+                if key.lower().endswith('pin') and isinstance(value, int) and value not in pinNames:
+                    pinNames[value] = key
+            expSettings.gpioTrace = AHF_GPIOTrace(GPIO, pinNames)
+        else:
+            expSettings.gpioTrace = None
         GPIO.setup(cageSettings.pistonsPin, GPIO.OUT, initial=GPIO.LOW)
         GPIO.setup(cageSettings.ledPin, GPIO.OUT, initial=GPIO.LOW)
         GPIO.setup(cageSettings.tirPin, GPIO.IN)
         GPIO.setup(cageSettings.contactPin, GPIO.IN)
-        # make a rewarder - TODO: make one for each mouse and record water for
-        # each mouse in its own rewarder
-        rewarder = AHF_Rewarder(30e-03, cageSettings.rewardPin)
-        rewarder.addToDict('entrance', expSettings.entranceRewardTime)
-        rewarder.addToDict('task', expSettings.taskRewardTime)
-        # make a notifier object
+        # licks are captured from their own thread, for closed-loop stimulators and saved with each trial
+        if cageSettings.lickPin != 0:
+            expSettings.lickDetector = AHF_LickDetector(cageSettings.lickPin)
+            AHF_Metrics.gauge('ahf_licks_total', 'Licks detected since start', lambda: expSettings.lickDetector.nLicks)
+        else:
+            expSettings.lickDetector = None
+        # head contacts can be debounced and filtered from their own thread, so bounces do not start trials
+        if cageSettings.contactOnSecs > 0:
+            expSettings.contactFilter = AHF_ContactFilter(cageSettings.contactPin, cageSettings.contactOnSecs,
+                                                          cageSettings.contactOffSecs)
+        else:
+            expSettings.contactFilter = None
+        # make a rewarder, one for the cage, that keeps a ledger of the rewards given to each mouse
+        flowCalibration = AHF_FlowCalibration.load(calibrationPath(cageSettings))
+        if flowCalibration is None:
+            print ('Reward solenoid is not calibrated, water volumes will not be tracked')
+        else:
+            print ('Using ' + flowCalibration.describe())
+        rewarder = AHF_Rewarder(30e-03, cageSettings.rewardPin, flowCalibration)
+        rewarder.addToDict('entrance', expSettings.entranceRewardTime, expSettings.entranceRewardVolume)
+        rewarder.addToDict('task', expSettings.taskRewardTime, expSettings.taskRewardVolume)
+        # today's ledgers, if restarting
+        try:
+            print ('Loaded reward ledgers for {:d} mice'.format(rewarder.loadLedgers(expSettings.ledgerPath)))
+        except ValueError as anError:
+            print (str(anError))
+        # the state of each mouse is journaled as it changes, so a restart after a crash carries on where it stopped
+        expSettings.journal = AHF_Journal(expSettings.journalPath)
+        restoreFromJournal(expSettings, mice, rewarder)
+        # make a notifier object, it sends messages from its own thread so the main loop never waits on the web
         if expSettings.hasTextMsg == True:
             notifier = AHF_Notifier(cageSettings.cageID, expSettings.phoneList)
         else:
             notifier = None
         # make RFID reader
         tagReader = AHF_TagReader(cageSettings.serialPort, False)
-        # configure camera
+        # configure camera, picamera is only imported here
+        from AHF_Camera import AHF_Camera
         camera = AHF_Camera(expSettings.camParamsDict)
         # make UDP Trigger
         if expSettings.hasUDP == True:
-            UDPTrigger = AHF_UDPTrig(expSettings.UDPList)
+            UDPTrigger = AHF_UDPTrig(
+                expSettings.UDPList, expSettings.UDPGroup)
         else:
             UDPTrigger = None
         # make stimulator
         stimulator = AHF_Stimulator.get_class(expSettings.stimulator)(
             expSettings.stimDict, rewarder, expSettings.logFP)
         expSettings.stimDict = stimulator.configDict
+        # today's stim results of each mouse, loaded from the day's results file if restarting
+        expSettings.stimResults = None
+        for mouse in mice.mouseArray:
+            bindStimResults(expSettings, stimulator, mouse)
+        # watch the experiment config file, so changes saved to it are applied between trials
+        if expSettings.fileName != '':
+            settingsWatcher = AHF_SettingsWatcher(expSettings.fileName)
+        else:
+            settingsWatcher = None
+        # gauges are read only when metrics are scraped
+        AHF_Metrics.gauge('ahf_rewards_given', 'Rewards given since start, all kinds',
+                          lambda: sum(rewarder.totalsDict.values()))
+        AHF_Metrics.gauge('ahf_solenoid_open_seconds', 'Total time the reward solenoid was open since start',
+                          rewarder.getTotalDur)
+        AHF_Metrics.gauge('ahf_water_microlitres', 'Total volume of water given since start, if the solenoid is calibrated',
+                          rewarder.getTotalVolume)
+        for name, queueOwner in (('notifier', notifier), ('event_store', expSettings.eventStore),
+                                 ('fleet', expSettings.fleetPublisher), ('video_catalog', videoCatalog)):
+            if queueOwner is not None:
+                AHF_Metrics.gauge('ahf_' + name + '_queue_depth', 'Items waiting in the ' + name.replace('_', ' ') +
+                                  ' queue', queueOwner.queue.qsize)
+        if cageSettings.metricsPort != 0:
+            metricsServer = AHF_Metrics.serve(cageSettings.metricsPort)
+        else:
+            metricsServer = None
+        # records where the program was if the main loop stops running, e.g., waiting on hardware that never answers
+        watchdog = AHF_Watchdog(cageSettings.stallSecs, cageSettings.dataPath + 'stalls_' + cageSettings.cageID + '.txt',
+                                notifier)
+        # pins the stimulus to a CPU with real-time priority, if a CPU is set, made last so memory made above is locked
+        expSettings.realTime = AHF_RealTime(cageSettings.realTimeCPU)
+        print (expSettings.realTime.describe())
+        # times the hardware at each start, so drift shows in the saved reports, a failed test does not stop the program
+        try:
+            selfTest(cageSettings, tagReader, camera)
+        except Exception as anError:
+            print ('Hardware self test failed:', str(anError))
     except Exception as anError:
         print ('Unexpected error starting AutoHeadFix:', str(anError))
         return
     try:
+        print ('AutoHeadFix ready after {:.2f} secs, {:.2f} secs since program start'.format(
+            perf_counter() - kSTARTTIME, processAgeSecs()))
         print ('Waiting for a mouse...')
         while True:  # start main loop
             try:
+                watchdog.beat()
+                # apply any changed settings while no mouse is in the chamber
+                stimulator = reloadSettings(
+                    settingsWatcher, expSettings, rewarder, stimulator)
                 # wait for mouse entry, with occasional timeout to catch
                 # keyboard interrupt
                 # wait for entry based on Tag-in-range pin
@@ -122,18 +250,24 @@ def main():
                         thisMouse = Mouse(tag, 1, 0, 0, 0)
                         mice.addMouse(thisMouse, expSettings.statsFP)
                     writeToLogFile(expSettings.logFP, thisMouse, 'entry')
+                    rewarder.setCurrentMouse(thisMouse)
+                    if expSettings.contactFilter is not None:
+                        expSettings.contactFilter.setMouse(thisMouse.tag)
                     thisMouse.entries += 1
+                    entriesCounter.inc()
+                    journalMouse(expSettings, rewarder, thisMouse)
                     # if we have entrance reward, first wait for entrance
                     # reward or first head-fix, which countermands entry reward
                     if thisMouse.entranceRewards < expSettings.maxEntryRewards:
                         giveEntranceReward = True
                         expSettings.doHeadFix = expSettings.propHeadFix > random()
                         while GPIO.input(cageSettings.tirPin) == GPIO.HIGH and time() < (entryTime + expSettings.entryRewardDelay):
-                            GPIO.wait_for_edge(
-                                cageSettings.contactPin, GPIO.RISING, timeout=kTIMEOUTmS)
-                            if (GPIO.input(cageSettings.contactPin) == GPIO.HIGH):
-                                runTrial(thisMouse, expSettings,
-                                         cageSettings, camera, rewarder, stimulator)
+                            watchdog.beat()
+                            if waitForContact(expSettings, cageSettings):
+                                expSettings.contactTime = perf_counter()
+                                runTrial(thisMouse, expSettings, cageSettings, camera,
+                                         rewarder, stimulator, UDPTrigger, videoCatalog)
+                                journalMouse(expSettings, rewarder, thisMouse)
                                 giveEntranceReward = False
                                 break
                         if (GPIO.input(cageSettings.tirPin) == GPIO.HIGH) and giveEntranceReward == True:
@@ -143,15 +277,19 @@ def main():
                             thisMouse.entranceRewards += 1
                             writeToLogFile(expSettings.logFP,
                                            thisMouse, 'entryReward')
+                            journalMouse(expSettings, rewarder, thisMouse)
                     # wait for contacts and run trials till mouse exits or time
                     # in chamber exceeded
                     expSettings.doHeadFix = expSettings.propHeadFix > random()
                     while GPIO.input(cageSettings.tirPin) == GPIO.HIGH and time() < entryTime + expSettings.inChamberTimeLimit:
-                        GPIO.wait_for_edge(
-                            cageSettings.contactPin, GPIO.RISING, timeout=kTIMEOUTmS)
-                        if (GPIO.input(cageSettings.contactPin) == GPIO.HIGH):
-                            runTrial(thisMouse, expSettings, cageSettings,
-                                     camera, rewarder, stimulator, UDPTrigger)
+                        watchdog.beat()
+                        if waitForContact(expSettings, cageSettings):
+                            expSettings.contactTime = perf_counter()
+                            runTrial(thisMouse, expSettings, cageSettings, camera,
+                                     rewarder, stimulator, UDPTrigger, videoCatalog)
+                            journalMouse(expSettings, rewarder, thisMouse)
+                            stimulator = reloadSettings(
+                                settingsWatcher, expSettings, rewarder, stimulator)
                             # set doHeadFix for next contact
                             expSettings.doHeadFix = expSettings.propHeadFix > random()
                     # either mouse left the chamber or has been in chamber too
@@ -160,40 +298,65 @@ def main():
                         # explictly turn off pistons, though they should be off
                         # at end of trial
                         GPIO.output(cageSettings.pistonsPin, GPIO.LOW)
-                        if expSettings.hasNotifier == True:
+                        if notifier is not None:
                             notifier.notify(
                                 thisMouse.tag, (time() - entryTime),  True)
-                        # wait for mouse to leave chamber, with no timeout
-                        GPIO.wait_for_edge(cageSettings.tirPin, GPIO.FALLING)
-                        if expSettings.hasNotifier == True:
+                        if expSettings.fleetPublisher is not None:
+                            expSettings.fleetPublisher.addEvent(thisMouse.tag, time(), 'overTime')
+                        # wait for mouse to leave chamber, for as long as it takes, with a timeout on each wait so
+                        # the watchdog can see the loop is still running
+                        while GPIO.input(cageSettings.tirPin) == GPIO.HIGH:
+                            watchdog.beat()
+                            GPIO.wait_for_edge(cageSettings.tirPin, GPIO.FALLING, timeout=kTIMEOUTmS)
+                        if notifier is not None:
                             notifier.notify(
                                 thisMouse.tag, (time() - entryTime), False)
                     tagReader.clearBuffer()
                     # after exit, update stats
                     writeToLogFile(expSettings.logFP, thisMouse, 'exit')
-                    updateStats(expSettings.statsFP, mice, thisMouse)
+                    rewarder.setCurrentMouse(None)
+                    if expSettings.contactFilter is not None:
+                        expSettings.contactFilter.setMouse(None)
+                        writeToLogFile(expSettings.logFP, thisMouse,
+                                       expSettings.contactFilter.statsStr(thisMouse.tag))
+                    updateStats(expSettings.statsFP, mice, thisMouse,
+                                mouseHistory, time() - entryTime)
+                    rewarder.saveLedgers(expSettings.ledgerPath)
+                    journalMouse(expSettings, rewarder, thisMouse)
                     # after each exit check for a new day
                     if time() > nextDay:
                         mice.show()
-                        writeToLogFile(logFP, None, 'SeshEnd')
-                        expSettings.logFP.close()
-                        expSettings.statsFP.close()
-                        dayFolderPath = makeDayFolderPath(cageSettings)
-                        expSettings.logFP = makeLogFile(
-                            dayFolderPath, cageSettings)
-                        expSettings.statsFP = makeQuickStatsFile(
-                            dayFolderPath, cageSettings, mice)
+                        writeToLogFile(expSettings.logFP, None, 'SeshEnd')
+                        if expSettings.stimResults is not None:
+                            expSettings.stimResults.quit()
+                            expSettings.stimResults = None
+                        # the new day's files are opened before the old day's are closed, so if anything fails on
+                        # the way, the session still ends in files that are open
+                        oldLogFP, oldStatsFP, oldJournal = expSettings.logFP, expSettings.statsFP, expSettings.journal
+                        makeDayFolderPath(expSettings, cageSettings)
+                        makeLogFile(expSettings, cageSettings)
+                        makeQuickStatsFile(expSettings, cageSettings, mice)
+                        expSettings.journal = AHF_Journal(expSettings.journalPath)
+                        expSettings.journal.recover()
+                        oldLogFP.close()
+                        oldStatsFP.close()
+                        oldJournal.quit()
                         stimulator.nextDay(expSettings.logFP)
                         nextDay += KSECSPERDAY
                         mice.clear()
+                        rewarder.clearLedgers()
+                        for mouse in mice.mouseArray:
+                            bindStimResults(expSettings, stimulator, mouse)
                     print ('Waiting for a mouse...')
             except KeyboardInterrupt:
+                # waiting for the user is not a stall
+                watchdog.pause()
                 GPIO.output(cageSettings.ledPin, GPIO.LOW)
                 GPIO.output(cageSettings.pistonsPin, GPIO.LOW)
                 GPIO.output(cageSettings.rewardPin, GPIO.LOW)
                 while True:
                     event = input(
-                        'Enter:\nr to return to head fix trials\nq to quit\nv to run valve control\nh for hardware tester\nc for camera configuration\ne for experiment configuration\n:')
+                        'Enter:\nr to return to head fix trials\nq to quit\nv to run valve control\nh for hardware tester\ns for hardware self test\nc for camera configuration\ne for experiment configuration\n:')
                     if event == 'r' or event == "R":
                         break
                     elif event == 'q' or event == 'Q':
@@ -201,7 +364,19 @@ def main():
                     elif event == 'v' or event == "V":
                         valveControl(cageSettings)
                     elif event == 'h' or event == 'H':
-                        hardwareTester(cageSettings, tagReader)
+                        # the hardware tester waits for edges on the contact pin itself
+                        if expSettings.contactFilter is not None:
+                            expSettings.contactFilter.pause()
+                        try:
+                            hardwareTester(cageSettings, tagReader)
+                        finally:
+                            if expSettings.contactFilter is not None:
+                                expSettings.contactFilter.resume()
+                    elif event == 's' or event == 'S':
+                        try:
+                            selfTest(cageSettings, tagReader, camera)
+                        except Exception as anError:
+                            print ('Hardware self test failed:', str(anError))
                     elif event == 'c' or event == 'C':
                         camParams = camera.adjust_config_from_user()
                     elif event == 'e' or event == 'E':
@@ -215,17 +390,138 @@ def main():
         print ('AutoHeadFix error:' + str(anError))
     finally:
         stimulator.quitting()
+        if notifier is not None:
+            notifier.quit()
+        if settingsWatcher is not None:
+            settingsWatcher.quit()
+        videoCatalog.quit()
+        if metricsServer is not None:
+            metricsServer.shutdown()
+        watchdog.quit()
+        expSettings.realTime.quit()
+        if expSettings.lickDetector is not None:
+            expSettings.lickDetector.quit()
+        if expSettings.contactFilter is not None:
+            expSettings.contactFilter.quit()
+        if expSettings.gpioTrace is not None:
+            expSettings.gpioTrace.quit()
         GPIO.output(cageSettings.ledPin, False)
         GPIO.output(cageSettings.pistonsPin, False)
         GPIO.output(cageSettings.rewardPin, False)
         GPIO.cleanup()
-        writeToLogFile(expSettings.logFP, None, 'SeshEnd')
-        expSettings.logFP.close()
+        if not expSettings.logFP.closed:
+            writeToLogFile(expSettings.logFP, None, 'SeshEnd')
+            expSettings.logFP.close()
         expSettings.statsFP.close()
+        expSettings.journal.quit()
+        if expSettings.stimResults is not None:
+            expSettings.stimResults.quit()
+        expSettings.profiler.quit()
+        if expSettings.eventStore is not None:
+            expSettings.eventStore.quit()
+        if expSettings.fleetPublisher is not None:
+            expSettings.fleetPublisher.quit()
         print ('AutoHeadFix Stopped')
 
 
-def runTrial(thisMouse, expSettings, cageSettings, camera, rewarder, stimulator, UDPTrigger):
+def getExperimentName():
+    """
+    Gets the name of the experiment config file to load without asking the user
+
+    The name is taken from the command line, as --exp name, or else from the AHF_EXP environment variable
+    :returns: the experiment name, or None if neither is set and the user should choose
+    """
+    if '--exp' in argv[:-1]:
+        return argv[argv.index('--exp') + 1]
+    return environ.get('AHF_EXP')
+
+
+def processAgeSecs():
+    """
+    Returns seconds since this process was started by the operating system, including starting python itself
+
+    Uses the start time in /proc/self/stat, falls back to time since this module started loading if that is not available
+    """
+    try:
+        from os import sysconf
+        with open('/proc/self/stat', 'r') as fp:
+            # field 22 is start time in clock ticks after boot, counted after the parenthesized command name
+            startTicks = int(fp.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as fp:
+            upSecs = float(fp.read().split()[0])
+        return upSecs - startTicks / sysconf('SC_CLK_TCK')
+    except (IOError, ValueError, IndexError):
+        return perf_counter() - kSTARTTIME
+
+
+def reloadSettings(settingsWatcher, expSettings, rewarder, stimulator):
+    """
+    Applies experiment settings that were changed in the config file, if there are any, between trials
+
+    Logs settingsReload if the changed settings were applied, or settingsReject if they were not and the old ones are kept
+
+    :param settingsWatcher: the AHF_SettingsWatcher watching the config file, or None if settings were not loaded from a file
+    :returns: the stimulator to use from now on, which is a new stimulator if the stimulator class was changed
+    """
+    if settingsWatcher is not None and settingsWatcher.pending is not None:
+        nApplied = settingsWatcher.nApplied
+        stimulator = settingsWatcher.apply(expSettings, rewarder, stimulator)
+        if settingsWatcher.nApplied > nApplied:
+            writeToLogFile(expSettings.logFP, None, 'settingsReload')
+        else:
+            writeToLogFile(expSettings.logFP, None, 'settingsReject')
+    return stimulator
+
+
+def waitForContact(expSettings, cageSettings):
+    """
+    Waits up to kTIMEOUTmS for the mouse to touch the head contacts, on the contact filter if there is one, else on the pin
+
+    :returns: True if the head contacts are touched
+    """
+    if expSettings.contactFilter is not None:
+        return expSettings.contactFilter.waitForContact(kTIMEOUTmS / 1000)
+    GPIO.wait_for_edge(cageSettings.contactPin, GPIO.RISING, timeout=kTIMEOUTmS)
+    return GPIO.input(cageSettings.contactPin) == GPIO.HIGH
+
+
+def waitForRelease(expSettings, cageSettings):
+    """
+    Waits up to kTIMEOUTmS for the mouse to let go of the head contacts, on the contact filter if there is one
+
+    :returns: True if the head contacts are not touched
+    """
+    if expSettings.contactFilter is not None:
+        return expSettings.contactFilter.waitForRelease(kTIMEOUTmS / 1000)
+    GPIO.wait_for_edge(cageSettings.contactPin, GPIO.FALLING, timeout=kTIMEOUTmS)
+    return GPIO.input(cageSettings.contactPin) == GPIO.LOW
+
+
+def isContact(expSettings, cageSettings):
+    if expSettings.contactFilter is not None:
+        return expSettings.contactFilter.isContact
+    return GPIO.input(cageSettings.contactPin) == GPIO.HIGH
+
+
+def connectStimulator(stimulator, expSettings, cageSettings):
+    """
+    Connects sensor events to a closed-loop stimulator, like AHF_Stimulator_Reactive, that has a connect method
+
+    Does nothing for other stimulators, or for sources already connected, so it is called before each trial to cover
+    stimulators made at start up, from the menu, or when settings are reloaded
+    """
+    if not hasattr(stimulator, 'connect'):
+        return
+    if expSettings.lickDetector is not None:
+        stimulator.connect(expSettings.lickDetector, 'lick')
+    if expSettings.contactFilter is not None:
+        stimulator.connect(expSettings.contactFilter, 'contact')
+    else:
+        stimulator.connect(cageSettings.contactPin, 'contact')
+    stimulator.connect(cageSettings.tirPin, 'tagInRange')
+
+
+def runTrial(thisMouse, expSettings, cageSettings, camera, rewarder, stimulator, UDPTrigger, videoCatalog=None):
     """
     Runs a single AutoHeadFix trial, from the mouse making initial contact with the plate
 
@@ -238,17 +534,32 @@ def runTrial(thisMouse, expSettings, cageSettings, camera, rewarder, stimulator,
         :param rewarder :object of AHF_Rewarder class that runs solenoid to give water rewards
         :param stimulator: object of a subclass of  AHF_Stimulator, which runs experiment, incuding giving rewards
         :param UDPTrigger: used if sending UDP signals to other Pi for behavioural observation
+        :param videoCatalog: AHF_VideoCatalog the trial's video is added to, with its timing, or None
     """
+    profiler = expSettings.profiler
+    profiler.startTrial(thisMouse.tag)
+    # the GPIO trace goes next to the video, or is named for the mouse and time if the trial ends before there is a video
+    if expSettings.gpioTrace is not None:
+        expSettings.gpioTrace.startTrial()
+        trace_path = expSettings.dayFolderPath + 'Videos/' + "M" + str(thisMouse.tag) + '_' + '%d' % time() + '.trace'
     try:
+        trialsCounter.inc()
         if expSettings.doHeadFix == True:
             # energize the pistons
+            profiler.begin('pistons')
             GPIO.output(cageSettings.pistonsPin, GPIO.HIGH)
+            contactLatency.observe(perf_counter() - expSettings.contactTime)
             sleep(0.15)  # wait a bit for things to settle, then re-check contacts
-            if GPIO.input(cageSettings.contactPin) == GPIO.LOW:
+            profiler.end('pistons')
+            profiler.begin('contactCheck')
+            if not isContact(expSettings, cageSettings):
                 # turn off pistons if contact was lost
                 GPIO.output(cageSettings.pistonsPin, GPIO.LOW)
                 writeToLogFile(expSettings.logFP, thisMouse, 'check-')
+                checkFailCounter.inc()
+                profiler.end('contactCheck')
                 return False
+            profiler.end('contactCheck')
         #  non-head fix trial or check was successful
         if expSettings.doHeadFix == True:
             thisMouse.headFixes += 1
@@ -256,58 +567,118 @@ def runTrial(thisMouse, expSettings, cageSettings, camera, rewarder, stimulator,
         else:
             writeToLogFile(expSettings.logFP, thisMouse, 'check No Fix Trial')
         # Configure the stimulator and the path for the video
+        profiler.begin('configStim')
+        connectStimulator(stimulator, expSettings, cageSettings)
+        bindStimResults(expSettings, stimulator, thisMouse)
         stimStr = stimulator.configStim(thisMouse)
+        # the stimulator changes its results as it configures, so they are saved now, by the stim results writer thread
+        expSettings.stimResults.saveTrial(thisMouse.tag)
+        profiler.end('configStim')
         headFixTime = time()
         video_name = str(thisMouse.tag) + "_" + stimStr + "_" + \
             '%d' % headFixTime + '.' + camera.AHFvideoFormat
         video_name_path = expSettings.dayFolderPath + 'Videos/' + "M" + video_name
+        if expSettings.gpioTrace is not None:
+            trace_path = video_name_path.rsplit('.', 1)[0] + '.trace'
         writeToLogFile(expSettings.logFP, thisMouse, video_name)
         # send socket message to start behavioural camera
         if expSettings.hasUDP == True:
             MESSAGE = str(thisMouse.tag) + "_" + \
                 stimStr + "_" + '%d' % headFixTime
+            profiler.begin('UDPTrigger')
             UDPTrigger.doTrigger(MESSAGE)
+            profiler.end('UDPTrigger')
             # start recording and Turn on the blue led
+            profiler.begin('cameraStart')
             camera.start_recording(video_name_path)
+            profiler.end('cameraStart')
+            startTime = time()
             # wait a bit so camera has time to start before light turns on, for
             # synchrony accross cameras
             sleep(expSettings.cameraStartDelay)
+            profiler.begin('LEDOn')
             GPIO.output(cageSettings.ledPin, GPIO.HIGH)
+            profiler.end('LEDOn')
+            ledOnTime = time()
         else:  # turn on the blue light and start the movie
+            profiler.begin('LEDOn')
             GPIO.output(cageSettings.ledPin, GPIO.HIGH)
+            profiler.end('LEDOn')
+            ledOnTime = time()
+            profiler.begin('cameraStart')
             camera.start_recording(video_name_path)
-        stimulator.run()  # run whatever stimulus is configured
+            profiler.end('cameraStart')
+            startTime = time()
+        if expSettings.lickDetector is not None:
+            expSettings.lickDetector.startTrial()
+        profiler.begin('stimRun')
+        with expSettings.realTime:
+            stimulator.run()  # run whatever stimulus is configured
+        profiler.end('stimRun')
+        for jitter in AHF_Metrics.intervalJitters(getattr(stimulator, 'rewardTimes', []),
+                                                  getattr(stimulator, 'rewardInterval', None)):
+            stimJitter.observe(jitter)
         if expSettings.hasUDP == True:
+            profiler.begin('LEDOff')
             GPIO.output(cageSettings.ledPin, GPIO.LOW)  # turn off the blue LED
+            profiler.end('LEDOff')
+            ledOffTime = time()
             # wait again after turning off LED before stopping camera, for
             # synchronization
             sleep(expSettings.cameraStartDelay)
             UDPTrigger.doTrigger("Stop")  # stop
+            profiler.begin('cameraStop')
             camera.stop_recording()
+            profiler.end('cameraStop')
+            stopTime = time()
         else:
+            profiler.begin('cameraStop')
             camera.stop_recording()
+            profiler.end('cameraStop')
+            stopTime = time()
+            profiler.begin('LEDOff')
             GPIO.output(cageSettings.ledPin, GPIO.LOW)  # turn off the blue LED
+            profiler.end('LEDOff')
+            ledOffTime = time()
+        if videoCatalog is not None:
+            videoCatalog.addVideo(thisMouse.tag, stimStr, startTime, stopTime, ledOnTime, ledOffTime, video_name_path)
+        profiler.begin('chown')
         uid = getpwnam('pi').pw_uid
         gid = getgrnam('pi').gr_gid
         # we run AutoheadFix as root for GPIO, so we expicitly set ownership to
         # pi
         chown(video_name_path, uid, gid)
+        profiler.end('chown')
+        # licks in the trial, with times from when the LED came on, go in a file named like the video
+        if expSettings.lickDetector is not None:
+            licks_path = expSettings.dayFolderPath + 'Licks/' + "M" + video_name.rsplit('.', 1)[0] + '.npy'
+            expSettings.lickDetector.saveTrial(licks_path, ledOnTime)
+            chown(licks_path, uid, gid)
         if expSettings.doHeadFix == True:
             GPIO.output(cageSettings.pistonsPin, GPIO.LOW)  # turn off pistons
+        profiler.begin('logfile')
         stimulator.logfile()
         writeToLogFile(expSettings.logFP, thisMouse, 'complete')
+        profiler.end('logfile')
         # give mouse a chance to disconnect before head fixing again
+        profiler.begin('skedaddle')
         skeddadleEnd = time() + expSettings.skeddadleTime
         while time() < skeddadleEnd:
-            GPIO.wait_for_edge(cageSettings.contactPin,
-                               GPIO.FALLING, timeout=kTIMEOUTmS)
-            if (GPIO.input(cageSettings.contactPin) == GPIO.LOW):
+            if waitForRelease(expSettings, cageSettings):
                 break
+        profiler.end('skedaddle')
         return True
     except Exception as anError:
         GPIO.output(cageSettings.pistonsPin, GPIO.LOW)  # turn off pistons
         camera.stop_recording()
         print ('Error in running trial:' + str(anError))
+    finally:
+        # the trial's timing and GPIO trace are written after it is over, whether it completed, failed the check, or had
+        # an error
+        profiler.writeTrial()
+        if expSettings.gpioTrace is not None:
+            expSettings.gpioTrace.dumpTrial(trace_path)
+            chown(trace_path, getpwnam('pi').pw_uid, getgrnam('pi').gr_gid)
 
 
 def makeDayFolderPath(expSettings, cageSettings):
@@ -315,7 +686,7 @@ def makeDayFolderPath(expSettings, cageSettings):
     Makes data folders for a day's data,including movies, log file, and quick stats file
 
     Format: dayFolder = cageSettings.dataPath + cageSettings.cageID + YYYMMMDD
-    within which will be /Videos and /TextFiles
+    within which will be /Videos, /Licks, and /TextFiles
     :param expSettings: experiment-specific settings, everything you need to know is stored in this object
     :param cageSettings: settings that are expected to stay the same for each setup, including hardware pin-outs for GPIO
 
@@ -331,24 +702,36 @@ def makeDayFolderPath(expSettings, cageSettings):
                  'TextFiles/', mode=0o777, exist_ok=True)
         makedirs(expSettings.dayFolderPath +
                  'Videos/', mode=0o777, exist_ok=True)
+        makedirs(expSettings.dayFolderPath +
+                 'Licks/', mode=0o777, exist_ok=True)
         uid = getpwnam('pi').pw_uid
         gid = getgrnam('pi').gr_gid
         chown(expSettings.dayFolderPath, uid, gid)
         chown(expSettings.dayFolderPath + 'TextFiles/', uid, gid)
         chown(expSettings.dayFolderPath + 'Videos/', uid, gid)
+        chown(expSettings.dayFolderPath + 'Licks/', uid, gid)
 
 
 def makeLogFile(expSettings, cageSettings):
     """
     open a new text log file for today, or open an exisiting text file with 'a' for append
+
+    If expSettings.eventStore or expSettings.fleetPublisher is set, the file is wrapped in an AHF_EventTee, so events are
+    also saved in the database or sent to the fleet aggregator. The day's trial profile file is opened here too
     """
     logFilePath = expSettings.dayFolderPath + 'TextFiles/headFix_' + \
         cageSettings.cageID + '_' + expSettings.dateStr + '.txt'
     expSettings.logFP = open(logFilePath, 'a')
+    if expSettings.eventStore is not None:
+        expSettings.logFP = AHF_EventTee(expSettings.logFP, expSettings.eventStore)
+    if expSettings.fleetPublisher is not None:
+        expSettings.logFP = AHF_EventTee(expSettings.logFP, expSettings.fleetPublisher)
     uid = getpwnam('pi').pw_uid
     gid = getgrnam('pi').gr_gid
     chown(logFilePath, uid, gid)
     writeToLogFile(expSettings.logFP, None, 'SeshStart')
+    expSettings.profiler.newDay(expSettings.dayFolderPath + 'TextFiles/profile_' +
+                                cageSettings.cageID + '_' + expSettings.dateStr + '.txt')
 
 
 def writeToLogFile(logFP, mouseObj, event):
@@ -370,8 +753,10 @@ def writeToLogFile(logFP, mouseObj, event):
     printOutPutStr = outPutStr + '\t' + \
         datetime.fromtimestamp(int(time())).isoformat(' ') + '\t' + event
     print (printOutPutStr)
+    flushStart = perf_counter()
     logFP.write(logOutPutStr + '\n')
     logFP.flush()
+    logFlushTime.observe(perf_counter() - flushStart)
 
 
 def makeQuickStatsFile(expSettings, cageSettings, mice):
@@ -385,6 +770,15 @@ def makeQuickStatsFile(expSettings, cageSettings, mice):
 """
     textFilePath = expSettings.dayFolderPath + 'TextFiles/quickStats_' + \
         cageSettings.cageID + '_' + expSettings.dateStr + '.txt'
+    # reward ledgers of each mouse are saved next to the quick stats, by the rewarder
+    expSettings.ledgerPath = expSettings.dayFolderPath + 'TextFiles/rewards_' + \
+        cageSettings.cageID + '_' + expSettings.dateStr + '.jsn'
+    # and the journal of the day's changes to each mouse, as .snap and .jnl files
+    expSettings.journalPath = expSettings.dayFolderPath + 'TextFiles/journal_' + \
+        cageSettings.cageID + '_' + expSettings.dateStr
+    # and the stim results of each mouse, in a file for each stimulator class, named by bindStimResults
+    expSettings.stimResultsPrefix = expSettings.dayFolderPath + 'TextFiles/stimResults_' + \
+        cageSettings.cageID + '_' + expSettings.dateStr + '_'
     if path.exists(textFilePath):
         expSettings.statsFP = open(textFilePath, 'r+')
         mice.addMiceFromFile(expSettings.statsFP)
@@ -400,11 +794,60 @@ def makeQuickStatsFile(expSettings, cageSettings, mice):
         chown(textFilePath, uid, gid)
 
 
-def updateStats(statsFP, mice, mouse):
+def journalMouse(expSettings, rewarder, mouse):
+    """
+    Records the daily counts, stimResults and reward ledger of a mouse in the day's journal
+    """
+    expSettings.journal.record(str(mouse.tag), {'mouse': mouse.getState(),
+                                                'ledger': rewarder.ledgerFor(mouse.tag).toDict()})
+
+
+def bindStimResults(expSettings, stimulator, mouse):
+    """
+    Makes a mouse's stimResultsDict its record in the day's AHF_StimResults for the stimulator's class
+
+    A new AHF_StimResults is opened, loading any results saved before, the first time it is needed each day, and when
+    the stimulator class has changed, as a different class declares different resultFields. Results the mouse had
+    before, restored from the journal or kept by another stimulator, are copied into a new record where fields match
+    """
+    stimName = type(stimulator).__name__
+    if expSettings.stimResults is None or expSettings.stimResults.stimulator != stimName:
+        if expSettings.stimResults is not None:
+            expSettings.stimResults.quit()
+        expSettings.stimResults = AHF_StimResults(expSettings.stimResultsPrefix + stimName + '.stim',
+                                                  stimulator.resultFields, stimName)
+    mouse.stimResultsDict = expSettings.stimResults.recordFor(mouse.tag, mouse.stimResultsDict)
+
+
+def restoreFromJournal(expSettings, mice, rewarder):
+    """
+    Recovers the day's journal, and sets each mouse in it to its journaled state, adding mice missing from quick stats
+
+    The journal is newer than the quick stats and reward ledger files, which are only written when a mouse leaves, so
+    it wins where they differ, and the quick stats file is updated to match
+    """
+    startTime = perf_counter()
+    state, nReplayed, nTorn = expSettings.journal.recover()
+    for key, mouseState in state.items():
+        mouse = mice.getMouseFromTag(int(key))
+        if mouse is None:
+            mouse = Mouse(int(key), 0, 0, 0, 0)
+            mice.addMouse(mouse, expSettings.statsFP)
+        mouse.setState(mouseState['mouse'])
+        rewarder.ledgers[mouse.tag] = mouse.ledger = AHF_RewardLedger(mouseState['ledger'])
+        updateStats(expSettings.statsFP, mice, mouse)
+    if len(state) > 0:
+        print ('Restored {:d} mice from the journal, replaying {:d} records, in {:.1f} ms'.format(
+            len(state), nReplayed, (perf_counter() - startTime) * 1e03))
+
+
+def updateStats(statsFP, mice, mouse, mouseHistory=None, tubeSecs=0.0):
     """ Updates the quick stats text file after every exit, mostly for the benefit of folks logged in remotely
     :param statsFP: file pointer to the stats file
     :param mice: the array of mouse objects
     :param mouse: the mouse which just left the chamber 
+    :param mouseHistory: AHF_MouseHistory index to add the mouse's new counts to, or None
+    :param tubeSecs: time the mouse spent in the tube on this entry, for the history
     returns:nothing
     """
     pos = mouse.arrayPos
@@ -412,16 +855,12 @@ def updateStats(statsFP, mice, mouse):
     statsFP.seek(39 + 38 * pos)
     # we are in the right place in the file and new and existing values are
     # zero-padded to the same length, so overwriting should work
-    outPutStr = '{:013}'.format(mouse.tag) + "\t" + \
-        '{:05}'.format(mouse.entries)
-    outPutStr += "\t" + \
-        '{:05}'.format(mouse.entranceRewards) + "\t" + \
-        '{:05}'.format(mouse.headFixes)
-    outPutStr += "\t" + '{:05}'.format(mouse.headFixRewards) + "\n"
-    statsFP.write(outPutStr)
+    statsFP.write(mouse.statsStr())
     statsFP.flush()
     # leave file position at end of file so when we quit, nothing is truncated
     statsFP.seek(39 + 38 * mice.nMice())
+    if mouseHistory is not None:
+        mouseHistory.update(mouse, tubeSecs)
 
 
 if __name__ == '__main__':